@@ -1,25 +1,36 @@
 # https://www.pragnakalp.com/create-telegram-bot-using-python-tutorial-with-examples/
 
-import io
+import asyncio
+import hmac
+import os
 
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
 # Import necessary modules
 from fastapi import FastAPI, Query, Request
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
 import messages
-from image_lib import download_image, rotate_image
+import image_cache
+import image_lib
 import messages as msgs
 import database as db
+import database_async as dba
 import db_schema
-import hyperparameters as hp
+import dedup
+import leaderboard as lb
+import notifier
+import session_store
+import updates
 # Import functions from other modules
 from telegram_aux import *
 
-scheduler = BackgroundScheduler(jobstores={'default': SQLAlchemyJobStore(url=db_schema.DATABASE_URL)})
+# results are notified by notifier.dispatcher. The scheduler only runs the notification jobs persisted by
+# earlier versions, until they are drained
+scheduler = BackgroundScheduler(jobstores={'default': SQLAlchemyJobStore(engine=db_schema.engine)})
 scheduler.start()
 
 # Create FastAPI app object
@@ -29,85 +40,100 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
-# Route for the root directory; handles Telegram messages
-@app.post("/", response_class=HTMLResponse)
-async def index(request: Request):
-    # Get the message from the POST request
-    req = await request.json()
-
-    # Parse the message to a structured dictionary
-    dict_msg = tel_parse_message(req)
-
-    user_id = dict_msg.get('user_id', '')
-    txt = dict_msg.get('txt', '')
-
-    # load dict from disk, update it and save it back to disk
-    dict_user_hp = db.load_dict(user_id)
-    dict_user_hp = msgs.update_dict_user_hps(dict_user_hp, dict_msg)
-    db.save_dict(dict_user_hp, user_id)
+# shared secret of the admin routes (X-Admin-Token header)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
 
-    # register the competitor in the database, if necessary
-    if not db.list_competitors(dict_msg):
-        db.insert_competitor(dict_msg)
+# worker pool used by the fast-ack webhook mode
+update_pool = updates.UpdateWorkerPool(updates.handle_update)
 
-    # evaluate the user's message and respond accordingly
-    if txt == 'new_model':
-        dict_user_hp = {}
-        db.save_dict(dict_user_hp, user_id)
-        msgs.select_batch_size(dict_msg)
 
-    elif txt in hp.batch_sizes:
-        msgs.select_epochs(dict_msg)
+@app.on_event("startup")
+async def startup():
+    # shared HTTP session for image downloads
+    await image_lib.open_session()
 
-    elif txt in hp.epochs:
-        msgs.select_lr(dict_msg)
+    # preload the pretrained metrics of every hyperparameter configuration
+    db.get_metrics_grid()
+    db.get_costs_table()
+    # build the leaderboard once; it is then kept up to date as results are notified
+    lb.board.start()
+    # leaderboard pushes are fanned out on this loop
+    lb.broadcaster.attach(asyncio.get_running_loop())
+    # send the results of the pending trainings when they are due
+    notifier.dispatcher.start()
 
-    elif txt in hp.learning_rates:
-        msgs.select_batch_norm(dict_msg)
+    if image_cache.IMAGE_CACHE_PREWARM:
+        # fill the rotated image cache for the whole hyperparameter grid in the background
+        asyncio.ensure_future(image_cache.prewarm())
 
-    elif txt in hp.batch_norm:
-        msgs.select_filters(dict_msg)
+    if updates.WEBHOOK_MODE == 'queue':
+        update_pool.start()
 
-    elif txt in hp.filters:
-        msgs.select_dropout(dict_msg)
 
-    elif txt in hp.dropout:
-        msgs.select_image_size(dict_msg)
+@app.on_event("shutdown")
+async def shutdown():
+    # close the leaderboard streams, then finish the queued updates, as they may still send messages
+    lb.broadcaster.close()
+    update_pool.stop()
+    notifier.dispatcher.stop()
+    session_store.store.close()
 
-    elif txt in hp.image_size:
-        msgs.select_gpu(dict_msg, dict_user_hp)
+    # send what is still queued, then close the pooled Telegram API connections
+    dispatcher.drain()
+    client.close()
+    await image_lib.close_session()
+    image_lib.shutdown_executor()
+    await dba.close()
 
-    elif txt in msgs.GPU_NAMES:
-        msgs.submit_training(dict_msg, dict_user_hp, request=request, scheduler=scheduler)
 
-    elif txt == "list_competitors":
-        results = json.dumps(db.list_competitors(), indent=2, default=str)
-        msg = 'Users:\n' + results
-        tel_send_message(dict_msg, msg)
-
-    elif txt == "show_leaderboard":
-        msgs.show_leaderboard(dict_msg)
-
-    elif txt == "show_status":
-        msgs.show_training_status(dict_msg, request=request)
-
-    else:
-        # clear dict user hyperparameters
-        dict_user_hp = {}
-        db.save_dict(dict_user_hp, user_id)
-        msgs.welcome_message(dict_msg)
+# Route for the root directory; handles Telegram messages
+@app.post("/", response_class=HTMLResponse)
+async def index(request: Request):
+    # Get the message from the POST request
+    try:
+        req = await request.json()
+    except ValueError:
+        return JSONResponse('invalid update', status_code=400)
+
+    if not updates.is_valid_update(req):
+        return JSONResponse('invalid update', status_code=400)
+
+    if not updates.is_handled_update(req):
+        # answered with a 200, or Telegram would keep redelivering it
+        return JSONResponse('ignored', status_code=200)
+
+    # a user's updates are claimed and handled in the order they arrived: the user's lock is taken before the
+    # first await, and asyncio locks are granted first come, first served. Each user has a lock of their own
+    async with updates.user_async_lock(req):
+        # Telegram redelivers updates it got no answer for in time; those already accepted are only acknowledged
+        update_id = req['update_id']
+        if not await dedup.deduplicator.claim_async(update_id):
+            return JSONResponse('duplicate', status_code=200)
+
+        if updates.WEBHOOK_MODE == 'queue':
+            # ack right away; a worker processes the update. Rejected updates are redelivered by Telegram later
+            result = update_pool.submit(req, str(request.base_url))
+            if result == updates.REJECTED:
+                await run_in_threadpool(dedup.deduplicator.release, update_id)
+                return JSONResponse(result, status_code=503)
+            return JSONResponse(result, status_code=200)
+
+        # the registration, balance and submission queries are awaited on the loop, and the rest of the flow runs
+        # in a thread, so the loop keeps serving other users meanwhile
+        try:
+            await updates.handle_update_async(req, str(request.base_url))
+        except Exception:
+            # answered with an error, so Telegram sends it again
+            await run_in_threadpool(dedup.deduplicator.release, update_id)
+            raise
 
     return JSONResponse('ok', status_code=200)
 
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    df = db.get_leaderboard_df()
-    df['last_submission'] = df['last_submission'].apply(msgs.calculate_time_ago)
-    df['rank'] = df.index + 1
-    df = df[['rank', 'fullname', 'score', 'entries', 'last_submission']]
-    df.columns = ['#', 'Team', 'Score', 'Entries', 'Last']
-    return templates.TemplateResponse("index.html", {"request": request, "df": df}, status_code=200)
+    # the table itself is filled by the page from /api/leaderboard
+    return templates.TemplateResponse("index.html", {"request": request}, status_code=200)
 
 
 # Route for uploading JSON records to the database
@@ -143,12 +169,34 @@ async def index(request: Request):
 @app.head("/notify_results")  # https://uptimerobot.com/ calls the api through a HEAD request each 5 min
 def notify_results(request: Request):
     # Notify the competitors
-    results = msgs.notify_finished_trainings(base_url=str(request.base_url))
+    try:
+        results = msgs.notify_finished_trainings(base_url=str(request.base_url))
+    except Exception as e:
+        print(f'Error notifying finished trainings: {e!r}')
+        return JSONResponse('Error notifying finished trainings.', status_code=500)
 
     # Return the number of users notified
     return JSONResponse(f'{str(results)} users notified.', status_code=200)
 
 
+def is_admin(request: Request) -> bool:
+    # admin routes need the ADMIN_TOKEN shared secret in the X-Admin-Token header; without one set they are off
+    token = request.headers.get('x-admin-token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+# route for reloading the GPU costs after the training_costs table is edited
+@app.post("/refresh_costs")
+def refresh_costs(request: Request):
+    if not is_admin(request):
+        return JSONResponse('Forbidden.', status_code=403)
+
+    if not db.load_costs_table():
+        return JSONResponse('Error loading the costs table.', status_code=500)
+
+    return JSONResponse(f'{len(db.costs_table)} GPU costs loaded.', status_code=200)
+
+
 # route for listing pretrained model metrics
 #@app.get("/list_competitors", response_class=JSONResponse)
 #def list_competitors():
@@ -160,19 +208,86 @@ def notify_results(request: Request):
 
 # Route for listing pretrained model metrics
 @app.get("/api/leaderboard", response_class=JSONResponse)
-async def get_leaderboard():
-    df = db.get_leaderboard_df()
-    df['last_submission'] = df['last_submission'].apply(msgs.calculate_time_ago)
-    df['rank'] = df.index + 1
-    df = df[['rank', 'fullname', 'score', 'entries', 'last_submission', 'sum_costs']]
-    df.columns = ['#', 'Team', 'Score', 'Entries', 'Last', f'Spent {messages.COIN}']
-
-    return JSONResponse(df.to_dict(orient="records"), status_code=200)
+async def get_leaderboard(request: Request):
+    payload = lb.board.api_payload()
+
+    # browsers revalidate every poll; unchanged boards cost a 304 with no body
+    headers = {'ETag': payload.etag,
+               'Last-Modified': payload.last_modified,
+               'Cache-Control': 'no-cache',
+               'Vary': 'Accept-Encoding'}
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if payload.etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')] or \
+                if_none_match.strip() == '*':
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get('if-modified-since') == payload.last_modified:
+        return Response(status_code=304, headers=headers)
+
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return Response(payload.gzipped, status_code=200, headers=headers, media_type='application/json')
+
+    return Response(payload.body, status_code=200, headers=headers, media_type='application/json')
+
+
+# Route for the live leaderboard (server-sent events): the whole board on connect, then diffs as results come in
+@app.get("/api/leaderboard/stream")
+async def get_leaderboard_stream(request: Request):
+    queue = lb.broadcaster.subscribe()
+    first = lb.broadcaster.format('full', lb.board.records(lb.board.rows()))
+
+    async def events():
+        try:
+            yield 'retry: 10000\n' + first
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # keeps proxies (and the Heroku router) from closing an idle stream
+                    message = ': keep-alive\n\n'
+
+                if message is None or await request.is_disconnected():
+                    break
+                yield message
+        finally:
+            lb.broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.get("/rotate_image", tags=["images"], name="rotate_image")
-async def get_rotated_image(image_url: str = Query(...)):
-    image_bytes = await download_image(image_url)
-    rotated_image_bytes = await rotate_image(io.BytesIO(image_bytes))
+async def get_rotated_image(request: Request, image_url: str = Query(...)):
+    if not image_cache.is_bucket_url(image_url):
+        return JSONResponse('image_url is not a result figure', status_code=400)
+
+    image_format = image_lib.negotiate_format(request.headers.get('accept'))
+
+    # the result only depends on the URL and the format, so it is cached on disk and by clients
+    etag = '"' + image_cache.cache.key(image_url, image_format)[:32] + '"'
+    headers = {'ETag': etag,
+               'Cache-Control': f'public, max-age={image_cache.IMAGE_CACHE_MAX_AGE}, immutable',
+               'Vary': 'Accept'}
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+
+    path = await image_cache.rotated_image_path(image_url, image_format)
+
+    return FileResponse(path, media_type=image_lib.IMAGE_MEDIA_TYPES[image_format], headers=headers)
+
+
+# Route for operational metrics of the bot subsystems
+@app.get("/api/metrics", response_class=JSONResponse)
+async def get_metrics():
+    metrics = {'telegram_outbound': dispatcher.stats(),
+               'updates': update_pool.stats(),
+               'dedup': dedup.deduplicator.stats(),
+               'notifications': notifier.dispatcher.stats(),
+               'db_pool': db_schema.engine.pool.stats(),
+               'leaderboard_stream': lb.broadcaster.stats(),
+               'image_cache': image_cache.cache.stats()}
 
-    return StreamingResponse(rotated_image_bytes, media_type="image/png")
+    return JSONResponse(metrics, status_code=200)
@@ -0,0 +1,188 @@
+"""
+Local stand-in for the Telegram Bot API, for load tests and benchmarks.
+
+Answers the methods the bot calls (sendMessage, sendPhoto, sendMediaGroup, editMessageText, ...) with well-formed
+results after a configurable latency, and can answer a fraction of the calls with 429 Too Many Requests. Point the
+app at it with TELEGRAM_API_URL:
+
+    python benchmarks/fake_telegram.py --port 8081 --latency-ms 50 --jitter-ms 20 --rate-429 0.02
+    TELEGRAM_API_URL=http://localhost:8081 TELEGRAM_TOKEN=test python main.py
+
+It also serves getUpdates, for the poller: POST /updates queues updates (one object or a list; a missing update_id
+is assigned), and getUpdates returns them like Telegram does. Updates below the offset are confirmed and dropped,
+and a call with a timeout waits up to that long for an update before it returns an empty list:
+
+    TELEGRAM_API_URL=http://localhost:8081 TELEGRAM_TOKEN=test python poller.py
+
+GET /stats returns the calls received per method and per chat and the updates queued and confirmed; GET /reset
+clears them.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_429: float = 0, retry_after: int = 1,
+                 seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1)
+        self.next_update_id = 1
+        self._new_update = asyncio.Event()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.calls = collections.Counter()
+        self.rejected = collections.Counter()
+        self.chats = collections.Counter()
+        # queued updates, by update_id, until a getUpdates offset confirms them
+        self.updates = {}
+        self.updates_queued = 0
+        self.updates_confirmed = 0
+
+    def message(self, chat_id, **fields) -> dict:
+        return {'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                **fields}
+
+    def result(self, method: str, payload: dict):
+        chat_id = payload.get('chat_id')
+
+        if method == 'sendMessage':
+            return self.message(chat_id, text=payload.get('text', ''))
+        if method == 'editMessageText':
+            return self.message(chat_id, text=payload.get('text', ''), edit_date=int(time.time()))
+        if method == 'sendPhoto':
+            return self.message(chat_id, photo=[{'file_id': str(payload.get('photo')), 'width': 1, 'height': 1}])
+        if method == 'sendMediaGroup':
+            media_group_id = str(next(self.message_ids))
+            return [self.message(chat_id, media_group_id=media_group_id,
+                                 photo=[{'file_id': str(item.get('media')), 'width': 1, 'height': 1}])
+                    for item in payload.get('media', [])]
+        if method == 'getUserProfilePhotos':
+            return {'total_count': 0, 'photos': []}
+        if method.startswith('send'):
+            return self.message(chat_id)
+
+        return True
+
+    def confirm(self, offset: int):
+        # every update below the offset was received by the bot
+        for update_id in [update_id for update_id in self.updates if update_id < offset]:
+            del self.updates[update_id]
+            self.updates_confirmed += 1
+
+    async def get_updates(self, payload: dict) -> list:
+        if payload.get('offset') is not None:
+            self.confirm(int(payload['offset']))
+
+        limit = min(max(int(payload.get('limit') or 100), 1), 100)
+        deadline = time.monotonic() + float(payload.get('timeout') or 0)
+
+        # long polling: wait for an update until the timeout, like Telegram
+        while not self.updates and time.monotonic() < deadline:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+
+        return [self.updates[update_id] for update_id in sorted(self.updates)[:limit]]
+
+    async def queue_updates(self, request: web.Request) -> web.Response:
+        updates = await request.json()
+        if isinstance(updates, dict):
+            updates = [updates]
+
+        update_ids = []
+        for update in updates:
+            update_id = update.setdefault('update_id', self.next_update_id)
+            # assigned ids keep increasing past the ones given
+            self.next_update_id = max(self.next_update_id, update_id + 1)
+            self.updates[update_id] = update
+            update_ids.append(update_id)
+
+        self.updates_queued += len(update_ids)
+        self._new_update.set()
+        return web.json_response({'ok': True, 'update_ids': update_ids})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = dict(await request.post())
+
+        delay = self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if self.rate_429 and self.random.random() < self.rate_429:
+            self.rejected[method] += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f'Too Many Requests: retry after {self.retry_after}',
+                                      'parameters': {'retry_after': self.retry_after}}, status=429)
+
+        self.calls[method] += 1
+        if payload.get('chat_id') is not None:
+            self.chats[str(payload['chat_id'])] += 1
+
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self.get_updates(payload)})
+
+        return web.json_response({'ok': True, 'result': self.result(method, payload)})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({'elapsed_secs': round(time.time() - self.started, 3),
+                                  # the long polls of the poller are not replies to updates
+                                  'total': sum(self.calls.values()) - self.calls['getUpdates'],
+                                  'rejected_429': sum(self.rejected.values()),
+                                  'calls': self.calls,
+                                  'rejected': self.rejected,
+                                  'chats': self.chats,
+                                  'updates_queued': self.updates_queued,
+                                  'updates_pending': len(self.updates),
+                                  'updates_confirmed': self.updates_confirmed})
+
+    async def clear(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({'ok': True})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_post('/updates', self.queue_updates)
+        app.router.add_get('/stats', self.stats)
+        app.router.add_get('/reset', self.clear)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0, help='mean latency of each call')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='latency varies uniformly by up to this much')
+    parser.add_argument('--rate-429', type=float, default=0, help='fraction of calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the 429 answers (s)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after, args.seed)
+    print(f'Fake Bot API on http://{args.host}:{args.port}')
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
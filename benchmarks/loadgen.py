@@ -0,0 +1,198 @@
+"""
+End-to-end load generator: N concurrent competitors walking the training wizard against the webhook.
+
+Each competitor posts the callback updates of the whole wizard (new_model, batch size, epochs, learning rate,
+batch norm, filters, dropout, image size, GPU) to POST /, one after the other, as a user tapping the buttons would.
+Run the app against benchmarks/fake_telegram.py so the outbound calls can be counted:
+
+    python benchmarks/fake_telegram.py --latency-ms 50 &
+    TELEGRAM_API_URL=http://localhost:8081 TELEGRAM_TOKEN=test python main.py &
+    python benchmarks/loadgen.py --users 200 --rounds 2
+
+With --mode poll the updates are queued on the fake server instead, for poller.py to fetch with getUpdates:
+
+    TELEGRAM_API_URL=http://localhost:8081 TELEGRAM_TOKEN=test python poller.py &
+    python benchmarks/loadgen.py --mode poll --users 200 --rounds 2
+
+Reports the throughput, the p50/p95/p99 latency of each step and the outbound API calls per update. In the queue
+webhook mode the latency is the time to the ack, not to the end of the processing. In the poll mode it is the time
+to queue the update, and the elapsed time runs until the poller confirmed every update.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+
+import hyperparameters as hp
+
+STEPS = [('new_model', None),
+         ('batch_size', hp.batch_sizes),
+         ('epochs', hp.epochs),
+         ('learning_rate', hp.learning_rates),
+         ('batch_norm', hp.batch_norm),
+         ('filters', hp.filters),
+         ('dropout', hp.dropout),
+         ('image_size', hp.image_size),
+         ('gpu_model', None)]
+
+
+def percentile(values: list, p: float) -> float:
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return float('nan')
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class LoadGenerator:
+    def __init__(self, url: str, users: int, rounds: int, gpu: str, user_base: int, seed: int = None):
+        self.url = url
+        self.users = users
+        self.rounds = rounds
+        self.gpu = gpu
+        self.user_base = user_base
+        self.random = random.Random(seed)
+
+        # unique across runs, so the webhook deduplicator doesn't drop updates of a previous run
+        self.update_ids = iter(range(int(time.time() * 1000), 2 ** 62))
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.Counter()
+        self.errors = 0
+
+    def update(self, user_id: int, data: str) -> dict:
+        return {'update_id': next(self.update_ids),
+                'callback_query': {'id': str(user_id),
+                                   'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load',
+                                            'last_name': str(user_id), 'username': f'load_{user_id}'},
+                                   'data': data}}
+
+    def wizard(self) -> list:
+        steps = []
+        for step, options in STEPS:
+            if step == 'new_model':
+                steps.append((step, 'new_model'))
+            elif step == 'gpu_model':
+                steps.append((step, f'gpu_model_{self.gpu}'))
+            else:
+                steps.append((step, self.random.choice(options)))
+        return steps
+
+    async def competitor(self, session: aiohttp.ClientSession, user_id: int):
+        for _ in range(self.rounds):
+            for step, data in self.wizard():
+                started = time.perf_counter()
+                try:
+                    async with session.post(self.url, json=self.update(user_id, data)) as response:
+                        await response.read()
+                        self.statuses[response.status] += 1
+                except aiohttp.ClientError as e:
+                    self.errors += 1
+                    print(f'Error posting {step} of {user_id}: {e!r}')
+                    continue
+                self.latencies[step].append((time.perf_counter() - started) * 1000)
+
+    async def run(self) -> float:
+        connector = aiohttp.TCPConnector(limit=self.users)
+        timeout = aiohttp.ClientTimeout(total=120)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            started = time.perf_counter()
+            await asyncio.gather(*(self.competitor(session, self.user_base + i) for i in range(self.users)))
+            return time.perf_counter() - started
+
+
+async def fake_stats(session: aiohttp.ClientSession, fake_url: str) -> dict:
+    async with session.get(f'{fake_url}/stats') as response:
+        return await response.json()
+
+
+async def settled_fake_stats(fake_url: str, quiet_secs: float, max_secs: float) -> dict:
+    # outbound calls keep arriving after the webhook answered (queue mode, rate limited sends); wait until the
+    # fake server has seen no new call for quiet_secs
+    async with aiohttp.ClientSession() as session:
+        stats = await fake_stats(session, fake_url)
+        deadline = time.monotonic() + max_secs
+        while time.monotonic() < deadline:
+            await asyncio.sleep(quiet_secs)
+            latest = await fake_stats(session, fake_url)
+            if latest['total'] == stats['total']:
+                break
+            stats = latest
+        return stats
+
+
+async def confirmed_updates(fake_url: str, max_secs: float) -> float:
+    # poll mode: waits until the poller confirmed every queued update; returns how long it took
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() - started < max_secs:
+            if (await fake_stats(session, fake_url))['updates_pending'] == 0:
+                break
+            await asyncio.sleep(0.05)
+    return time.monotonic() - started
+
+
+async def reset_fake(fake_url: str):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'{fake_url}/reset') as response:
+            await response.read()
+
+
+def report(generator: LoadGenerator, elapsed: float, stats: dict = None):
+    total = sum(len(values) for values in generator.latencies.values())
+    print(f'{generator.users} competitors x {generator.rounds} rounds: {total} updates in {elapsed:.2f}s '
+          f'({total / elapsed:.1f} updates/s), {generator.errors} errors, statuses {dict(generator.statuses)}')
+
+    print(f'\n{"step":<14} {"n":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for step, _ in STEPS:
+        values = sorted(generator.latencies[step])
+        if values:
+            print(f'{step:<14} {len(values):>6} {percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f} '
+                  f'{percentile(values, 99):>9.1f} {values[-1]:>9.1f}')
+
+    if stats is not None:
+        print(f'\noutbound API calls: {stats["total"]} ({stats["total"] / max(total, 1):.2f} per update), '
+              f'{stats["rejected_429"]} answered with 429')
+        print(json.dumps(stats['calls'], sort_keys=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=['webhook', 'poll'], default='webhook',
+                        help='post the updates to the webhook, or queue them on the fake server for poller.py')
+    parser.add_argument('--url', default='http://localhost:8000/', help='webhook URL of the app')
+    parser.add_argument('--fake-url', default='http://localhost:8081',
+                        help='fake Bot API to read the outbound call counts from; empty to skip')
+    parser.add_argument('--users', type=int, default=50, help='concurrent competitors')
+    parser.add_argument('--rounds', type=int, default=1, help='wizards walked by each competitor')
+    parser.add_argument('--gpu', default='CPU', help='gpu_model of the submissions (a row of training_costs)')
+    parser.add_argument('--user-base', type=int, default=900000000, help='user id of the first competitor')
+    parser.add_argument('--settle-secs', type=float, default=1, help='quiet time that ends the outbound count')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.mode == 'poll' and not args.fake_url:
+        parser.error('--mode poll needs the fake server (--fake-url)')
+
+    if args.fake_url:
+        asyncio.run(reset_fake(args.fake_url))
+
+    url = f'{args.fake_url}/updates' if args.mode == 'poll' else args.url
+    generator = LoadGenerator(url, args.users, args.rounds, args.gpu, args.user_base, args.seed)
+    elapsed = asyncio.run(generator.run())
+    if args.mode == 'poll':
+        elapsed += asyncio.run(confirmed_updates(args.fake_url, 300))
+
+    stats = asyncio.run(settled_fake_stats(args.fake_url, args.settle_secs, 120)) if args.fake_url else None
+    report(generator, elapsed, stats)
+
+
+if __name__ == "__main__":
+    main()
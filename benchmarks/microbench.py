@@ -0,0 +1,157 @@
+"""
+Microbenchmarks of the pure functions on the per-update path, compared against a stored baseline.
+
+Times each function with timeit (best of --repeat samples) and compares it with benchmarks/microbench_baseline.json.
+Exits with status 1 when a function got slower than its baseline by more than --threshold:
+
+    python benchmarks/microbench.py                # compare with the baseline
+    python benchmarks/microbench.py --save         # record a new baseline
+    python benchmarks/microbench.py -k time_ago    # only the matching benchmarks
+
+Timings depend on the machine and the Python version, so the baseline should be recorded on the machine that runs
+the comparison. The functions don't touch the database, but importing messages.py needs one; without a
+DATABASE_URL a throwaway sqlite file is used.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.gettempdir(), "microbench.db")}')
+
+import hyperparameters as hp
+import messages as msgs
+from telegram_aux import tel_parse_message
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json')
+
+UPDATE_MESSAGE = {'update_id': 100000001,
+                  'message': {'message_id': 1, 'date': 1684800000, 'text': '/start',
+                              'chat': {'id': 123456789, 'type': 'private'},
+                              'from': {'id': 123456789, 'is_bot': False, 'first_name': 'Ada', 'last_name': 'Lovelace',
+                                       'username': 'ada'}}}
+UPDATE_CALLBACK = {'update_id': 100000002,
+                   'callback_query': {'id': '1', 'data': 'learning_rate|0.001',
+                                      'from': {'id': 123456789, 'is_bot': False, 'first_name': 'Ada',
+                                               'last_name': 'Lovelace', 'username': 'ada'}}}
+DICT_MSG = {'chat_id': 123456789, 'txt': 'learning_rate|0.001', 'user_id': '123456789'}
+DICT_USER_HP = {'batch_size': '8', 'epochs': '10', 'learning_rate': '0.001', 'batch_norm': 'True', 'filters': '32',
+                'dropout': '0.2', 'image_size': '128'}
+
+
+def benchmarks() -> dict:
+    # name -> zero-argument callable. Timestamps are relative to now, so each time_ago case stays in its bucket
+    now = datetime.datetime.now()
+    submitted = str(now - datetime.timedelta(hours=2, minutes=13, seconds=7, microseconds=1))
+    available = str(now + datetime.timedelta(minutes=41, microseconds=1))
+    ago = {label: str(now - delta) for label, delta in [('now', datetime.timedelta(seconds=20)),
+                                                         ('min', datetime.timedelta(minutes=17)),
+                                                         ('h', datetime.timedelta(hours=5)),
+                                                         ('d', datetime.timedelta(days=12)),
+                                                         ('mo', datetime.timedelta(days=95)),
+                                                         ('y', datetime.timedelta(days=800))]}
+
+    cases = {'tel_parse_message[message]': lambda: tel_parse_message(UPDATE_MESSAGE),
+             'tel_parse_message[callback]': lambda: tel_parse_message(UPDATE_CALLBACK),
+             'update_dict_user_hps': lambda: msgs.update_dict_user_hps({}, DICT_MSG),
+             'extract_dict_options': lambda: msgs.extract_dict_options('learning_rate|0.001'),
+             'create_dict_options': lambda: msgs.create_dict_options(hp.learning_rates),
+             'parse_user_hps': lambda: msgs.parse_user_hps(DICT_USER_HP),
+             'calc_timestamp_diff_in_secs': lambda: msgs.calc_timestamp_diff_in_secs(submitted, available),
+             'convert_seconds': lambda: msgs.convert_seconds(8029.5)}
+
+    for label, timestamp in ago.items():
+        cases[f'calculate_time_ago[{label}]'] = lambda timestamp=timestamp: msgs.calculate_time_ago(timestamp)
+
+    # a leaderboard column of 1000 teams, in every bucket
+    column = [datetime.datetime.fromisoformat(timestamp) for timestamp in ago.values()] * 167
+    cases['calculate_times_ago[1000]'] = lambda: msgs.calculate_times_ago(column[:1000])
+
+    return cases
+
+
+def measure(cases: dict, repeat: int) -> dict:
+    # best time per call of each case, in ns. The cases are timed round-robin in short samples, so a slow spell of
+    # the machine hits every benchmark instead of skewing one. Output (tel_parse_message logs every update) goes to
+    # /dev/null, as it would to a log: its formatting is part of the cost, the terminal is not
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        timers = {}
+        for name, function in cases.items():
+            timer = timeit.Timer(function)
+            # autorange aims at 0.2 s; samples of about 20 ms
+            number, _ = timer.autorange()
+            timers[name] = (timer, max(1, number // 10))
+
+        best = {name: float('inf') for name in cases}
+        for _ in range(repeat):
+            for name, (timer, number) in timers.items():
+                best[name] = min(best[name], timer.timeit(number) / number * 1e9)
+
+    return best
+
+
+def environment() -> dict:
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def load_baseline(path: str) -> dict:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown over the baseline reported as a regression (0.25 = 25%%)')
+    parser.add_argument('--repeat', type=int, default=25, help='samples of each benchmark; the best one counts')
+    parser.add_argument('-k', dest='filter', default='', help='only run the benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline.get('environment') != environment():
+        print(f'Baseline recorded on {baseline.get("environment")}, running on {environment()}')
+    baseline_results = baseline.get('results', {})
+
+    cases = {name: function for name, function in benchmarks().items() if args.filter in name}
+    results = measure(cases, args.repeat)
+
+    regressions = []
+    print(f'{"benchmark":<32} {"ns/call":>10} {"baseline":>10} {"change":>8}')
+    for name, ns in results.items():
+        reference = baseline_results.get(name)
+        if reference is None:
+            print(f'{name:<32} {ns:>10.0f} {"-":>10} {"new":>8}')
+            continue
+
+        change = ns / reference - 1
+        flag = ''
+        if change > args.threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<32} {ns:>10.0f} {reference:>10.0f} {change:>+8.1%}{flag}')
+
+    if args.save:
+        # a filtered run only replaces the benchmarks it ran
+        baseline_results.update({name: round(ns, 1) for name, ns in results.items()})
+        with open(args.baseline, 'w') as file:
+            json.dump({'environment': environment(), 'results': baseline_results}, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regression(s) over {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
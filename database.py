@@ -1,23 +1,55 @@
 import datetime
-import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
 
-import pandas as pd
-import numpy as np
 import sqlalchemy
-from pandas import DataFrame
-from sqlalchemy import NUMERIC
-from sqlalchemy import create_engine, select, insert
+from sqlalchemy import Numeric
+from sqlalchemy import select, insert
 from sqlalchemy import func
 
 import db_schema
+import session_store
 # import tables from the db_schema module
-from db_schema import tb_pretrained, tb_competitors, tb_submissions, tb_costs, DATABASE_URL
+from db_schema import tb_pretrained, tb_competitors, tb_submissions, tb_costs, tb_balances
 
-# create a SQLAlchemy engine object using the DATABASE_URL
-engine = create_engine(DATABASE_URL)
+# pandas is only needed by the load_df_* analytics exports, so webhook workers never import it
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+# the engine (and connection pool) shared by the whole process
+engine = db_schema.engine
 
 INITIAL_BALANCE = 10
 
+# how often the in-memory metrics grid is reloaded from pretrained_results
+METRICS_GRID_REFRESH_SECS = float(os.environ.get('METRICS_GRID_REFRESH_SECS', 600))
+
+METRICS_COLUMNS = ['avg_training_secs', 'stddev_training_secs',
+                   'avg_metrics_train_set', 'stddev_metrics_train_set',
+                   'avg_metrics_val_set', 'stddev_metrics_val_set',
+                   'avg_metrics_test_set', 'stddev_metrics_test_set']
+
+# how often the cached training_costs table is reloaded, so GPUs added to the table show up without a restart
+COSTS_REFRESH_SECS = float(os.environ.get('COSTS_REFRESH_SECS', 300))
+
+# aggregated metrics of pretrained_results, keyed by metrics_key(); None until load_metrics_grid() succeeds
+metrics_grid = None
+_metrics_grid_lock = threading.Lock()
+_metrics_grid_refresher = None
+
+# rows of training_costs in display order, None until load_costs_table() succeeds
+costs_table = None
+_costs_lock = threading.Lock()
+_costs_refresher = None
+# called with the new table after each load, to rebuild what is derived from it (messages.build_costs_msgs)
+costs_listeners = []
+
+
+class InsufficientBalance(Exception):
+    """Raised by make_submission when the competitor's balance does not cover the cost."""
+
 
 def insert_competitor(dict_msg: dict = {}):
     user_id = dict_msg.get('user_id', '')
@@ -30,9 +62,10 @@ def insert_competitor(dict_msg: dict = {}):
                                          initial_balance=initial_balance)
 
     try:
-        # execute the insert statement within a transaction and commit it
+        # execute the insert statements (competitor and opening balance) within a transaction and commit it
         with engine.connect() as conn:
             conn.execute(stmt)
+            conn.execute(insert(tb_balances).values(user_id=user_id, balance=initial_balance))
             conn.commit()
             return True
 
@@ -48,6 +81,14 @@ def insert_competitor(dict_msg: dict = {}):
     return
 
 
+def register_competitor(dict_msg: dict) -> bool:
+    # inserts the competitor unless they exist. Returns True if they were new
+    if list_competitors(dict_msg):
+        return False
+
+    return bool(insert_competitor(dict_msg))
+
+
 def list_competitors(dict_msg: dict = {}):
     if dict_msg == {}:
         # create a select statement for the tb_competitors table that retrieves all rows
@@ -93,7 +134,10 @@ def insert_json(json_record: dict):
         with engine.connect() as conn:
             conn.execute(tb_pretrained.insert(), [json_record])
             conn.commit()
-            return 'JSON inserted successfully.'
+
+        # the new run changes the aggregates of its configuration
+        load_metrics_grid()
+        return 'JSON inserted successfully.'
 
     except sqlalchemy.exc.IntegrityError as e:
         # handle the case where the insert fails due to a unique constraint violation and print the error message for
@@ -107,7 +151,88 @@ def insert_json(json_record: dict):
     return
 
 
-def return_metrics(dict_user_hp: dict = {}, user_id: str = '') -> dict:
+def metrics_key(batch_size, epochs, learning_rate, batch_norm, filters, dropout, image_size) -> tuple:
+    # normalizes a configuration coming either from the database or from the user's wizard strings.
+    # learning_rate is stored as REAL, so it is rounded to drop float32 noise
+    return (int(batch_size), int(epochs), round(float(learning_rate), 8), bool(batch_norm), int(filters),
+            round(float(dropout), 2), int(image_size))
+
+
+def user_metrics_key(dict_user_hp: dict) -> tuple:
+    # the wizard stores everything as strings; 'None' dropout means 0, anything else is the 0.2 run
+    return metrics_key(dict_user_hp.get('batch_size', 0),
+                       dict_user_hp.get('epochs', 0),
+                       dict_user_hp.get('learning_rate', 0),
+                       dict_user_hp.get('batch_norm', '') == 'True',
+                       dict_user_hp.get('filters', 0),
+                       0 if dict_user_hp.get('dropout', '') == 'None' else 0.2,
+                       dict_user_hp.get('image_size', 0))
+
+
+def metrics_aggregates() -> list:
+    return [func.avg(tb_pretrained.c.training_secs).label('avg_training_secs'),
+            func.stddev(tb_pretrained.c.training_secs).label('stddev_training_secs'),
+            func.avg(tb_pretrained.c.metrics_train_set).label('avg_metrics_train_set'),
+            func.stddev(tb_pretrained.c.metrics_train_set).label('stddev_metrics_train_set'),
+            func.avg(tb_pretrained.c.metrics_val_set).label('avg_metrics_val_set'),
+            func.stddev(tb_pretrained.c.metrics_val_set).label('stddev_metrics_val_set'),
+            func.avg(tb_pretrained.c.metrics_test_set).label('avg_metrics_test_set'),
+            func.stddev(tb_pretrained.c.metrics_test_set).label('stddev_metrics_test_set')]
+
+
+def load_metrics_grid() -> bool:
+    global metrics_grid
+
+    config = [tb_pretrained.c.batch_size, tb_pretrained.c.epochs, tb_pretrained.c.learning_rate,
+              tb_pretrained.c.batch_norm, tb_pretrained.c.filters, tb_pretrained.c.dropout_norm,
+              tb_pretrained.c.image_size]
+
+    # one pass over pretrained_results computes the aggregates of every configuration
+    sql = select(*config, *metrics_aggregates()).group_by(*config)
+
+    try:
+        with engine.connect() as conn:
+            results = conn.execute(sql).fetchall()
+    except Exception as e:
+        print(f'Error loading the metrics grid: {e}')
+        return False
+
+    grid = {}
+    for row in results:
+        if None in row[:7]:
+            continue
+        grid[metrics_key(*row[:7])] = tuple(row[7:])
+
+    # swap the whole dict, so readers never see a half built grid
+    with _metrics_grid_lock:
+        metrics_grid = grid
+
+    return True
+
+
+def _refresh_metrics_grid_loop():
+    while True:
+        time.sleep(METRICS_GRID_REFRESH_SECS)
+        load_metrics_grid()
+
+
+def get_metrics_grid():
+    global _metrics_grid_refresher
+
+    if metrics_grid is None:
+        load_metrics_grid()
+
+    # start the periodic refresh on first use
+    with _metrics_grid_lock:
+        if _metrics_grid_refresher is None and METRICS_GRID_REFRESH_SECS > 0:
+            _metrics_grid_refresher = threading.Thread(target=_refresh_metrics_grid_loop,
+                                                       name='metrics-grid-refresh', daemon=True)
+            _metrics_grid_refresher.start()
+
+    return metrics_grid
+
+
+def metrics_query(dict_user_hp: dict = {}):
     if dict_user_hp.get('batch_norm', '') == 'True':
         bn = True
     else:
@@ -118,46 +243,49 @@ def return_metrics(dict_user_hp: dict = {}, user_id: str = '') -> dict:
     else:
         drop = 0.2
 
-    sql = select(func.avg(tb_pretrained.c.training_secs).label('avg_training_secs'),
-                 func.stddev(tb_pretrained.c.training_secs).label('stddev_training_secs'),
-                 func.avg(tb_pretrained.c.metrics_train_set).label('avg_metrics_train_set'),
-                 func.stddev(tb_pretrained.c.metrics_train_set).label('stddev_metrics_train_set'),
-                 func.avg(tb_pretrained.c.metrics_val_set).label('avg_metrics_val_set'),
-                 func.stddev(tb_pretrained.c.metrics_val_set).label('stddev_metrics_val_set'),
-                 func.avg(tb_pretrained.c.metrics_test_set).label('avg_metrics_test_set'),
-                 func.stddev(tb_pretrained.c.metrics_test_set).label('stddev_metrics_test_set')). \
+    sql = select(*metrics_aggregates()). \
         where(tb_pretrained.c.batch_size == dict_user_hp.get('batch_size', 0),
               tb_pretrained.c.epochs == dict_user_hp.get('epochs', 0),
               tb_pretrained.c.learning_rate == dict_user_hp.get('learning_rate', 0),
               tb_pretrained.c.batch_norm == bn,
               tb_pretrained.c.filters == dict_user_hp.get('filters', 0),
-              func.round(func.cast(tb_pretrained.c.dropout, NUMERIC), 2) == drop,
+              tb_pretrained.c.dropout_norm == drop,
               tb_pretrained.c.image_size == dict_user_hp.get('image_size', 0),
               )
 
     # print(sql.compile(compile_kwargs={"literal_binds": True}))
 
+    return sql
+
+
+def query_metrics(dict_user_hp: dict = {}) -> list:
     # execute the select statement within a transaction and retrieve all results
     with engine.connect() as conn:
-        results = conn.execute(sql).fetchall()
+        results = conn.execute(metrics_query(dict_user_hp)).fetchall()
 
-    if results == [(None, None, None, None, None, None, None, None)]:
-        result = [0, 0, 0, 0, 0, 0, 0, 0]
-    elif len(results) == 1:
-        result = results[0]
+    if len(results) == 1:
+        return results[0]
+
+    return [None] * 8
+
+
+def return_metrics(dict_user_hp: dict = {}, user_id: str = '') -> dict:
+    grid = get_metrics_grid()
+
+    if grid is None:
+        # the grid could not be loaded; query this configuration directly
+        result = query_metrics(dict_user_hp)
     else:
+        try:
+            result = grid.get(user_metrics_key(dict_user_hp), [None] * 8)
+        except ValueError:
+            # incomplete wizard state (e.g. an empty value)
+            result = [None] * 8
+
+    if all(value is None for value in result):
         result = [0, 0, 0, 0, 0, 0, 0, 0]
 
-    dict_result = {
-        'avg_training_secs': result[0],
-        'stddev_training_secs': result[1],
-        'avg_metrics_train_set': result[2],
-        'stddev_metrics_train_set': result[3],
-        'avg_metrics_val_set': result[4],
-        'stddev_metrics_val_set': result[5],
-        'avg_metrics_test_set': result[6],
-        'stddev_metrics_test_set': result[7]
-    }
+    dict_result = dict(zip(METRICS_COLUMNS, result))
 
     return dict_result
 
@@ -174,30 +302,25 @@ def generate_random_number(base_number: float, std_dev: float, max_percentage_fr
     else:
         random_number = float(base_number) - new_std_dev
 
-    return np.clip(random_number, 0, 0.99999)
+    return min(max(random_number, 0), 0.99999)
 
 
 def save_dict(dict_user_hp: dict, user_id: str):
-    filename = user_id + '.json'
-
     try:
-        # Save the dictionary to a file
-        with open(filename, "w") as file:
-            json.dump(dict_user_hp, file)
+        # Save the dictionary to the session store
+        session_store.store.save(user_id, dict_user_hp)
     except Exception as e:
         # Handle exceptions and print an error message
-        print(f"An error occurred while saving the file: {e}")
+        print(f"An error occurred while saving the session: {e}")
 
 
 def load_dict(user_id: str):
-    filename = user_id + '.json'
-
     try:
-        # Read the dictionary from the file
-        with open(filename, "r") as file:
-            loaded_dict = json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
+        # Read the dictionary from the session store
+        loaded_dict = session_store.store.load(user_id)
+    except Exception as e:
         # Return an empty dictionary if there's an error
+        print(f"An error occurred while loading the session: {e}")
         loaded_dict = {}
 
     return loaded_dict
@@ -213,6 +336,30 @@ def estimate_train_time(dict_user_hp: dict, user_id: str, chat_id: str):
 
 
 def make_submission(dict_user_hp: dict, user_id: str, chat_id: str, gpu_model: str, cost: float, estimated_time: float):
+    # the ledger holds cents: the submission records exactly what is debited
+    cost = round(float(cost), 2)
+    stmt, datetime_results_available = submission_stmt(dict_user_hp, user_id, chat_id, gpu_model, cost,
+                                                       estimated_time)
+
+    try:
+        # debit the balance and insert the submission within one transaction, so concurrent submissions of the same
+        # competitor can't spend the same balance twice
+        with engine.connect() as conn:
+            debit_balance(conn, user_id, cost)
+            conn.execute(stmt)
+            conn.commit()
+
+            return datetime_results_available
+    except InsufficientBalance:
+        raise
+    except Exception as e:
+        print(f'Error making submission\e{e}')
+        return 0
+
+
+def submission_stmt(dict_user_hp: dict, user_id: str, chat_id: str, gpu_model: str, cost: float,
+                    estimated_time: float) -> tuple:
+    # insert statement of a new submission, with its simulated results, and the time the results are available
     # searches for metrics from pretrained models
     metrics = return_metrics(dict_user_hp)
 
@@ -270,33 +417,95 @@ def make_submission(dict_user_hp: dict, user_id: str, chat_id: str, gpu_model: s
         sample_figs_urls='',
         training_status='Training')
 
-    try:
-        # execute the insert statement within a transaction and commit it
-        with engine.connect() as conn:
-            conn.execute(stmt)
-            conn.commit()
+    return stmt, datetime_results_available
 
-            return datetime_results_available
-    except Exception as e:
-        print(f'Error making submission\e{e}')
-        return 0
+
+def dialect_insert(dialect_name: str):
+    # insert construct with ON CONFLICT support for the database in use
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    return dialect_insert
+
+
+def init_balance_stmt(dialect_name: str, user_id: str):
+    # creates the balance row of a competitor registered before the ledger existed: initial balance minus what they
+    # already spent. Does nothing if the row exists
+
+    expenses = select(func.coalesce(func.sum(tb_submissions.c.cost), 0)). \
+        where(tb_submissions.c.user_id == user_id). \
+        scalar_subquery()
+    balance = select(tb_competitors.c.user_id, tb_competitors.c.initial_balance - expenses). \
+        where(tb_competitors.c.user_id == user_id)
+
+    stmt = dialect_insert(dialect_name)(tb_balances).from_select(['user_id', 'balance'], balance). \
+        on_conflict_do_nothing(index_elements=[tb_balances.c.user_id])
+
+    return stmt
+
+
+def init_balance(conn, user_id: str):
+    conn.execute(init_balance_stmt(conn.dialect.name, user_id))
 
 
-def load_df_submissions(user_id: str) -> DataFrame:
+def debit_balance_stmt(user_id: str, cost: float):
+    # atomic check-and-debit: the row is only updated if the balance covers the cost (already rounded to cents)
+    cost = sqlalchemy.cast(cost, Numeric(10, 2))
+    stmt = tb_balances.update(). \
+        where(tb_balances.c.user_id == user_id,
+              tb_balances.c.balance >= cost). \
+        values(balance=tb_balances.c.balance - cost). \
+        returning(tb_balances.c.balance)
+
+    return stmt
+
+
+def debit_balance(conn, user_id: str, cost: float):
+    stmt = debit_balance_stmt(user_id, cost)
+
+    balance = conn.execute(stmt).scalar()
+    if balance is None:
+        # no row yet (competitor from before the ledger): create it and try once more
+        init_balance(conn, user_id)
+        balance = conn.execute(stmt).scalar()
+        if balance is None:
+            raise InsufficientBalance(user_id)
+
+    return balance
+
+
+def submissions_query(user_id: str, limit: int = None):
     # create a select statement from the tb_submissions
     sql = select(tb_submissions). \
         where(tb_submissions.c.user_id == user_id). \
-        order_by(tb_submissions.c.datetime_submission.desc())
+        order_by(tb_submissions.c.datetime_submission.desc()). \
+        limit(limit)
 
     # print(sql.compile(compile_kwargs={"literal_binds": True}))
 
-    df = pd.read_sql_query(sql=sql, con=engine)
+    return sql
+
+
+def load_submissions(user_id: str, limit: int = None) -> list:
+    # the competitor's submissions, latest first, as rows (attribute access by column name)
+    with engine.connect() as conn:
+        results = conn.execute(submissions_query(user_id, limit)).fetchall()
+
+    return results
+
+
+def load_df_submissions(user_id: str) -> 'DataFrame':
+    import pandas as pd
+
+    df = pd.read_sql_query(sql=submissions_query(user_id), con=engine)
     # print(df)
 
     return df
 
 
-def load_df_costs(gpu_model: str = '') -> DataFrame:
+def costs_query(gpu_model: str = ''):
     if gpu_model:
         where = tb_costs.c.gpu_model == gpu_model
     else:
@@ -309,13 +518,76 @@ def load_df_costs(gpu_model: str = '') -> DataFrame:
 
     # print(sql.compile(compile_kwargs={"literal_binds": True}))
 
-    df = pd.read_sql_query(sql=sql, con=engine)
+    return sql
+
+
+def load_costs(gpu_model: str = '') -> list:
+    table = get_costs_table()
+
+    if table is None:
+        # the table could not be loaded; query it directly
+        with engine.connect() as conn:
+            return conn.execute(costs_query(gpu_model)).fetchall()
+
+    if gpu_model:
+        return [row for row in table if row.gpu_model == gpu_model]
+    return table
+
+
+def load_costs_table() -> bool:
+    global costs_table
+
+    try:
+        with engine.connect() as conn:
+            results = conn.execute(costs_query()).fetchall()
+    except Exception as e:
+        print(f'Error loading the costs table: {e}')
+        return False
+
+    # under the lock, so concurrent reloads swap the table and what is derived from it in the same order
+    with _costs_lock:
+        costs_table = results
+
+        for listener in costs_listeners:
+            try:
+                listener(results)
+            except Exception as e:
+                print(f'Error rebuilding from the costs table: {e}')
+
+    return True
+
+
+def _refresh_costs_loop():
+    while True:
+        time.sleep(COSTS_REFRESH_SECS)
+        load_costs_table()
+
+
+def get_costs_table():
+    global _costs_refresher
+
+    if costs_table is None:
+        load_costs_table()
+
+    # start the periodic refresh on first use
+    with _costs_lock:
+        if _costs_refresher is None and COSTS_REFRESH_SECS > 0:
+            _costs_refresher = threading.Thread(target=_refresh_costs_loop, name='costs-refresh', daemon=True)
+            _costs_refresher.start()
+
+    return costs_table
+
+
+def load_df_costs(gpu_model: str = '') -> 'DataFrame':
+    import pandas as pd
+
+    df = pd.read_sql_query(sql=costs_query(gpu_model), con=engine)
     # print(df)
 
     return df
 
 
-def load_df_finished_trainings(user_id: str = None) -> DataFrame:
+def finished_trainings_query(user_id: str = None):
     # optional user_id
     if user_id:
         where_user = tb_submissions.c.user_id == user_id
@@ -360,35 +632,108 @@ def load_df_finished_trainings(user_id: str = None) -> DataFrame:
 
     # print(sql.compile(compile_kwargs={"literal_binds": True}))
 
-    df = pd.read_sql_query(sql=sql, con=engine)
+    return sql
+
+
+def load_pending_notifications() -> list:
+    # submissions still training and not notified, with the time their results are due
+    sql = select(tb_submissions.c.id,
+                 tb_submissions.c.user_id,
+                 tb_submissions.c.datetime_results_available). \
+        where(tb_submissions.c.training_status == db_schema.TRAINING_STATUS_TRAINING,
+              tb_submissions.c.telegram_sent == None)
+
+    with engine.connect() as conn:
+        results = conn.execute(sql).fetchall()
+
+    return results
+
+
+def load_df_finished_trainings(user_id: str = None) -> 'DataFrame':
+    import pandas as pd
+
+    df = pd.read_sql_query(sql=finished_trainings_query(user_id), con=engine)
     # print(df)
 
     return df
 
 
-def mark_submissions_notified(list_competitors_notified: list):
-    # create a select statement from the tb_submissions
+def claim_finished_trainings_stmt(user_id: str = None, user_ids: list = None):
+    # moves the due submissions to Notified and returns them. Rows being claimed by another transaction are
+    # skipped, not waited for
+    if user_id:
+        where_user = tb_submissions.c.user_id == user_id
+    elif user_ids is not None:
+        where_user = tb_submissions.c.user_id.in_(user_ids)
+    else:
+        where_user = True
+
+    due = select(tb_submissions.c.id). \
+        where(tb_submissions.c.training_status == db_schema.TRAINING_STATUS_TRAINING,
+              tb_submissions.c.telegram_sent == None,
+              where_user,
+              tb_submissions.c.datetime_results_available <= datetime.datetime.now()). \
+        with_for_update(skip_locked=True)
+
     stmt = tb_submissions.update(). \
-        where(tb_submissions.c.user_id.in_(list_competitors_notified),
+        where(tb_submissions.c.id.in_(due.scalar_subquery()),
               tb_submissions.c.training_status == db_schema.TRAINING_STATUS_TRAINING). \
         values(training_status=db_schema.TRAINING_STATUS_NOTIFIED,
-               telegram_sent=datetime.datetime.now())
+               telegram_sent=datetime.datetime.now()). \
+        returning(tb_submissions.c.id,
+                  tb_submissions.c.user_id,
+                  tb_submissions.c.chat_id,
+                  tb_submissions.c.epochs,
+                  tb_submissions.c.learning_rate,
+                  tb_submissions.c.batch_norm,
+                  tb_submissions.c.filters,
+                  tb_submissions.c.dropout,
+                  tb_submissions.c.image_size,
+                  tb_submissions.c.batch_size,
+                  tb_submissions.c.gpu_model,
+                  tb_submissions.c.cost,
+                  tb_submissions.c.metrics_train_set,
+                  tb_submissions.c.metrics_val_set,
+                  tb_submissions.c.metrics_test_set,
+                  tb_submissions.c.datetime_submission)
+
+    return stmt
+
+
+def claim_finished_trainings(user_id: str = None, user_ids: list = None) -> list:
+    # atomically claims the due submissions, so each one is claimed by exactly one of the workers sweeping at the
+    # same time. Errors are raised: an empty list means nothing was due, and the notifier retries on errors
+    stmt = claim_finished_trainings_stmt(user_id, user_ids)
 
-    try:
-        # execute the insert statement within a transaction and commit it
-        with engine.connect() as conn:
-            conn.execute(stmt)
-            conn.commit()
-            return True
+    with engine.connect() as conn:
+        results = conn.execute(stmt).fetchall()
+        conn.commit()
 
-    except Exception as e:
-        # handle all other exceptions by printing the error message and returning None
-        print(e)
+    # latest first, like load_df_finished_trainings
+    return sorted(results, key=lambda row: row.datetime_submission or datetime.datetime.min, reverse=True)
 
-        return False
 
+def load_balances(user_ids) -> dict:
+    # balances of several competitors in one query, by user_id
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+
+    sql = select(tb_balances.c.user_id, tb_balances.c.balance). \
+        where(tb_balances.c.user_id.in_(user_ids))
+
+    with engine.connect() as conn:
+        balances = {row.user_id: round(float(row.balance), 2) for row in conn.execute(sql)}
+
+    # competitors from before the ledger get their row created on the way
+    for user_id in user_ids:
+        if user_id not in balances:
+            balances[user_id] = return_balance_per_user(user_id)
+
+    return balances
 
-def get_leaderboard_df(user_id: str = None) -> DataFrame:
+
+def leaderboard_query(user_id: str = None):
     if user_id:
         where_user = tb_submissions.c.user_id == user_id
     else:
@@ -412,7 +757,40 @@ def get_leaderboard_df(user_id: str = None) -> DataFrame:
 
     # print(sql.compile(compile_kwargs={"literal_binds": True}))
 
-    df = pd.read_sql_query(sql=sql, con=engine)
+    return sql
+
+
+def notified_ids_query(user_id: str = None):
+    # ids of the submissions the leaderboard counts
+    if user_id:
+        where_user = tb_submissions.c.user_id == user_id
+    else:
+        where_user = True
+
+    sql = select(tb_submissions.c.id). \
+        where(tb_submissions.c.training_status == db_schema.TRAINING_STATUS_NOTIFIED,
+              where_user)
+
+    return sql
+
+
+def get_leaderboard_snapshot(user_id: str = None) -> tuple:
+    # leaderboard rows and the ids of the submissions they count, read in one transaction. On PostgreSQL it is
+    # REPEATABLE READ, so both queries see the same committed submissions
+    options = {'isolation_level': 'REPEATABLE READ'} if engine.dialect.name == 'postgresql' else {}
+
+    with engine.connect().execution_options(**options) as conn:
+        with conn.begin():
+            rows = conn.execute(leaderboard_query(user_id)).fetchall()
+            ids = set(conn.scalars(notified_ids_query(user_id)))
+
+    return rows, ids
+
+
+def get_leaderboard_df(user_id: str = None) -> 'DataFrame':
+    import pandas as pd
+
+    df = pd.read_sql_query(sql=leaderboard_query(user_id), con=engine)
 
     return df
 
@@ -424,33 +802,26 @@ def gpu_buttons() -> list:
 
     # print(sql.compile(compile_kwargs={"literal_binds": True}))
 
-    df = pd.read_sql_query(sql=sql, con=engine)
-    # print(df)
+    with engine.connect() as conn:
+        results = conn.execute(sql).fetchall()
 
-    return df.to_list()
+    return results
 
 
 def return_balance_per_user(user_id: str = '') -> float:
-    sql = select(func.sum(tb_submissions.c.cost).label('sum_cost')). \
-        where(tb_submissions.c.user_id == user_id)
-    df = pd.read_sql_query(sql=sql, con=engine)
-
-    if len(df):
-        expenses = df.iloc[0][0]
-        if expenses is None:
-            expenses = 0
-    else:
-        expenses = 0
+    sql = select(tb_balances.c.balance). \
+        where(tb_balances.c.user_id == user_id)
 
-    sql = select(tb_competitors.c.initial_balance). \
-        where(tb_competitors.c.user_id == user_id)
-    df = pd.read_sql_query(sql=sql, con=engine)
+    with engine.connect() as conn:
+        balance = conn.execute(sql).scalar()
 
-    if len(df):
-        initial_balance = df.iloc[0][0]
-    else:
-        initial_balance = 0
+        if balance is None:
+            # first read for a competitor from before the ledger
+            init_balance(conn, user_id)
+            conn.commit()
+            balance = conn.execute(sql).scalar()
 
-    balance = initial_balance - expenses
+    if balance is None:
+        balance = 0
 
-    return round(balance, 2)
+    return round(float(balance), 2)
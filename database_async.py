@@ -0,0 +1,125 @@
+import asyncio
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import database as db
+import db_schema
+from db_schema import tb_competitors, tb_balances
+
+# async mirror of the database.py functions awaited by the inline webhook, on SQLAlchemy asyncio and asyncpg. The
+# statements are the ones database.py builds, so both layers run the same SQL. Its pool (DB_ASYNC_POOL_SIZE,
+# DB_ASYNC_MAX_OVERFLOW) is taken out of the budget of the sync one, see db_schema.sync_pool_budget
+
+# competitors known to be registered: registration costs a round trip per competitor and process, not per update
+_registered = set()
+
+
+def async_url(url: str):
+    # asyncpg URL of a PostgreSQL DATABASE_URL; None for other databases
+    if not db_schema.is_postgresql(url):
+        return None
+    return 'postgresql+asyncpg://' + url.partition('://')[2]
+
+
+def create_shared_async_engine(url: str = db_schema.DATABASE_URL):
+    url = async_url(url)
+    if url is None:
+        return None
+
+    return create_async_engine(url,
+                               pool_size=db_schema.DB_ASYNC_POOL_SIZE,
+                               max_overflow=db_schema.DB_ASYNC_MAX_OVERFLOW,
+                               pool_timeout=db_schema.DB_POOL_TIMEOUT,
+                               pool_recycle=db_schema.DB_POOL_RECYCLE,
+                               pool_pre_ping=db_schema.DB_POOL_PRE_PING)
+
+
+# without PostgreSQL (local runs on sqlite) there is no async engine, and every function runs its database.py
+# counterpart in a thread instead
+engine = create_shared_async_engine()
+
+
+async def register_competitor(dict_msg: dict) -> bool:
+    # inserts the competitor (and their opening balance) unless they exist. Returns True if they were new
+    user_id = dict_msg.get('user_id', '')
+    if user_id in _registered:
+        return False
+
+    if engine is None:
+        inserted = await asyncio.to_thread(db.register_competitor, dict_msg)
+        _registered.add(user_id)
+        return inserted
+
+    initial_balance = dict_msg.get('initial_balance', db.INITIAL_BALANCE)
+
+    stmt = db.dialect_insert('postgresql')(tb_competitors). \
+        values(user_id=user_id,
+               username=dict_msg.get('username', ''),
+               fullname=dict_msg.get('fullname', ''),
+               initial_balance=initial_balance). \
+        on_conflict_do_nothing(index_elements=[tb_competitors.c.user_id]). \
+        returning(tb_competitors.c.user_id)
+
+    async with engine.begin() as conn:
+        inserted = (await conn.execute(stmt)).scalar()
+        if inserted is not None:
+            await conn.execute(insert(tb_balances).values(user_id=user_id, balance=initial_balance))
+
+    _registered.add(user_id)
+    return inserted is not None
+
+
+async def return_balance_per_user(user_id: str = '') -> float:
+    if engine is None:
+        return await asyncio.to_thread(db.return_balance_per_user, user_id)
+
+    sql = select(tb_balances.c.balance).where(tb_balances.c.user_id == user_id)
+
+    async with engine.connect() as conn:
+        balance = (await conn.execute(sql)).scalar()
+
+        if balance is None:
+            # first read for a competitor from before the ledger
+            await conn.execute(db.init_balance_stmt('postgresql', user_id))
+            await conn.commit()
+            balance = (await conn.execute(sql)).scalar()
+
+    if balance is None:
+        balance = 0
+
+    return round(float(balance), 2)
+
+
+async def make_submission(dict_user_hp: dict, user_id: str, chat_id: str, gpu_model: str, cost: float,
+                          estimated_time: float):
+    if engine is None:
+        return await asyncio.to_thread(db.make_submission, dict_user_hp, user_id, chat_id, gpu_model, cost,
+                                       estimated_time)
+
+    # the ledger holds cents: the submission records exactly what is debited
+    cost = round(float(cost), 2)
+    stmt, datetime_results_available = db.submission_stmt(dict_user_hp, user_id, chat_id, gpu_model, cost,
+                                                          estimated_time)
+    debit = db.debit_balance_stmt(user_id, cost)
+
+    try:
+        # same transaction as database.make_submission: debit, then insert
+        async with engine.begin() as conn:
+            if (await conn.execute(debit)).scalar() is None:
+                await conn.execute(db.init_balance_stmt('postgresql', user_id))
+                if (await conn.execute(debit)).scalar() is None:
+                    raise db.InsufficientBalance(user_id)
+            await conn.execute(stmt)
+
+        return datetime_results_available
+    except db.InsufficientBalance:
+        raise
+    except Exception as e:
+        print(f'Error making submission: {e}')
+        return 0
+
+
+async def close():
+    if engine is not None:
+        await engine.dispose()
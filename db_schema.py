@@ -1,8 +1,14 @@
 import os
+import threading
+import time
 
-from sqlalchemy import DateTime as TimeStamp, SmallInteger as smallint, Text as text, REAL as real, BOOLEAN as boolean, Numeric
-from sqlalchemy import Table, Column
+from sqlalchemy import DateTime as TimeStamp, SmallInteger as smallint, BigInteger as bigint, Text as text, REAL as real, BOOLEAN as boolean, Numeric
+from sqlalchemy import Table, Column, Index, Computed
 from sqlalchemy import create_engine, MetaData, ForeignKey
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+import migrations
 
 # get the database URL from an environment variable or use a default value
 # The URI should start with postgresql:// instead of postgres://. SQLAlchemy used to accept both, but has removed support for the postgres name.
@@ -29,8 +35,87 @@ TRAINING_STATUS_CANCELLED = 'Cancelled'
 TRAINING_STATUS_NOTIFIED = 'Notified'
 TRAINING_STATUS_COMPLETE = 'Complete'
 
-# create a SQLAlchemy engine object using the DATABASE_URL
-engine = create_engine(DATABASE_URL)
+# connection pool of the engine shared by the whole process (database, sessions, scheduler jobstore). A process
+# opens at most DB_POOL_SIZE + DB_MAX_OVERFLOW connections, which has to fit the plan's connection limit once
+# multiplied by the number of processes
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# on PostgreSQL the webhook awaits its queries (registration, balance, submission) on an asyncio pool of its own
+# (database_async.py). That pool is carved out of the budget above, not added to it: by default it gets half of it,
+# and the sync pool of the worker threads, the notifier and the scheduler the other half
+DB_ASYNC_POOL_SIZE = int(os.environ.get('DB_ASYNC_POOL_SIZE', DB_POOL_SIZE // 2))
+DB_ASYNC_MAX_OVERFLOW = int(os.environ.get('DB_ASYNC_MAX_OVERFLOW', DB_MAX_OVERFLOW // 2))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection and how many connections are in use."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.max_checked_out = 0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+
+        wait = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.max_checked_out = max(self.max_checked_out, self.checkedout())
+
+        return connection
+
+    def stats(self) -> dict:
+        return {'size': self.size(),
+                'max_overflow': self._max_overflow,
+                'checked_out': self.checkedout(),
+                'max_checked_out': self.max_checked_out,
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_ms_avg': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+                'wait_ms_max': round(self.wait_max * 1000, 3)}
+
+
+def is_postgresql(url: str) -> bool:
+    return url.partition('://')[0].split('+')[0] == 'postgresql'
+
+
+def sync_pool_budget(url: str = DATABASE_URL) -> tuple:
+    # (pool_size, max_overflow) of the sync engine: what the async pool leaves of the budget
+    if not is_postgresql(url):
+        return DB_POOL_SIZE, DB_MAX_OVERFLOW
+    return max(DB_POOL_SIZE - DB_ASYNC_POOL_SIZE, 1), max(DB_MAX_OVERFLOW - DB_ASYNC_MAX_OVERFLOW, 0)
+
+
+def create_shared_engine(url: str = DATABASE_URL):
+    pool_size, max_overflow = sync_pool_budget(url)
+    return create_engine(url,
+                         poolclass=InstrumentedQueuePool,
+                         pool_size=pool_size,
+                         max_overflow=max_overflow,
+                         pool_timeout=DB_POOL_TIMEOUT,
+                         pool_recycle=DB_POOL_RECYCLE,
+                         pool_pre_ping=DB_POOL_PRE_PING)
+
+
+# create the SQLAlchemy engine object using the DATABASE_URL; every module uses this one
+engine = create_shared_engine()
 
 # create a SQLAlchemy metadata object
 metadata_obj = MetaData()
@@ -65,6 +150,10 @@ tb_pretrained = Table("pretrained_results", metadata_obj,
                       Column("loss_fig_url", text),
                       Column("metrics_fig_url", text),
                       Column("sample_figs_urls", text),
+                      # dropout rounded to 2 decimals (REAL 0.2 is 0.200000003), so configurations can be matched
+                      # by equality and through an index
+                      Column("dropout_norm", Numeric(4, 2), Computed("round(CAST(dropout AS numeric), 2)",
+                                                                     persisted=True)),
                       )
 
 # create a SQLAlchemy Table object for the submissions table with columns for various model training parameters
@@ -97,6 +186,19 @@ tb_submissions = Table("submissions", metadata_obj,
                        Column("training_status", text),
                        )
 
+# indexes of the hot queries. Existing databases get them from migrations.py, which uses the same names
+Index("ix_pretrained_results_config", tb_pretrained.c.batch_size, tb_pretrained.c.epochs,
+      tb_pretrained.c.learning_rate, tb_pretrained.c.batch_norm, tb_pretrained.c.filters,
+      tb_pretrained.c.dropout_norm, tb_pretrained.c.image_size)
+# submissions of a competitor, latest first (status, leaderboard of one user)
+Index("ix_submissions_user_id_datetime", tb_submissions.c.user_id, tb_submissions.c.datetime_submission.desc())
+# trainings waiting for their results to be notified: a small partial index, as most rows are Notified
+Index("ix_submissions_pending", tb_submissions.c.datetime_results_available,
+      postgresql_where=(tb_submissions.c.training_status == TRAINING_STATUS_TRAINING) &
+                       (tb_submissions.c.telegram_sent == None),
+      sqlite_where=(tb_submissions.c.training_status == TRAINING_STATUS_TRAINING) &
+                   (tb_submissions.c.telegram_sent == None))
+
 
 # create a SQLAlchemy Table object for the competitors table with columns for the username and fullname
 tb_costs = Table("training_costs", metadata_obj,
@@ -107,5 +209,27 @@ tb_costs = Table("training_costs", metadata_obj,
                        Column("cuda_cores", smallint)
                        )
 
-# creates the tables in case they don't exist
+# create a SQLAlchemy Table object for the running balance of each competitor (initial balance minus every submission
+# cost), debited in the same transaction that inserts the submission
+tb_balances = Table("balances", metadata_obj,
+                    Column("user_id", text, ForeignKey("competitors.user_id"), primary_key=True),
+                    Column("balance", Numeric(10, 2), nullable=False),
+                    )
+
+# create a SQLAlchemy Table object for the wizard state of each user (hyperparameters selected so far), as JSON
+tb_sessions = Table("sessions", metadata_obj,
+                    Column("user_id", text, primary_key=True),
+                    Column("data", text),
+                    Column("updated", TimeStamp),
+                    )
+
+# create a SQLAlchemy Table object for the Telegram updates already processed, shared by the workers to drop
+# redeliveries (see dedup.py)
+tb_updates = Table("processed_updates", metadata_obj,
+                   Column("update_id", bigint, primary_key=True),
+                   Column("received", TimeStamp, nullable=False),
+                   )
+
+# creates the tables in case they don't exist, then brings existing ones up to the current schema version
 metadata_obj.create_all(engine)
+migrations.migrate(engine)
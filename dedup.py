@@ -0,0 +1,152 @@
+import collections
+import datetime
+import os
+import threading
+import time
+
+from sqlalchemy import delete
+from starlette.concurrency import run_in_threadpool
+
+import db_schema
+from db_schema import tb_updates
+
+# Telegram redelivers an update until the webhook answers it; ids seen within the window are acknowledged and dropped
+DEDUP_WINDOW_SECS = float(os.environ.get('DEDUP_WINDOW_SECS', 60 * 60))
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 100000))
+# optional store shared by every worker and dyno ('postgres'); by default each process only knows its own updates
+DEDUP_BACKEND = os.environ.get('DEDUP_BACKEND', '')
+# the shared table is pruned of expired ids every this many claims
+DEDUP_PRUNE_EVERY = int(os.environ.get('DEDUP_PRUNE_EVERY', 1000))
+
+
+class SQLUpdateStore:
+    # processed_updates table in the main database: the primary key makes the first insert of an id win
+
+    def __init__(self, engine=None, window: float = DEDUP_WINDOW_SECS, prune_every: int = DEDUP_PRUNE_EVERY):
+        self.engine = engine if engine is not None else db_schema.engine
+        self.window = window
+        self.prune_every = prune_every
+        self._claims = 0
+
+        if self.engine.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        self._insert = insert
+
+    def claim(self, update_id: int) -> bool:
+        stmt = self._insert(tb_updates).values(update_id=update_id, received=datetime.datetime.now()). \
+            on_conflict_do_nothing(index_elements=[tb_updates.c.update_id]). \
+            returning(tb_updates.c.update_id)
+
+        with self.engine.connect() as conn:
+            inserted = conn.execute(stmt).scalar()
+            conn.commit()
+
+        self._claims += 1
+        if self._claims % self.prune_every == 0:
+            self.prune()
+
+        return inserted is not None
+
+    def release(self, update_id: int):
+        with self.engine.connect() as conn:
+            conn.execute(delete(tb_updates).where(tb_updates.c.update_id == update_id))
+            conn.commit()
+
+    def prune(self):
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.window)
+        with self.engine.connect() as conn:
+            conn.execute(delete(tb_updates).where(tb_updates.c.received < cutoff))
+            conn.commit()
+
+
+class UpdateDeduplicator:
+    """
+    Bounded, time-windowed set of the Telegram update ids already accepted.
+
+    claim() returns True the first time an id is seen and False for its redeliveries. Ids are kept in arrival
+    order, so expired and excess ones are dropped from the front. With a backend, ids new to this process are also
+    claimed there, so a redelivery that lands on another worker is dropped as well.
+    """
+
+    def __init__(self, backend: SQLUpdateStore = None, window: float = DEDUP_WINDOW_SECS,
+                 max_entries: int = DEDUP_MAX_ENTRIES):
+        self.backend = backend
+        self.window = window
+        self.max_entries = max_entries
+
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def claim_local(self, update_id: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if len(self._seen) < self.max_entries and now - seen_at <= self.window:
+                    break
+                del self._seen[oldest_id]
+
+            if update_id in self._seen:
+                self.counters['duplicates'] += 1
+                return False
+
+            self._seen[update_id] = now
+            return True
+
+    def claim(self, update_id: int) -> bool:
+        if not self.claim_local(update_id):
+            return False
+
+        if self.backend is not None:
+            try:
+                if not self.backend.claim(update_id):
+                    with self._lock:
+                        self.counters['duplicates'] += 1
+                    return False
+            except Exception as e:
+                # better to process an update twice than to lose it
+                print(f'Error claiming update {update_id}: {e}')
+
+        with self._lock:
+            self.counters['accepted'] += 1
+        return True
+
+    async def claim_async(self, update_id: int) -> bool:
+        # the in-memory check runs on the loop; only the shared store needs a thread
+        if self.backend is None:
+            return self.claim(update_id)
+        return await run_in_threadpool(self.claim, update_id)
+
+    def release(self, update_id: int):
+        # forget an update that could not be processed, so that its redelivery is processed
+        with self._lock:
+            self._seen.pop(update_id, None)
+            self.counters['released'] += 1
+
+        if self.backend is not None:
+            try:
+                self.backend.release(update_id)
+            except Exception as e:
+                print(f'Error releasing update {update_id}: {e}')
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._seen)
+        return {'size': size, 'max_entries': self.max_entries, 'window_secs': self.window,
+                'shared': self.backend is not None, **self.counters}
+
+
+def create_deduplicator(backend: str = DEDUP_BACKEND) -> UpdateDeduplicator:
+    if backend == 'postgres':
+        return UpdateDeduplicator(SQLUpdateStore())
+    if backend == '':
+        return UpdateDeduplicator()
+
+    raise ValueError(f'Unknown dedup backend: {backend}')
+
+
+# the deduplicator of the webhook
+deduplicator = create_deduplicator()
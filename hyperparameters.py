@@ -14,3 +14,12 @@ filters = ['filters|8', 'filters|32']
 dropout = ['dropout|None', 'dropout|0.2']
 
 image_size = ['image_size|64', 'image_size|128', 'image_size|256']
+
+
+# Every combination of the options above, as the values the wizard stores ({'batch_size': '2', 'epochs': '5', ...})
+def grid():
+    import itertools
+
+    options = [batch_sizes, epochs, learning_rates, batch_norm, filters, dropout, image_size]
+    for combination in itertools.product(*options):
+        yield dict(option.split(sep) for option in combination)
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import io
+import os
+import posixpath
+import sys
+import threading
+import urllib.parse
+
+import db_schema
+import hyperparameters as hp
+import image_lib
+from image_lib import download_image, rotate_image
+
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', '.image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# set to 1 to fill the cache for the whole hyperparameter grid when the app starts
+IMAGE_CACHE_PREWARM = os.environ.get('IMAGE_CACHE_PREWARM', '0') == '1'
+IMAGE_CACHE_PREWARM_CONCURRENCY = int(os.environ.get('IMAGE_CACHE_PREWARM_CONCURRENCY', 8))
+# the rotated image of a URL never changes, so clients may keep it for long
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 7 * 24 * 60 * 60))
+
+
+class ImageCache:
+    """
+    Bounded on-disk cache of transformed images, addressed by a hash of the source URL (and output variant).
+
+    Entries are written atomically. Hits refresh the file mtime and eviction removes the least recently used
+    files once the directory grows over max_bytes.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    @staticmethod
+    def key(url: str, variant: str = 'png') -> str:
+        return hashlib.sha256(f'{variant}:{url}'.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key: str):
+        # path of a cached entry, or None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        path = self.path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+
+        with self._lock:
+            # an overwritten entry (two workers missing on the same key) no longer counts
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, path)
+
+            self.total_bytes += len(data) - replaced
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+        return path
+
+    def _evict(self):
+        # drop least recently used files until the cache is back to 90% of its budget
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self.total_bytes = total
+
+    async def get_or_create(self, key: str, create) -> str:
+        # returns the path of the entry, building it with `await create()` on a miss.
+        # concurrent misses of the same key share one build
+        path = self.lookup(key)
+        if path is not None:
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._create(key, create))
+        return await asyncio.shield(task)
+
+    async def _create(self, key, create):
+        try:
+            data = await create()
+            return await asyncio.get_running_loop().run_in_executor(None, self.put, key, data)
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {'bytes': self.total_bytes, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+# the cache of this process
+cache = ImageCache()
+
+
+def is_bucket_url(url: str) -> bool:
+    # /rotate_image only serves the result figures of the bucket, so it can't be used to fetch and cache any URL
+    parts = urllib.parse.urlsplit(url)
+    bucket = urllib.parse.urlsplit(db_schema.BUCKET_URL)
+    path = posixpath.normpath(urllib.parse.unquote(parts.path))
+
+    return (parts.scheme, parts.netloc) == (bucket.scheme, bucket.netloc) and path.startswith(bucket.path)
+
+
+async def rotated_image_path(image_url: str, image_format: str = 'png') -> str:
+    # path of the rotated version of the image, downloading and rotating it on a miss
+    async def create():
+        image_bytes = await download_image(image_url)
+        rotated_image_bytes = await rotate_image(io.BytesIO(image_bytes), image_format)
+        return rotated_image_bytes.getvalue()
+
+    return await cache.get_or_create(cache.key(image_url, image_format), create)
+
+
+def sample_urls() -> list:
+    # sample image of every configuration of the hyperparameter grid, as sent by notify_finished_trainings
+    urls = []
+    for config in hp.grid():
+        dice, jacloss, sample = db_schema.imgs_url(0,
+                                                   int(config['epochs']),
+                                                   float(config['learning_rate']),
+                                                   config['batch_norm'] == 'True',
+                                                   int(config['filters']),
+                                                   0.0 if config['dropout'] == 'None' else float(config['dropout']),
+                                                   int(config['image_size']),
+                                                   int(config['batch_size']))
+        urls.append(sample)
+    return urls
+
+
+async def prewarm(concurrency: int = IMAGE_CACHE_PREWARM_CONCURRENCY) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def warm(url):
+        nonlocal failed
+        async with semaphore:
+            try:
+                await rotated_image_path(url)
+            except Exception as e:
+                failed += 1
+                print(f'Error prewarming {url}: {e!r}')
+
+    urls = sample_urls()
+    await asyncio.gather(*(warm(url) for url in urls))
+    print(f'Image cache prewarmed: {len(urls) - failed} of {len(urls)} images, {cache.total_bytes} bytes')
+
+    return len(urls) - failed
+
+
+async def prewarm_command():
+    try:
+        await prewarm()
+    finally:
+        await image_lib.close_session()
+        image_lib.shutdown_executor()
+
+
+if __name__ == "__main__":
+    # python image_cache.py prewarm
+    if sys.argv[1:] == ['prewarm']:
+        asyncio.run(prewarm_command())
+    else:
+        print('usage: python image_cache.py prewarm')
@@ -1,22 +1,135 @@
+import asyncio
+import concurrent.futures
 import io
+import multiprocessing
+import os
 
 import aiohttp
 from PIL import Image
 from fastapi import HTTPException
+from yarl import URL
 
+# shared download session settings
+IMAGE_POOL_LIMIT = int(os.environ.get('IMAGE_POOL_LIMIT', 50))
+IMAGE_PER_HOST_CONCURRENCY = int(os.environ.get('IMAGE_PER_HOST_CONCURRENCY', 16))
+IMAGE_CONNECT_TIMEOUT = float(os.environ.get('IMAGE_CONNECT_TIMEOUT', 5))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.environ.get('IMAGE_DOWNLOAD_TIMEOUT', 20))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_CHUNK_BYTES = 64 * 1024
 
-async def download_image(url: str):
-    async with aiohttp.ClientSession() as session:
+# image transforms run off the event loop, in a 'process' or 'thread' pool
+IMAGE_POOL = os.environ.get('IMAGE_POOL', 'process')
+IMAGE_POOL_WORKERS = int(os.environ.get('IMAGE_POOL_WORKERS', min(4, os.cpu_count() or 1)))
+
+# output formats, by the name used in the cache key
+IMAGE_MEDIA_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+# one session (and connection pool) per process, opened and closed in the app lifespan
+_session = None
+_session_loop = None
+_host_semaphores = {}
+_executor = None
+
+
+async def open_session() -> aiohttp.ClientSession:
+    global _session, _session_loop
+
+    connector = aiohttp.TCPConnector(limit=IMAGE_POOL_LIMIT, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=IMAGE_DOWNLOAD_TIMEOUT, connect=IMAGE_CONNECT_TIMEOUT)
+    _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    _session_loop = asyncio.get_running_loop()
+    _host_semaphores.clear()
+
+    return _session
+
+
+async def close_session():
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    # outside the app (e.g. the prewarm command) the session is opened on first use
+    if _session is None or _session.closed or _session_loop is not asyncio.get_running_loop():
+        await open_session()
+    return _session
+
+
+def host_semaphore(url: str) -> asyncio.Semaphore:
+    host = URL(url).host
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(IMAGE_PER_HOST_CONCURRENCY)
+    return semaphore
+
+
+async def download_image(url: str, max_bytes: int = IMAGE_MAX_BYTES) -> bytes:
+    session = await get_session()
+
+    async with host_semaphore(url):
         async with session.get(url) as response:
             if response.status != 200:
                 raise HTTPException(status_code=response.status, detail="Image not found")
-            return await response.read()
+            if response.content_length is not None and response.content_length > max_bytes:
+                raise HTTPException(status_code=413, detail="Image too large")
+
+            # stream the body, so an oversized image is rejected before it is fully in memory
+            chunks = []
+            size = 0
+            async for chunk in response.content.iter_chunked(IMAGE_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail="Image too large")
+                chunks.append(chunk)
+
+            return b''.join(chunks)
+
+
+def get_executor() -> concurrent.futures.Executor:
+    global _executor
+
+    if _executor is None:
+        if IMAGE_POOL == 'thread':
+            _executor = concurrent.futures.ThreadPoolExecutor(IMAGE_POOL_WORKERS, thread_name_prefix='image')
+        else:
+            # spawn instead of fork: the app process runs threads (Telegram client, workers) that must not be forked
+            _executor = concurrent.futures.ProcessPoolExecutor(IMAGE_POOL_WORKERS,
+                                                               mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
 
+def shutdown_executor():
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def negotiate_format(accept: str) -> str:
+    # WebP when the client says it takes it (browsers, Telegram's fetcher does not), PNG otherwise
+    if 'image/webp' in (accept or ''):
+        return 'webp'
+    return 'png'
+
+
+def transform_image(image_bytes: bytes, image_format: str = 'png') -> bytes:
+    # runs in the worker pool. A transpose is a lossless pixel copy, unlike rotate(), which resamples
+    image = Image.open(io.BytesIO(image_bytes))
+    rotated_image = image.transpose(Image.Transpose.ROTATE_270)
 
-async def rotate_image(image_bytes: io.BytesIO) -> io.BytesIO:
-    image = Image.open(image_bytes)
-    rotated_image = image.rotate(-90, expand=True)
     rotated_image_bytes = io.BytesIO()
-    rotated_image.save(rotated_image_bytes, format="PNG")
-    rotated_image_bytes.seek(0)
-    return rotated_image_bytes
+    if image_format == 'webp':
+        rotated_image.save(rotated_image_bytes, format="WEBP", lossless=True, exact=True)
+    else:
+        rotated_image.save(rotated_image_bytes, format="PNG", optimize=True)
+    return rotated_image_bytes.getvalue()
+
+
+async def rotate_image(image_bytes: io.BytesIO, image_format: str = 'png') -> io.BytesIO:
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(get_executor(), transform_image, image_bytes.getvalue(), image_format)
+    return io.BytesIO(data)
@@ -0,0 +1,367 @@
+import asyncio
+import collections
+import datetime
+import email.utils
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+import database as db
+
+# how often the in-process leaderboard is rebuilt from the database, to pick up results finalized by other workers
+LEADERBOARD_RESYNC_SECS = float(os.environ.get('LEADERBOARD_RESYNC_SECS', 300))
+
+# number of undelivered events kept per push client before the slowest ones are dropped
+LEADERBOARD_CLIENT_BACKLOG = int(os.environ.get('LEADERBOARD_CLIENT_BACKLOG', 16))
+
+# serialized /api/leaderboard response, valid until `expires` (next time-ago label change) or the next board update
+Payload = collections.namedtuple('Payload', ['version', 'body', 'gzipped', 'etag', 'last_modified', 'expires'])
+
+
+def label_expiry(timestamp: datetime.datetime, now: datetime.datetime) -> datetime.datetime:
+    # earliest moment the time-ago label of the timestamp (calculate_times_ago) can change. Month and year
+    # labels change on the same time of day as the timestamp, so checking once a day is enough for them
+    elapsed = now - timestamp
+    if elapsed < datetime.timedelta(minutes=1):
+        return timestamp + datetime.timedelta(minutes=1)
+    if elapsed < datetime.timedelta(hours=1):
+        return timestamp + datetime.timedelta(minutes=elapsed // datetime.timedelta(minutes=1) + 1)
+    if elapsed < datetime.timedelta(days=1):
+        return timestamp + datetime.timedelta(hours=elapsed // datetime.timedelta(hours=1) + 1)
+    return timestamp + datetime.timedelta(days=elapsed.days + 1)
+
+
+def format_float_column(values: list) -> list:
+    # 6 decimals, minus the trailing zeros all the values share (keeping one decimal)
+    texts = ['NaN' if value is None else f'{value:.6f}' for value in values]
+    numbers = [text for text in texts if text != 'NaN']
+    while numbers and all(text.endswith('0') and text[-2] != '.' for text in numbers):
+        texts = [text if text == 'NaN' else text[:-1] for text in texts]
+        numbers = [text[:-1] for text in numbers]
+    return texts
+
+
+def format_table(columns: list, rows: list) -> str:
+    # plain text table with the layout of DataFrame.to_string(index=False): right-aligned columns, one space apart,
+    # and a leading space in the header of numeric columns
+    cells = []
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows]
+        header = str(column)
+        if any(isinstance(value, float) for value in values):
+            header = ' ' + header
+            texts = format_float_column([None if value is None else float(value) for value in values])
+        elif values and all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            header = ' ' + header
+            texts = [str(value) for value in values]
+        else:
+            texts = [str(value) for value in values]
+        width = max([len(header)] + [len(text) for text in texts])
+        cells.append([header.rjust(width)] + [text.rjust(width) for text in texts])
+
+    return '\n'.join(' '.join(line) for line in zip(*cells))
+
+
+class Leaderboard:
+    """
+    In-process leaderboard: one entry per competitor with their best score, number of entries, last submission
+    and total spent, over the Notified submissions.
+
+    It is built once from the database and then updated with the submissions that claim_finished_trainings moves
+    to Notified. The ids of the counted submissions are kept, so a submission already in a reload is not counted
+    again when it is applied. Entries are replaced, never changed in place, so a ranking read without the lock is
+    consistent. Reads return the already ranked list.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._entries = {}
+        self._applied = set()
+        # rows applied while a reload is reading the database, None when no reload is running
+        self._applied_during_load = None
+        self._ranking = []
+        self._positions = {}
+        self._top_text = {}
+        self._payload = None
+        self._published = None
+        self._published_version = None
+        self.version = 0
+        self.loaded_at = None
+        self._resync = None
+
+    @staticmethod
+    def _entry(row) -> dict:
+        return {'user_id': row.user_id,
+                'fullname': row.fullname,
+                'initial_balance': float(row.initial_balance or 0),
+                'score': row.score,
+                'entries': int(row.entries),
+                'last_submission': row.last_submission,
+                'sum_costs': float(row.sum_costs or 0)}
+
+    def load(self) -> bool:
+        with self._load_lock:
+            with self._lock:
+                self._applied_during_load = []
+
+            try:
+                rows, ids = db.get_leaderboard_snapshot()
+            except Exception as e:
+                print(f'Error loading the leaderboard: {e}')
+                with self._lock:
+                    self._applied_during_load = None
+                return False
+
+            entries = {row.user_id: self._entry(row) for row in rows}
+            with self._lock:
+                applied, self._applied_during_load = self._applied_during_load, None
+                self._entries = entries
+                self._applied = ids
+                # submissions claimed after the snapshot was read, but applied before it was installed
+                for row in applied:
+                    if row.id not in ids and row.user_id in entries:
+                        self._add(row)
+                self._rerank()
+                self.loaded_at = time.time()
+                # the next push after a full reload sends the whole board
+                self._published = None
+
+        return True
+
+    def _rerank(self):
+        # the ranking is almost sorted after an update, which timsort handles in linear time
+        self._ranking = sorted(self._entries.values(), key=lambda entry: -(entry['score'] or 0))
+        self._positions = {entry['user_id']: position for position, entry in enumerate(self._ranking, start=1)}
+        self._top_text = {}
+        self.version += 1
+
+    def _add(self, row):
+        # called with the lock held: counts a submission in its competitor's entry
+        entry = dict(self._entries[row.user_id])
+        if row.metrics_test_set is not None and (entry['score'] is None or row.metrics_test_set > entry['score']):
+            entry['score'] = row.metrics_test_set
+        if row.datetime_submission is not None and (entry['last_submission'] is None or
+                                                    row.datetime_submission > entry['last_submission']):
+            entry['last_submission'] = row.datetime_submission
+        entry['entries'] += 1
+        entry['sum_costs'] += float(row.cost or 0)
+
+        self._entries[row.user_id] = entry
+        self._applied.add(row.id)
+        if self._applied_during_load is not None:
+            self._applied_during_load.append(row)
+
+    def apply(self, notified: list):
+        """
+        Updates the board with submissions moved to Notified (rows with id, user_id, metrics_test_set,
+        datetime_submission and cost). Submissions already counted are skipped.
+        """
+        if not notified:
+            return
+
+        new_users = set()
+        with self._lock:
+            for row in notified:
+                if row.id in self._applied:
+                    continue
+                if row.user_id not in self._entries:
+                    new_users.add(row.user_id)
+                    continue
+                self._add(row)
+
+        # competitors ranking for the first time: read their row (name and balance) from the database
+        for user_id in new_users:
+            rows, ids = db.get_leaderboard_snapshot(user_id)
+            with self._lock:
+                for row in rows:
+                    entry = self._entries.get(row.user_id)
+                    # a concurrent apply may have installed a later snapshot of the competitor already
+                    if entry is None or entry['entries'] < row.entries:
+                        self._entries[row.user_id] = self._entry(row)
+                self._applied |= ids
+
+        with self._lock:
+            self._rerank()
+
+        self._publish()
+
+    def _publish(self):
+        # push the rows that changed since the last push to the connected leaderboard pages
+        with self._lock:
+            version = self.version
+            ranking = self._ranking
+        records = self.records(ranking)
+
+        with self._publish_lock:
+            if self._published is not None and version <= self._published_version:
+                # a concurrent apply already pushed this version or a later one
+                return
+            previous, self._published, self._published_version = self._published, records, version
+
+            # under the lock, so the diffs reach the pages in the order they were computed
+            if previous is None:
+                broadcaster.publish('full', records)
+                return
+
+            changed = [{'i': i, 'row': row} for i, row in enumerate(records)
+                       if i >= len(previous) or previous[i] != row]
+            if changed or len(records) != len(previous):
+                broadcaster.publish('diff', {'length': len(records), 'changed': changed})
+
+    def rows(self) -> list:
+        if self.loaded_at is None:
+            self.start()
+
+        return self._ranking
+
+    def position(self, user_id: str):
+        # 1-based rank of the competitor, None if they are not ranked yet
+        if self.loaded_at is None:
+            self.start()
+
+        return self._positions.get(user_id)
+
+    def top_text(self, n: int = 3) -> str:
+        # rendered top n table for the Telegram reply, cached until the ranking or the time-ago labels change
+        from messages import calculate_time_ago
+
+        # three rows: the scalar form keeps numpy off the webhook path
+        ranking = self.rows()[:n]
+        labels = tuple(calculate_time_ago(entry['last_submission']) for entry in ranking)
+        key = (self.version, n, labels)
+
+        text = self._top_text.get(key)
+        if text is None:
+            text = format_table(['🏆', 'Team', '🎯', 'Entries', '🕰️ Last', 'Spent 💰'],
+                                [[position, entry['fullname'], entry['score'], entry['entries'], label,
+                                  entry['sum_costs']]
+                                 for position, (entry, label) in enumerate(zip(ranking, labels), start=1)])
+            self._top_text = {key: text}
+
+        return text
+
+    @staticmethod
+    def records(ranking: list) -> list:
+        # rows as shown on the leaderboard page
+        from messages import COIN, calculate_times_ago
+
+        labels = calculate_times_ago([entry['last_submission'] for entry in ranking])
+
+        return [{'#': position,
+                 'Team': entry['fullname'],
+                 'Score': entry['score'],
+                 'Entries': entry['entries'],
+                 'Last': label,
+                 f'Spent {COIN}': entry['sum_costs']}
+                for position, (entry, label) in enumerate(zip(ranking, labels), start=1)]
+
+    def api_payload(self) -> Payload:
+        # pre-serialized (and pre-gzipped) /api/leaderboard body, rebuilt only when the board or a label changes
+        now = datetime.datetime.now()
+        payload = self._payload
+        self.rows()
+        # read the version before the ranking: a concurrent update then only causes an extra rebuild
+        version = self.version
+        ranking = self._ranking
+
+        if payload is None or payload.version != version or now >= payload.expires:
+            records = self.records(ranking)
+
+            # same encoding as starlette's JSONResponse
+            body = json.dumps(records, ensure_ascii=False, allow_nan=False, indent=None,
+                              separators=(",", ":")).encode("utf-8")
+
+            expires = min((label_expiry(entry['last_submission'], now) for entry in ranking
+                           if entry['last_submission'] is not None), default=datetime.datetime.max)
+            etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+            if payload is not None and payload.etag == etag:
+                last_modified = payload.last_modified
+            else:
+                last_modified = email.utils.formatdate(time.time(), usegmt=True)
+
+            payload = Payload(version, body, gzip.compress(body), etag, last_modified, expires)
+            self._payload = payload
+
+        return payload
+
+    def start(self):
+        # loads the board and keeps it in sync with results finalized by other processes
+        with self._lock:
+            if self._resync is not None:
+                return
+            self._resync = threading.Thread(target=self._resync_loop, name='leaderboard-resync', daemon=True)
+
+        self.load()
+        if LEADERBOARD_RESYNC_SECS > 0:
+            self._resync.start()
+
+    def _resync_loop(self):
+        while True:
+            time.sleep(LEADERBOARD_RESYNC_SECS)
+            self.load()
+
+
+class Broadcaster:
+    """
+    Fan-out of leaderboard events to the server-sent events clients of this process.
+
+    Each event is formatted once and the same string is queued for every client. publish() can be called from
+    any thread; the fan-out runs on the app event loop. Idle clients cost nothing but a periodic keep-alive.
+    """
+
+    def __init__(self, backlog: int = LEADERBOARD_CLIENT_BACKLOG):
+        self.backlog = backlog
+        self._loop = None
+        self._clients = set()
+        self.counters = collections.Counter()
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.backlog)
+        self._clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._clients.discard(queue)
+
+    @staticmethod
+    def format(event: str, data) -> str:
+        return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(",", ":"))}\n\n'
+
+    def publish(self, event: str, data):
+        if self._loop is None or not self._clients:
+            return
+
+        message = self.format(event, data)
+        self._loop.call_soon_threadsafe(self._fanout, message)
+
+    def _fanout(self, message):
+        self.counters['events'] += 1
+        for queue in list(self._clients):
+            if queue.full():
+                # a client that stopped reading loses its oldest events; the page polls as a fallback
+                queue.get_nowait()
+                self.counters['dropped'] += 1
+            queue.put_nowait(message)
+
+    def close(self):
+        # ends every open stream, so the server can shut down
+        for queue in list(self._clients):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    def stats(self) -> dict:
+        return {'clients': len(self._clients), **self.counters}
+
+
+# the leaderboard of this process and its push channel
+board = Leaderboard()
+broadcaster = Broadcaster()
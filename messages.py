@@ -1,18 +1,35 @@
 import datetime
+import os
+import types
 import urllib.parse
+from typing import TYPE_CHECKING
 
-from apscheduler.schedulers.background import BackgroundScheduler
 from dateutil.relativedelta import relativedelta
-from fastapi import Request
 
 import database as db
+import database_async as dba
 import db_schema
 import hyperparameters as hp
-from telegram_aux import tel_send_message, tel_send_inlinebutton, tel_send_image
+import leaderboard as lb
+import notifier
+from telegram_aux import tel_send_message, tel_send_inlinebutton, tel_send_media_group
+
+if TYPE_CHECKING:
+    import numpy as np
 
 COIN = "Gems"
+# public URL of the app, for the links in the notifications sent outside a webhook request (poller, notifier)
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', 'https://siim-23-bot.herokuapp.com/')
 TRAIN_TIME_MULTIPLIER = 4000
 
+# epoch and unit of the integer timestamps of datetime64_column
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+# create_msg_costs_gpu results of every estimated time of the metrics grid, by estimated time. Built in one pass
+# each time the costs table loads, and replaced whole: readers only ever see a complete, read-only mapping
+_costs_msgs = types.MappingProxyType({})
+
 
 def update_dict_user_hps(dict_user_hp: dict = {}, dict_msg: dict = {}) -> dict:
     # Get the user_id and txt fields from the dict_msg dictionary, providing default values if the keys are not found
@@ -164,6 +181,17 @@ def select_image_size(dict_msg: dict = {}):
 
 
 def select_gpu(dict_msg: dict = {}, dict_user_hp: dict = {}):
+    user_balance = db.return_balance_per_user(dict_msg.get('user_id', ''))
+    send_gpu_options(dict_msg, dict_user_hp, user_balance)
+
+
+async def select_gpu_async(dict_msg: dict = {}, dict_user_hp: dict = {}):
+    # the balance query is awaited on the event loop; the messages are only queued
+    user_balance = await dba.return_balance_per_user(dict_msg.get('user_id', ''))
+    send_gpu_options(dict_msg, dict_user_hp, user_balance)
+
+
+def send_gpu_options(dict_msg: dict, dict_user_hp: dict, user_balance: float):
     chat_id = dict_msg.get('chat_id', '')
     user_id = dict_msg.get('user_id', '')
 
@@ -171,13 +199,12 @@ def select_gpu(dict_msg: dict = {}, dict_user_hp: dict = {}):
 
     estimated_time = db.estimate_train_time(dict_user_hp, user_id, chat_id)
 
-    user_balance = db.return_balance_per_user(user_id)
     formatted_user_balance = "{:.2f}".format(user_balance)
 
     # create messages with costs and time for each gpu
     msg_gpu_comparison, list_dict_buttons, list_est_times, list_costs = create_msg_costs_gpu(estimated_time)
 
-    list_dict_buttons += [{"text": "Cancel", "callback_data": "start"}]
+    list_dict_buttons = list(list_dict_buttons) + [{"text": "Cancel", "callback_data": "start"}]
 
     if estimated_time > 0:
         tel_send_message(chat_id, f"Here are your selected hyperparameters:{user_hps}")
@@ -197,34 +224,65 @@ def select_gpu(dict_msg: dict = {}, dict_user_hp: dict = {}):
                                {"text": "Leaderboard", "callback_data": "show_leaderboard"}])
 
 
-def submit_training(dict_msg: dict = {}, dict_user_hp: dict = {}, request: Request = None,
-                    scheduler: BackgroundScheduler = None):
+def submit_training(dict_msg: dict = {}, dict_user_hp: dict = {}, base_url: str = None):
+    chat_id = dict_msg.get('chat_id', '')
+    user_id = dict_msg.get('user_id', '')
+    gpu_model, cost, estimated_time = submission_costs(dict_msg, dict_user_hp)
+
+    # the balance is checked and debited by the database, in the same transaction as the submission
+    try:
+        datetime_results_available = db.make_submission(dict_user_hp, user_id, chat_id, gpu_model, cost,
+                                                        estimated_time)
+    except db.InsufficientBalance:
+        tel_send_message(chat_id, f"💔 Sorry. Your balance is insufficient.")
+        select_gpu(dict_msg, dict_user_hp)
+        return
+
+    send_submission_result(dict_msg, datetime_results_available, estimated_time, base_url)
+
+
+async def submit_training_async(dict_msg: dict = {}, dict_user_hp: dict = {}, base_url: str = None):
+    # submit_training with the submission (and, if it is refused, the balance) awaited on the event loop
+    chat_id = dict_msg.get('chat_id', '')
+    user_id = dict_msg.get('user_id', '')
+    gpu_model, cost, estimated_time = submission_costs(dict_msg, dict_user_hp)
+
+    try:
+        datetime_results_available = await dba.make_submission(dict_user_hp, user_id, chat_id, gpu_model, cost,
+                                                               estimated_time)
+    except db.InsufficientBalance:
+        tel_send_message(chat_id, f"💔 Sorry. Your balance is insufficient.")
+        await select_gpu_async(dict_msg, dict_user_hp)
+        return
+
+    send_submission_result(dict_msg, datetime_results_available, estimated_time, base_url)
+
+
+def submission_costs(dict_msg: dict, dict_user_hp: dict) -> tuple:
+    # (gpu_model, cost, estimated_time) of the GPU the competitor picked
     chat_id = dict_msg.get('chat_id', '')
     user_id = dict_msg.get('user_id', '')
-    fullname = dict_msg.get('fullname', '')
     gpu_model = dict_msg.get('txt', '').split('gpu_model_')[1]
 
     # calculate avg train time
     estimated_time = db.estimate_train_time(dict_user_hp, user_id, chat_id)
 
-    user_balance = db.return_balance_per_user(user_id)
-
     # create messages with costs and time for each gpu
     msg_gpu_comparison, list_dict_buttons, list_est_times, list_costs = create_msg_costs_gpu(estimated_time, gpu_model)
-    estimated_time = list_est_times[0]
-    cost = list_costs[0]
 
-    if user_balance < cost:
-        tel_send_message(chat_id, f"💔 Sorry. Your balance is insufficient.")
-        select_gpu(dict_msg, dict_user_hp)
-        return
+    return gpu_model, list_costs[0], list_est_times[0]
 
-    datetime_results_available = db.make_submission(dict_user_hp, user_id, chat_id, gpu_model, cost, estimated_time)
 
-    run_time = datetime_results_available
-    scheduler.add_job(notify_finished_trainings, 'date', run_date=run_time, args=[str(request.base_url), user_id])
+def send_submission_result(dict_msg: dict, datetime_results_available, estimated_time: float, base_url: str = None):
+    chat_id = dict_msg.get('chat_id', '')
+    user_id = dict_msg.get('user_id', '')
+    fullname = dict_msg.get('fullname', '')
 
-    if estimated_time > 0:
+    if datetime_results_available:
+        # the notifier sends the results when they are due
+        notifier.dispatcher.schedule(user_id, datetime_results_available, base_url)
+
+    if datetime_results_available and estimated_time > 0:
         tel_send_message(chat_id, f"🎉🎊 Nice work, {fullname}!")
         tel_send_message(chat_id, "📃 Your model was submitted to the training queue.\n" \
                                   f"🕐 The estimated training time is {convert_seconds(estimated_time)}")
@@ -242,14 +300,14 @@ def submit_training(dict_msg: dict = {}, dict_user_hp: dict = {}, request: Reque
                                {"text": "Leaderboard", "callback_data": "show_leaderboard"}])
 
 
-def show_training_status(dict_msg: dict = {}, request: Request = None):
+def show_training_status(dict_msg: dict = {}, base_url: str = None):
     chat_id = dict_msg.get('chat_id', '')
     user_id = dict_msg.get('user_id', '')
 
-    # Loads user's submissions
-    df = db.load_df_submissions(user_id)
+    # Loads user's last submission
+    submissions = db.load_submissions(user_id, limit=1)
 
-    if len(df) == 0:
+    if not submissions:
         # If there is no submission
         tel_send_message(chat_id, "🤚 You didn't submit any model to training yet.")
         tel_send_inlinebutton(chat_id, "Select your option:",
@@ -257,7 +315,7 @@ def show_training_status(dict_msg: dict = {}, request: Request = None):
                                {"text": "Leaderboard", "callback_data": "show_leaderboard"}])
     else:
         # Submission were found
-        rec = df.loc[0]
+        rec = submissions[0]
 
         if rec.training_status in db_schema.TRAINING_STATUS_TRAINING:
             # The last submission is training
@@ -282,35 +340,26 @@ def show_training_status(dict_msg: dict = {}, request: Request = None):
 
             else:
                 # The training session is over. Notify the user and change status in the database
-                notify_finished_trainings(base_url=str(request.base_url), user_id=user_id)
+                try:
+                    notify_finished_trainings(base_url=base_url, user_id=user_id)
+                except Exception as e:
+                    # still pending: the notifier sends it on its next rescan
+                    print(f'Error notifying finished trainings of {user_id}: {e!r}')
 
 
 def show_leaderboard(dict_msg: dict = {}):
     chat_id = dict_msg.get('chat_id', '')
     user_id = dict_msg.get('user_id', '')
 
-    df = db.get_leaderboard_df()
-
-    df['last_submission'] = df['last_submission'].apply(calculate_time_ago)
-    df['rank'] = df.index + 1
-
-    # Look for the user_id in the dataframe
-    df_user = df[df['user_id'] == user_id]
-
-    df = df[['rank', 'fullname', 'score', 'entries', 'last_submission', 'sum_costs']]
-    df.columns = ['🏆', 'Team', '🎯', 'Entries', '🕰️ Last', 'Spent 💰']
-    df = df.head(3)
-    leaderboard = df.to_string(index=False)
-
-    if not df_user.empty:
-        # Find the position (index) of the first matching row and add 1 to start counting from 1
-        position = int(df_user.index[0] + 1)
+    # Look for the user_id in the leaderboard
+    position = lb.board.position(user_id)
 
-        # Create a series called rec of the first matching row
-        row = df_user.iloc[0]
+    if position is not None:
+        row = lb.board.rows()[position - 1]
+        leaderboard = lb.board.top_text(3)
 
         tel_send_message(chat_id,
-                         f"👏 Your are in the *{number_to_ordinal(position)}* position. Your best score is *{row.score}*")
+                         f"👏 Your are in the *{number_to_ordinal(position)}* position. Your best score is *{row['score']}*")
         tel_send_message(chat_id, "🏆 *LEADERBOARD (Top 3)*")
         tel_send_message(chat_id, '```' + leaderboard + '```')
         tel_send_message(chat_id, 'Check the complete leaderboard at the SIIM AI Playground located at exposition hall, close to the food area.')
@@ -320,7 +369,7 @@ def show_leaderboard(dict_msg: dict = {}):
 
 
     else:
-        # User not found in the dataframe.
+        # User not found in the leaderboard.
         tel_send_message(chat_id, "🏆 *LEADERBOARD*")
         tel_send_message(chat_id, f"You have not ranked yet. Create a new model or wait your model to finish training.")
         tel_send_inlinebutton(chat_id, "Select your option:",
@@ -377,18 +426,20 @@ def calc_timestamp_diff_in_secs(timestamp1, timestamp2):
     return time_difference_seconds
 
 
-def notify_finished_trainings(base_url: str = None, user_id: str = None):
+def notify_finished_trainings(base_url: str = None, user_id: str = None, user_ids: list = None):
     if base_url is None:
-        base_url = 'https://siim-23-bot.herokuapp.com/'
+        base_url = PUBLIC_BASE_URL
 
-    df = db.load_df_finished_trainings(user_id)
-
-    user_balance = db.return_balance_per_user(user_id)
+    # the due submissions are claimed (moved to Notified) before sending, so concurrent sweeps never notify twice
+    finished_trainings = db.claim_finished_trainings(user_id, user_ids)
+    balances = db.load_balances({row.user_id for row in finished_trainings})
 
     list_competitors_notified = []
 
-    for idx, row in df.iterrows():
+    for row in finished_trainings:
         if row.user_id not in list_competitors_notified:
+            user_balance = balances[row.user_id]
+
             dice, jacloss, sample = db_schema.imgs_url(0, row.epochs, row.learning_rate, row.batch_norm, row.filters,
                                                        row.dropout, row.image_size, row.batch_size)
 
@@ -403,9 +454,9 @@ def notify_finished_trainings(base_url: str = None, user_id: str = None):
                                           f"*Training Cost:* {row.cost:.2f} {COIN}\n"
                                           f'*Balance:* {user_balance:.2f} {COIN}')
 
-            tel_send_image(row.chat_id, dice)
-            tel_send_image(row.chat_id, jacloss)
-            tel_send_image(row.chat_id, sample)
+            # the three figures as one album; the sends are queued per chat, so this loop doesn't wait for Telegram
+            # and the competitors are notified concurrently
+            tel_send_media_group(row.chat_id, [dice, jacloss, sample])
 
             tel_send_inlinebutton(row.chat_id, "Select your option:",
                                   [{"text": "Leaderboard", "callback_data": "show_leaderboard"},
@@ -413,7 +464,7 @@ def notify_finished_trainings(base_url: str = None, user_id: str = None):
 
             list_competitors_notified.append(row.user_id)
 
-    db.mark_submissions_notified(list_competitors_notified)
+    lb.board.apply(finished_trainings)
 
     return len(list_competitors_notified)
 
@@ -466,6 +517,64 @@ def calculate_time_ago(timestamp: str):
         return f'{minutes}min'
 
 
+def datetime64_column(timestamps) -> 'np.ndarray':
+    # datetime64[us] array of datetimes (None for missing) or timestamp strings. numpy converts datetime objects
+    # one by one on a slow generic path, so those go through integer microseconds since the epoch
+    import numpy as np
+
+    timestamps = list(timestamps)
+    if all(timestamp is None or isinstance(timestamp, datetime.datetime) for timestamp in timestamps):
+        nat = np.iinfo(np.int64).min
+        micros = [nat if timestamp is None else (timestamp - EPOCH) // MICROSECOND for timestamp in timestamps]
+        return np.array(micros, dtype=np.int64).view('datetime64[us]')
+
+    return np.asarray(timestamps, dtype='datetime64[us]')
+
+
+def calculate_times_ago(timestamps, now: datetime.datetime = None) -> list:
+    # calculate_time_ago of a whole column at once: the same labels, bucketed with array operations against a
+    # single now. Missing timestamps get ''. For the leaderboard page and API; numpy is only imported when used,
+    # so the webhook doesn't load it
+    import numpy as np
+
+    if now is None:
+        now = datetime.datetime.now()
+
+    timestamps = datetime64_column(timestamps)
+    if timestamps.size == 0:
+        return []
+
+    us_per_day = 86400 * 10 ** 6
+    now = np.datetime64(now, 'us')
+    now_month = now.astype('datetime64[M]')
+    now_day = (now.astype('datetime64[D]') - now_month).astype(np.int64) + 1
+    now_time = (now - now.astype('datetime64[D]')).astype(np.int64)
+    days_in_month = ((now_month + 1).astype('datetime64[D]') - now_month.astype('datetime64[D]')).astype(np.int64)
+
+    months = timestamps.astype('datetime64[M]')
+    days = timestamps.astype('datetime64[D]')
+    day = (days - months).astype(np.int64) + 1
+    time_of_day = (timestamps - days).astype(np.int64)
+
+    # relativedelta's whole months: the calendar months in between, minus one if the timestamp moved that many
+    # months forward (clamped to the last day of the month) is still after now
+    shifted_day = np.minimum(day, days_in_month)
+    after_now = (shifted_day > now_day) | ((shifted_day == now_day) & (time_of_day > now_time))
+    total_months = (now_month - months).astype(np.int64) - after_now
+
+    difference = (now - timestamps).astype(np.int64)
+    seconds_of_day = difference % us_per_day // 10 ** 6
+
+    conditions = [difference < 60 * 10 ** 6, total_months >= 12, total_months >= 1, difference >= us_per_day,
+                  difference >= 3600 * 10 ** 6]
+    values = np.select(conditions, [0, total_months // 12, total_months, difference // us_per_day,
+                                    seconds_of_day // 3600], seconds_of_day // 60)
+    units = np.select(conditions, ['Now', 'y', 'mo', 'd', 'h'], 'min')
+    units[np.isnat(timestamps)] = ''
+
+    return [unit if unit in ('Now', '') else f'{value}{unit}' for value, unit in zip(values.tolist(), units.tolist())]
+
+
 def number_to_ordinal(n):
     if isinstance(n, (int, float)):
         n = int(n)
@@ -501,35 +610,66 @@ def create_url(url, route, parameters=None):
 
 
 def create_msg_costs_gpu(estimated_time: str, gpu_model: str = ''):
-    df_costs = db.load_df_costs(gpu_model)
-
-    list_dict_buttons = []
-    list_est_times = []
-    list_costs = []
-    msg = ''
-    for idx, row in df_costs.iterrows():
-        gpu_model = row.gpu_model
-        gpu_cost_per_seconds = row.cost / 60 / 60
-        est_time = estimated_time * TRAIN_TIME_MULTIPLIER / row.cuda_cores
-        cost = gpu_cost_per_seconds * float(est_time)
+    # the table, buttons, estimated times and costs of every GPU (or only gpu_model) for an estimated time.
+    # Shared by every caller, so they are tuples
+    entry = _costs_msgs.get(float(estimated_time))
+    if entry is None:
+        # a time missing from the grid (or no table loaded yet): the same numbers, one GPU at a time
+        costs = db.load_costs()
+        est_times = [float(estimated_time) * TRAIN_TIME_MULTIPLIER / row.cuda_cores for row in costs]
+        gpu_costs = [float(row.cost) / 60 / 60 * est_time for row, est_time in zip(costs, est_times)]
+        entry = costs_msgs_entry(costs, est_times, gpu_costs)
+
+    result, by_gpu = entry
+    if not gpu_model:
+        return result
+    return by_gpu.get(gpu_model, ('', (), (), ()))
+
+
+def costs_msgs_entry(costs: list, est_times: list, gpu_costs: list) -> tuple:
+    # (result for all GPUs, result of each GPU) from the estimated time and the unrounded cost on each GPU
+    rows = []
+    for row, est_time, cost in zip(costs, est_times, gpu_costs):
         cost = round(cost, 2)
-        formatted_cost = "{:.2f}".format(cost)
+        rows.append((row.gpu_model,
+                     f"*- {row.gpu_model}*: ⏱️ {convert_seconds(est_time)} / 💰 {cost:.2f}\n",
+                     {"text": row.gpu_model, "callback_data": f"gpu_model_{row.gpu_model}"},
+                     est_time,
+                     cost))
 
-        list_dict_buttons.append({"text": gpu_model, "callback_data": f"gpu_model_{gpu_model}"})
-        list_est_times.append(est_time)
-        list_costs.append(cost)
+    result = (''.join(row[1] for row in rows),
+              tuple(row[2] for row in rows),
+              tuple(row[3] for row in rows),
+              tuple(row[4] for row in rows))
+    by_gpu = {gpu: (line, (button,), (est_time,), (cost,)) for gpu, line, button, est_time, cost in rows}
 
-        msg += f"*- {row.gpu_model}*: ⏱️ {convert_seconds(est_time)} / 💰 {formatted_cost}\n"
+    return result, by_gpu
 
-    return msg, list_dict_buttons, list_est_times, list_costs
 
+def build_costs_msgs(costs: list):
+    # called by database.load_costs_table with the new table: time and cost of every GPU for every estimated time
+    # of the metrics grid, as one (times x GPUs) array operation. Runs in the loader, so numpy stays off the
+    # webhook path
+    global _costs_msgs
+    import numpy as np
 
-def list_gpus_buttons() -> list:
-    df_costs = db.load_df_costs()
+    grid = db.metrics_grid or {}
+    # 0 is the estimate of a configuration without pretrained results
+    times = sorted({0.0} | {float(metrics[0]) for metrics in grid.values() if metrics[0] is not None})
+
+    cuda_cores = np.array([row.cuda_cores for row in costs], dtype=float)
+    hourly_costs = np.array([float(row.cost) for row in costs])
+    est_times = np.array(times)[:, None] * TRAIN_TIME_MULTIPLIER / cuda_cores
+    gpu_costs = hourly_costs / 60 / 60 * est_times
 
-    df_costs['button'] = 'gpu_model_' + df_costs['gpu_model']
+    costs_msgs = {time: costs_msgs_entry(costs, row_times, row_costs)
+                  for time, row_times, row_costs in zip(times, est_times.tolist(), gpu_costs.tolist())}
 
-    return df_costs['button'].to_list()
+    _costs_msgs = types.MappingProxyType(costs_msgs)
 
 
-GPU_NAMES = list_gpus_buttons()
+db.costs_listeners.append(build_costs_msgs)
+
+
+def list_gpus_buttons() -> list:
+    return ['gpu_model_' + row.gpu_model for row in db.load_costs()]
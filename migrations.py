@@ -0,0 +1,60 @@
+from sqlalchemy import text
+
+# versioned schema changes for databases created before the change was added to db_schema.py. Every statement is
+# idempotent, as a fresh database already gets the same columns and indexes from metadata_obj.create_all
+MIGRATIONS = [
+    (1, 'indexes on submissions for the per-user and pending-notification queries', [
+        'CREATE INDEX IF NOT EXISTS ix_submissions_user_id_datetime '
+        'ON submissions (user_id, datetime_submission DESC)',
+        "CREATE INDEX IF NOT EXISTS ix_submissions_pending "
+        "ON submissions (datetime_results_available) "
+        "WHERE training_status = 'Training' AND telegram_sent IS NULL",
+    ]),
+    (2, 'normalized dropout column and configuration index on pretrained_results', [
+        'ALTER TABLE pretrained_results ADD COLUMN IF NOT EXISTS dropout_norm numeric(4, 2) '
+        'GENERATED ALWAYS AS (round(CAST(dropout AS numeric), 2)) STORED',
+        'CREATE INDEX IF NOT EXISTS ix_pretrained_results_config '
+        'ON pretrained_results (batch_size, epochs, learning_rate, batch_norm, filters, dropout_norm, image_size)',
+    ]),
+]
+
+# any constant works, it only has to be the same for every process running the migrations
+MIGRATIONS_LOCK_ID = 230523
+
+
+def current_version(conn) -> int:
+    return conn.execute(text('SELECT coalesce(max(version), 0) FROM schema_version')).scalar()
+
+
+def migrate(engine) -> int:
+    # applies the pending migrations, each one in its own transaction. Returns the schema version
+    if engine.dialect.name != 'postgresql':
+        # other databases are only used for local runs, where create_all builds the current schema
+        return 0
+
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version '
+                          '(version integer PRIMARY KEY, description text, applied timestamp DEFAULT now())'))
+
+    version = 0
+    for version, description, statements in MIGRATIONS:
+        with engine.begin() as conn:
+            # several workers start at the same time; the first one migrates, the others wait and skip
+            conn.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': MIGRATIONS_LOCK_ID})
+            if current_version(conn) >= version:
+                continue
+
+            for statement in statements:
+                conn.execute(text(statement))
+            conn.execute(text('INSERT INTO schema_version (version, description) VALUES (:version, :description)'),
+                         {'version': version, 'description': description})
+            print(f'Applied migration {version}: {description}')
+
+    return version
+
+
+if __name__ == "__main__":
+    # python migrations.py
+    import db_schema
+
+    print(f'Schema version: {migrate(db_schema.engine)}')
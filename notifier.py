@@ -0,0 +1,163 @@
+import collections
+import datetime
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import database as db
+
+# how often the submissions table is read again, for the trainings submitted by other processes
+NOTIFY_RESCAN_SECS = float(os.environ.get('NOTIFY_RESCAN_SECS', 60))
+# backoff of the deadlines whose notification failed
+NOTIFY_RETRY_SECS = float(os.environ.get('NOTIFY_RETRY_SECS', 5))
+NOTIFY_RETRY_MAX_SECS = float(os.environ.get('NOTIFY_RETRY_MAX_SECS', 300))
+
+
+class NotificationDispatcher:
+    """
+    Sends the results of each training when they are due.
+
+    Pending deadlines (datetime_results_available) are kept in a min-heap, rebuilt from the submissions table on
+    start. One thread sleeps until the earliest deadline and notifies only the competitors whose results are due,
+    so scheduling a submission is a heap push: no jobstore row and no sweep of the whole table.
+
+    The table is read again every NOTIFY_RESCAN_SECS, so the trainings submitted by other processes are picked up
+    too; the claim lets only one process notify each of them. When a notification fails, its deadlines are pushed
+    back with exponential backoff.
+    """
+
+    def __init__(self, rescan_secs: float = NOTIFY_RESCAN_SECS, retry_secs: float = NOTIFY_RETRY_SECS,
+                 retry_max_secs: float = NOTIFY_RETRY_MAX_SECS):
+        self.rescan_secs = rescan_secs
+        self.retry_secs = retry_secs
+        self.retry_max_secs = retry_max_secs
+
+        # (due, seq, user_id, base_url, failed attempts, deadline), due is later than the deadline after a failure
+        self._heap = []
+        # (user_id, deadline) of the entries in the heap, so a rescan doesn't add them twice
+        self._keys = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._next_rescan = None
+        self.counters = collections.Counter()
+
+    def _push(self, due: datetime.datetime, user_id: str, base_url: str = None, attempts: int = 0,
+              deadline: datetime.datetime = None):
+        # called with the condition held
+        deadline = deadline or due
+        entry = (due, next(self._seq), user_id, base_url, attempts, deadline)
+        heapq.heappush(self._heap, entry)
+        self._keys.add((user_id, deadline))
+        # wake the thread only if this is the new earliest deadline
+        if self._heap[0] is entry:
+            self._cond.notify()
+
+    def schedule(self, user_id: str, due: datetime.datetime, base_url: str = None):
+        with self._cond:
+            self._push(due, user_id, base_url)
+            self.counters['scheduled'] += 1
+
+    def load(self) -> bool:
+        with self._cond:
+            self._next_rescan = time.monotonic() + self.rescan_secs
+
+        try:
+            rows = db.load_pending_notifications()
+        except Exception as e:
+            print(f'Error loading the pending notifications: {e}')
+            return False
+
+        with self._cond:
+            # keep what was scheduled while the table was read, and what is already in the heap
+            for row in rows:
+                if row.datetime_results_available is not None and \
+                        (row.user_id, row.datetime_results_available) not in self._keys:
+                    self._push(row.datetime_results_available, row.user_id)
+                    self.counters['loaded'] += 1
+
+        return True
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+
+        self.load()
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = datetime.datetime.now()
+                    rescan_in = self._next_rescan - time.monotonic() if self._next_rescan is not None else None
+                    if (self._heap and self._heap[0][0] <= now) or (rescan_in is not None and rescan_in <= 0):
+                        break
+                    timeouts = [timeout for timeout in
+                                [(self._heap[0][0] - now).total_seconds() if self._heap else None, rescan_in]
+                                if timeout is not None]
+                    self._cond.wait(min(timeouts) if timeouts else None)
+
+                if self._stopping:
+                    return
+
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    self._keys.discard((entry[2], entry[5]))
+                    due.append(entry)
+                rescan = self._next_rescan is not None and self._next_rescan <= time.monotonic()
+
+            if rescan:
+                self.load()
+            if due:
+                self._notify(due)
+
+    def _notify(self, due: list):
+        from messages import notify_finished_trainings
+
+        user_ids = list(dict.fromkeys(user_id for _, _, user_id, _, _, _ in due))
+        base_url = next((base_url for _, _, _, base_url, _, _ in due if base_url), None)
+
+        try:
+            notified = notify_finished_trainings(base_url=base_url, user_ids=user_ids)
+            self.counters['notified'] += notified
+        except Exception as e:
+            self.counters['failed'] += 1
+            print(f'Error notifying finished trainings of {user_ids}: {e!r}')
+            self._retry(due)
+
+    def _retry(self, due: list):
+        # the claim failed, so the submissions are still pending: try again later, backing off on every failure
+        now = datetime.datetime.now()
+        with self._cond:
+            for _, _, user_id, base_url, attempts, deadline in due:
+                delay = min(self.retry_secs * 2 ** attempts, self.retry_max_secs)
+                self._push(now + datetime.timedelta(seconds=delay), user_id, base_url, attempts + 1, deadline)
+                self.counters['retried'] += 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._heap)
+            next_due = self._heap[0][0].isoformat() if self._heap else None
+
+        return {'pending': pending, 'next_due': next_due, **self.counters}
+
+
+# the notification dispatcher of this process
+dispatcher = NotificationDispatcher()
@@ -0,0 +1,203 @@
+"""
+Long-polling entry point: fetches updates with getUpdates instead of receiving them on the webhook.
+
+Useful where Telegram cannot reach the app (behind NAT), to drain a backlog after an outage, or to measure the
+handlers without an HTTPS ingress.
+
+The web (webhook) and poller modes are mutually exclusive: Telegram only serves getUpdates while no webhook is set.
+Keep the Procfile `poller` process scaled to 0 while the webhook is in use. If a webhook is set, the poller logs the
+conflict and retries every POLL_CONFLICT_SECS instead of exiting (a one-off --drain run exits); pass
+--delete-webhook to switch the bot over to polling.
+
+    python poller.py                     # poll until interrupted
+    python poller.py --drain             # process what is pending, then exit
+    python poller.py --delete-webhook    # remove the webhook first, then poll
+    TELEGRAM_API_URL=http://localhost:8081 python poller.py   # against a local stand-in Bot API
+"""
+import argparse
+import collections
+import concurrent.futures
+import os
+import signal
+import threading
+import time
+
+import database as db
+import dedup
+import leaderboard as lb
+import messages as msgs
+import notifier
+import session_store
+import updates
+from telegram_aux import client, dispatcher
+from telegram_client import TELEGRAM_TIMEOUT
+
+# getUpdates returns at most 100 updates per call
+POLL_BATCH_SIZE = int(os.environ.get('POLL_BATCH_SIZE', 100))
+# how long each getUpdates call waits for new updates
+POLL_TIMEOUT_SECS = int(os.environ.get('POLL_TIMEOUT_SECS', 30))
+POLL_CONCURRENCY = int(os.environ.get('POLL_CONCURRENCY', updates.UPDATE_WORKERS))
+POLL_RETRY_MAX_SECS = float(os.environ.get('POLL_RETRY_MAX_SECS', 30))
+# how often getUpdates is tried again while a webhook is set
+POLL_CONFLICT_SECS = float(os.environ.get('POLL_CONFLICT_SECS', 300))
+
+
+class UpdatePoller:
+    """
+    getUpdates loop feeding the webhook handler.
+
+    Each batch is processed concurrently: the updates of one user run in order, different users run in parallel.
+    The offset only moves past a batch once it is fully processed, so after a crash Telegram sends the unfinished
+    batch again, and the deduplicator drops what was already handled.
+    """
+
+    def __init__(self, handler, batch_size: int = POLL_BATCH_SIZE, timeout: int = POLL_TIMEOUT_SECS,
+                 concurrency: int = POLL_CONCURRENCY, base_url: str = msgs.PUBLIC_BASE_URL):
+        self.handler = handler
+        self.batch_size = max(1, min(batch_size, 100))
+        self.timeout = timeout
+        self.base_url = base_url
+        self.offset = None
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix='poll-worker')
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.started = time.monotonic()
+
+    def fetch(self, timeout: int, limit: int = None) -> dict:
+        payload = {'limit': limit or self.batch_size,
+                   'timeout': timeout,
+                   'allowed_updates': ['message', 'callback_query']}
+        if self.offset is not None:
+            # confirms every update below the offset
+            payload['offset'] = self.offset
+
+        return client.call('getUpdates', payload, timeout=timeout + TELEGRAM_TIMEOUT)
+
+    def process(self, batch: list):
+        per_user = collections.defaultdict(list)
+        for req in batch:
+            if not updates.is_valid_update(req) or not updates.is_handled_update(req):
+                self._count('ignored')
+            elif not dedup.deduplicator.claim(req['update_id']):
+                self._count('duplicates')
+            else:
+                per_user[updates.update_user_id(req)].append(req)
+
+        futures = [self._executor.submit(self._handle_user, reqs) for reqs in per_user.values()]
+        concurrent.futures.wait(futures)
+
+    def _handle_user(self, reqs: list):
+        for req in reqs:
+            try:
+                with updates.user_lock(req):
+                    self.handler(req, self.base_url)
+                self._count('processed')
+            except Exception as e:
+                self._count('failed')
+                print(f'Error processing update {req.get("update_id")}: {e!r}')
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.counters[key] += value
+
+    def run(self, drain: bool = False):
+        # drain: don't wait for new updates, return once none are pending
+        timeout = 0 if drain else self.timeout
+        retry_secs = 1
+
+        while not self._stopping.is_set():
+            result = self.fetch(timeout)
+
+            if not result.get('ok'):
+                if result.get('error_code') == 409:
+                    print(f'getUpdates is not available while a webhook is set: {result.get("description")}')
+                    if drain:
+                        break
+                    # exiting would only make the process manager restart the poller in a loop
+                    print(f'The webhook and the poller are mutually exclusive: scale the poller to 0 or run it with '
+                          f'--delete-webhook. Retrying in {POLL_CONFLICT_SECS:g}s')
+                    self._stopping.wait(POLL_CONFLICT_SECS)
+                    continue
+
+                print(f'Error polling updates: {result.get("description")}')
+                self._stopping.wait(result.get('parameters', {}).get('retry_after') or retry_secs)
+                retry_secs = min(retry_secs * 2, POLL_RETRY_MAX_SECS)
+                continue
+
+            retry_secs = 1
+            batch = result.get('result') or []
+            if not batch:
+                if drain:
+                    break
+                continue
+
+            started = time.monotonic()
+            self.process(batch)
+            self.offset = max(req['update_id'] for req in batch) + 1
+
+            self._count('batches')
+            self._count('updates', len(batch))
+            self._count('busy_ms', int((time.monotonic() - started) * 1000))
+
+    def stop(self):
+        # the loop ends after the current getUpdates call returns
+        self._stopping.set()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self.offset is not None:
+            # confirm the last batch, so it is not sent again on the next start
+            self.fetch(0, limit=1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+
+        busy_secs = counters.get('busy_ms', 0) / 1000
+        return {'offset': self.offset,
+                'elapsed_secs': round(time.monotonic() - self.started, 3),
+                'updates_per_sec': round(counters.get('updates', 0) / busy_secs, 1) if busy_secs else None,
+                **counters}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=POLL_BATCH_SIZE)
+    parser.add_argument('--timeout', type=int, default=POLL_TIMEOUT_SECS, help='long polling timeout (s)')
+    parser.add_argument('--concurrency', type=int, default=POLL_CONCURRENCY)
+    parser.add_argument('--base-url', default=msgs.PUBLIC_BASE_URL, help='public URL used in the links sent')
+    parser.add_argument('--drain', action='store_true', help='exit once there are no pending updates')
+    parser.add_argument('--delete-webhook', action='store_true',
+                        help='remove the webhook first (its pending updates are kept)')
+    parser.add_argument('--send-timeout', type=float, default=60,
+                        help='how long to wait at exit for the queued messages to be sent (s)')
+    args = parser.parse_args()
+
+    if args.delete_webhook:
+        print(f'deleteWebhook: {client.call("deleteWebhook", {"drop_pending_updates": False})}')
+
+    # same warm-up as the app startup, minus the HTTP-only parts
+    db.get_metrics_grid()
+    db.get_costs_table()
+    lb.board.start()
+    notifier.dispatcher.start()
+
+    poller = UpdatePoller(updates.handle_update, args.batch_size, args.timeout, args.concurrency, args.base_url)
+    signal.signal(signal.SIGINT, lambda *_: poller.stop())
+    signal.signal(signal.SIGTERM, lambda *_: poller.stop())
+
+    try:
+        poller.run(drain=args.drain)
+    finally:
+        poller.close()
+        notifier.dispatcher.stop()
+        session_store.store.close()
+        dispatcher.drain(args.send_timeout)
+        client.close()
+        print(f'Poller stopped: {poller.stats()}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import abc
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import select
+
+import db_schema
+from db_schema import tb_sessions
+
+# where the wizard state of each user is kept: 'postgres', 'sqlite', 'memory' or 'file' (one JSON file per user)
+SESSION_STORE = os.environ.get('SESSION_STORE', 'postgres')
+# optional store written behind the in-memory one ('postgres', 'sqlite' or 'file')
+SESSION_BACKING = os.environ.get('SESSION_BACKING', '')
+SESSION_TTL_SECS = float(os.environ.get('SESSION_TTL_SECS', 6 * 60 * 60))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+SESSION_FLUSH_SECS = float(os.environ.get('SESSION_FLUSH_SECS', 1))
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', 'sessions.db')
+
+
+class SessionStore(abc.ABC):
+    """Key-value store for the per-user wizard state (dict of selected hyperparameters)."""
+
+    @abc.abstractmethod
+    def load(self, user_id: str) -> dict:
+        pass
+
+    @abc.abstractmethod
+    def save(self, user_id: str, data: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSessionStore(SessionStore):
+    # one <user_id>.json file in the working directory; single process only
+
+    def load(self, user_id: str) -> dict:
+        try:
+            with open(user_id + '.json', "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, user_id: str, data: dict):
+        with open(user_id + '.json', "w") as file:
+            json.dump(data, file)
+
+
+class SQLiteSessionStore(SessionStore):
+    # sqlite file in WAL mode: readers don't block the writer, so several workers on one host can share it
+
+    def __init__(self, path: str = SESSION_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute('CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT, updated REAL)')
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads; keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, user_id: str) -> dict:
+        row = self._conn().execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save(self, user_id: str, data: dict):
+        self._conn().execute('INSERT INTO sessions (user_id, data, updated) VALUES (?, ?, ?) '
+                             'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated',
+                             (user_id, json.dumps(data), time.time()))
+
+
+class SQLSessionStore(SessionStore):
+    # sessions table in the main database, shared by every worker and dyno
+
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else db_schema.engine
+
+        if self.engine.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        self._insert = insert
+
+    def load(self, user_id: str) -> dict:
+        with self.engine.connect() as conn:
+            data = conn.execute(select(tb_sessions.c.data).where(tb_sessions.c.user_id == user_id)).scalar()
+        return json.loads(data) if data else {}
+
+    def save(self, user_id: str, data: dict):
+        stmt = self._insert(tb_sessions).values(user_id=user_id, data=json.dumps(data),
+                                                updated=datetime.datetime.now())
+        stmt = stmt.on_conflict_do_update(index_elements=[tb_sessions.c.user_id],
+                                          set_={'data': stmt.excluded.data, 'updated': stmt.excluded.updated})
+        with self.engine.connect() as conn:
+            conn.execute(stmt)
+            conn.commit()
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process LRU of sessions with an idle TTL.
+
+    With a backing store, misses are read from it and saves are written behind by a flusher thread, so a click
+    costs no I/O. Without one, state lives only in this process.
+    """
+
+    def __init__(self, backing: SessionStore = None, ttl: float = SESSION_TTL_SECS,
+                 max_entries: int = SESSION_MAX_ENTRIES, flush_secs: float = SESSION_FLUSH_SECS):
+        self.backing = backing
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_secs = flush_secs
+
+        self._entries = collections.OrderedDict()
+        self._dirty = set()
+        # dirty entries evicted from _entries, until they are written to the backing store
+        self._evicting = {}
+        self._lock = threading.Lock()
+        # one backing write at a time, so an older value of a session can't be written after a newer one
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+        if backing is not None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='session-flusher', daemon=True)
+            self._flusher.start()
+
+    def load(self, user_id: str) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(user_id)
+                entry[0] = now
+                return dict(entry[1])
+
+            # evicted but not written yet, the backing store may still hold an older value
+            data = self._evicting.get(user_id)
+
+        if data is None:
+            data = self.backing.load(user_id) if self.backing is not None else {}
+        with self._lock:
+            # a save may have raced with the backing read; keep the newer in-memory value
+            evicted = [] if user_id in self._dirty else self._put(user_id, data, now)
+        self._write_back(evicted)
+        return dict(data)
+
+    def save(self, user_id: str, data: dict):
+        with self._lock:
+            evicted = self._put(user_id, dict(data), time.monotonic())
+            if self.backing is not None:
+                # supersedes a value of the user still waiting to be written back
+                self._evicting.pop(user_id, None)
+                self._dirty.add(user_id)
+        self._write_back(evicted)
+
+    def _put(self, user_id, data, now) -> list:
+        # called with the lock held. Returns the ids of the evicted dirty entries, which the caller writes with
+        # _write_back once the lock is released
+        self._entries[user_id] = [now, data]
+        self._entries.move_to_end(user_id)
+
+        # evict least recently used and idle entries
+        evicted = []
+        while self._entries:
+            oldest_id, (accessed, oldest_data) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - accessed <= self.ttl:
+                break
+            if oldest_id in self._dirty:
+                self._dirty.discard(oldest_id)
+                self._evicting[oldest_id] = oldest_data
+                evicted.append(oldest_id)
+            del self._entries[oldest_id]
+
+        return evicted
+
+    def _write_back(self, user_ids: list):
+        for user_id in user_ids:
+            with self._write_lock:
+                with self._lock:
+                    # None if superseded by a save, or already written by another thread
+                    data = self._evicting.get(user_id)
+                if data is None:
+                    continue
+
+                try:
+                    self.backing.save(user_id, data)
+                except Exception as e:
+                    print(f'Error writing evicted session {user_id}: {e}')
+                    with self._lock:
+                        # back in memory as dirty, for the flusher to retry
+                        entry = self._entries.get(user_id)
+                        if entry is None:
+                            self._entries[user_id] = [time.monotonic(), data]
+                            self._dirty.add(user_id)
+                        elif entry[1] is data:
+                            self._dirty.add(user_id)
+
+                with self._lock:
+                    if self._evicting.get(user_id) is data:
+                        del self._evicting[user_id]
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending = [(user_id, self._entries[user_id][1]) for user_id in self._dirty
+                           if user_id in self._entries]
+                self._dirty.clear()
+
+            for user_id, data in pending:
+                try:
+                    self.backing.save(user_id, data)
+                except Exception as e:
+                    print(f'Error writing session {user_id}: {e}')
+                    with self._lock:
+                        self._dirty.add(user_id)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_secs):
+            self.flush()
+
+    def close(self):
+        if self._flusher is not None:
+            self._stop.set()
+            self._flusher.join()
+            self.flush()
+            self.backing.close()
+
+
+def create_store(kind: str = SESSION_STORE, backing: str = SESSION_BACKING) -> SessionStore:
+    if kind == 'memory':
+        return MemorySessionStore(create_store(backing, '') if backing else None)
+    if kind == 'sqlite':
+        return SQLiteSessionStore()
+    if kind == 'file':
+        return FileSessionStore()
+    if kind == 'postgres':
+        return SQLSessionStore()
+
+    raise ValueError(f'Unknown session store: {kind}')
+
+
+# the store used by database.load_dict / save_dict
+store = create_store()
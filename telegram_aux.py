@@ -1,11 +1,38 @@
 import json
 import os
 
-import requests
+from telegram_client import TelegramClient
+from telegram_dispatch import OutboundDispatcher
 
 # token that we get from the BotFather
 TOKEN = os.environ.get('TELEGRAM_TOKEN', '')
 
+# one pooled client shared by every tel_* function
+client = TelegramClient(TOKEN)
+
+# rate-limited, per-chat ordered queue for everything sent to a chat
+dispatcher = OutboundDispatcher(client)
+
+
+# Calls a Bot API method through the shared client and returns the decoded JSON response
+def tel_request(method, payload, timeout=None):
+    return client.call(method, payload, timeout)
+
+
+# Awaitable version of tel_request, for async handlers
+async def tel_request_async(method, payload, timeout=None):
+    return await client.call_async(method, payload, timeout)
+
+
+# Queues a message for a chat and returns a Future with the decoded JSON response; does not block
+def tel_send(method, payload):
+    return dispatcher.enqueue(method, payload)
+
+
+# Awaitable version of tel_send, for async handlers
+async def tel_send_async(method, payload):
+    return await dispatcher.send(method, payload)
+
 
 # Reading the JSON format when we send the text message and extracting the chat id of the user and the text that user send to the bot
 def tel_parse_message(message):
@@ -31,7 +58,8 @@ def tel_parse_message(message):
             lastname = message.get('callback_query', {}).get('from', {}).get('last_name', '')
             fullname = f'{firstname} {lastname}'
 
-        return {'chat_id': chat_id,
+        return {'update_id': message.get('update_id'),
+                'chat_id': chat_id,
                 'txt': txt,
                 'user_id': user_id,
                 'username': username,
@@ -45,30 +73,55 @@ def tel_parse_message(message):
 
 # Get the Text message response from the bot
 def tel_send_message(chat_id, text):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
-    payload = {
+    return tel_send('sendMessage', message_payload(chat_id, text))
+
+
+async def tel_send_message_async(chat_id, text):
+    return await tel_send_async('sendMessage', message_payload(chat_id, text))
+
+
+def message_payload(chat_id, text):
+    return {
         'chat_id': chat_id,
         'parse_mode': 'Markdown',
         'text': text
     }
-    r = requests.post(url, json=payload)
-    return r
 
 
 # Get the Image response from the bot by providing the image link
 def tel_send_image(chat_id, img_url):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendPhoto'
-    payload = {
+    return tel_send('sendPhoto', image_payload(chat_id, img_url))
+
+
+async def tel_send_image_async(chat_id, img_url):
+    return await tel_send_async('sendPhoto', image_payload(chat_id, img_url))
+
+
+def image_payload(chat_id, img_url):
+    return {
         'chat_id': chat_id,
         'photo': str(img_url)
     }
-    r = requests.post(url, json=payload)
-    return r
+
+
+# Send several images as one album (2 to 10 photos) by providing the image links
+def tel_send_media_group(chat_id, img_urls):
+    return tel_send('sendMediaGroup', media_group_payload(chat_id, img_urls))
+
+
+async def tel_send_media_group_async(chat_id, img_urls):
+    return await tel_send_async('sendMediaGroup', media_group_payload(chat_id, img_urls))
+
+
+def media_group_payload(chat_id, img_urls):
+    return {
+        'chat_id': chat_id,
+        'media': [{'type': 'photo', 'media': str(img_url)} for img_url in img_urls]
+    }
 
 
 # Get the Poll response from the bot
 def tel_send_poll(chat_id):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendPoll'
     payload = {
         'chat_id': chat_id,
         "question": "In which direction does the sun rise?",
@@ -79,14 +132,11 @@ def tel_send_poll(chat_id):
         # Here we are providing the index for the correct option(i.e. indexing starts from 0)
         "correct_option_id": 2
     }
-    r = requests.post(url, json=payload)
-    return r
+    return tel_send('sendPoll', payload)
 
 
 # Get the Button response in the keyboard section
 def tel_send_button(chat_id):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
-
     payload = {
         'chat_id': chat_id,
         'text': "What is this?",  # button should be in the propper format as described
@@ -101,8 +151,7 @@ def tel_send_button(chat_id):
             ]]
         }
     }
-    r = requests.post(url, json=payload)
-    return r
+    return tel_send('sendMessage', payload)
 
 
 # Get the Inline button response
@@ -112,25 +161,27 @@ def tel_send_inlinebutton(chat_id, message, options):
     :param chat_id: parameter received from Telegram
     :param message: Header message
     :param options: eg [{"text": "A", "callback_data": "ic_A"}, {"text": "B", "callback_data": "ic_B"}]
-    :return: the request response
+    :return: a Future with the decoded Bot API response
     '''
 
-    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
+    return tel_send('sendMessage', inlinebutton_payload(chat_id, message, options))
 
-    payload = {
+
+async def tel_send_inlinebutton_async(chat_id, message, options):
+    return await tel_send_async('sendMessage', inlinebutton_payload(chat_id, message, options))
+
+
+def inlinebutton_payload(chat_id, message, options):
+    return {
         'chat_id': chat_id,
         'text': message,
         'parse_mode': 'Markdown',
         'reply_markup': {"inline_keyboard": [options]}
     }
-    r = requests.post(url, json=payload)
-    return r
 
 
 # Get the Button response from the bot with the redirected URL
 def tel_send_inlineurl(chat_id):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
-
     payload = {
         'chat_id': chat_id,
         'text': "Which link would you like to visit?",
@@ -143,50 +194,40 @@ def tel_send_inlineurl(chat_id):
             ]
         }
     }
-    r = requests.post(url, json=payload)
-    return r
+    return tel_send('sendMessage', payload)
 
 
 # Get the Audio response from the bot by providing the URL for the audio
 def tel_send_audio(chat_id):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendAudio'
-
     payload = {
         'chat_id': chat_id,
         "audio": "http://www.largesound.com/ashborytour/sound/brobob.mp3",
     }
-    r = requests.post(url, json=payload)
-    return r
+    return tel_send('sendAudio', payload)
 
 
 # Get the Document response from the bot by providing the URL for the Document
 def tel_send_document(chat_id):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendDocument'
-
     payload = {
         'chat_id': chat_id,
         "document": "http://www.africau.edu/images/default/sample.pdf",
     }
-    r = requests.post(url, json=payload)
-    return r
+    return tel_send('sendDocument', payload)
 
 
 def tel_get_user_photos(user_id, offset=0, limit=1):
-    url = f'https://api.telegram.org/bot{TOKEN}/getUserProfilePhotos'
     payload = {
         'user_id': user_id,
         'offset': offset,
         'limit': limit
     }
-    r = requests.post(url, json=payload)
-    return r
+    return tel_request('getUserProfilePhotos', payload)
 
 def tel_download_file(file_id, file_unique_id):
-    url = f'https://api.telegram.org/file/bot<TOKEN>'
+    url = f'{client.api_url}/file/bot<TOKEN>'
 
     payload = {
         'file_id': file_id,
         'file_unique_id': file_unique_id,
     }
-    r = requests.post(url, json=payload)
-    return r
\ No newline at end of file
+    return client.post(url, payload)
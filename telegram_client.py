@@ -0,0 +1,116 @@
+import asyncio
+import os
+import threading
+
+import aiohttp
+
+# base URL of the Bot API. It can point to a local stand-in server for tests and benchmarks
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+
+# connection pool and timeout settings of the shared session
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 100))
+TELEGRAM_KEEPALIVE_SECS = float(os.environ.get('TELEGRAM_KEEPALIVE_SECS', 60))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 5))
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', 15))
+
+
+class TelegramClient:
+    """
+    Long-lived, pooled HTTP client for the Telegram Bot API.
+
+    The aiohttp session lives on a dedicated event loop running in a daemon thread, so the same keep-alive
+    connections are reused by async code (FastAPI handlers) and by the sync helpers in telegram_aux, which are
+    called from the webhook handlers, the scheduler and worker threads.
+
+    The connections are HTTP/1.1 keep-alive: aiohttp speaks neither HTTP/2 nor pipelining. Requests in flight at
+    the same time use separate pooled connections instead of streams of one, which is enough for the Bot API
+    limits (30 messages per second, so a few dozen connections at most); the handshake per call is what is saved.
+    """
+
+    def __init__(self, token: str, api_url: str = TELEGRAM_API_URL):
+        self.token = token
+        self.api_url = api_url
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        # start the client loop on first use
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name='telegram-client', daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    def method_url(self, method: str) -> str:
+        return f'{self.api_url}/bot{self.token}/{method}'
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # the session must be created inside the client loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=TELEGRAM_POOL_SIZE,
+                                             keepalive_timeout=TELEGRAM_KEEPALIVE_SECS,
+                                             ttl_dns_cache=300)
+            timeout = aiohttp.ClientTimeout(total=TELEGRAM_TIMEOUT, connect=TELEGRAM_CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def _post(self, url: str, payload: dict, timeout: float = None) -> dict:
+        session = await self._get_session()
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout, connect=TELEGRAM_CONNECT_TIMEOUT)
+
+        try:
+            async with session.post(url, json=payload, **kwargs) as response:
+                result = await response.json(content_type=None)
+                if not isinstance(result, dict):
+                    result = {'ok': False, 'error_code': response.status, 'description': str(result)}
+                return result
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # network errors are reported in the same shape as Bot API errors
+            print(f'Error calling the Telegram API: {e!r}')
+            return {'ok': False, 'error_code': None, 'description': repr(e)}
+
+    def submit(self, coro):
+        # schedules a coroutine on the client loop and returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def call_async(self, method: str, payload: dict, timeout: float = None) -> dict:
+        coro = self._post(self.method_url(method), payload, timeout)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self._loop:
+            return await coro
+
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def call(self, method: str, payload: dict, timeout: float = None) -> dict:
+        return self.post(self.method_url(method), payload, timeout)
+
+    def post(self, url: str, payload: dict, timeout: float = None) -> dict:
+        # blocking call, safe from any thread except the client loop itself
+        return self.submit(self._post(url, payload, timeout)).result()
+
+    async def _close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        self.submit(self._close()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+        self._thread = None
+        self._session = None
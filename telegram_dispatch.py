@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import concurrent.futures
+import os
+import time
+
+from telegram_client import TelegramClient
+
+# Bot API limits: about 30 messages per second overall and 1 message per second in a single chat
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_GLOBAL_BURST = float(os.environ.get('TELEGRAM_GLOBAL_BURST', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+
+# retry and queue settings
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 5))
+TELEGRAM_BACKOFF_SECS = float(os.environ.get('TELEGRAM_BACKOFF_SECS', 0.5))
+TELEGRAM_MAX_BACKOFF_SECS = float(os.environ.get('TELEGRAM_MAX_BACKOFF_SECS', 30))
+TELEGRAM_QUEUE_SIZE = int(os.environ.get('TELEGRAM_QUEUE_SIZE', 10000))
+
+
+def is_client_error(result: dict) -> bool:
+    # a 4xx answer other than 429: the request itself is wrong and won't succeed as it is
+    error_code = result.get('error_code')
+    return not result.get('ok') and error_code is not None and 400 <= error_code < 500 and error_code != 429
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations: reserve() returns how long the caller has to wait."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class OutboundDispatcher:
+    """
+    Outbound queue for chat messages.
+
+    Messages are kept in FIFO order per chat and drained by one task per active chat, so the wizard steps always
+    arrive in the order they were sent. Every send first takes a token from the chat bucket and from the global
+    bucket. A 429 answer is retried after the retry_after given by Telegram, network and 5xx errors are retried
+    with exponential backoff. An album rejected with another 4xx (one bad photo URL fails the whole
+    sendMediaGroup) is sent again photo by photo, in its place in the chat queue.
+    """
+
+    def __init__(self, client: TelegramClient,
+                 global_rate: float = TELEGRAM_GLOBAL_RATE, global_burst: float = TELEGRAM_GLOBAL_BURST,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, chat_burst: float = TELEGRAM_CHAT_BURST,
+                 max_retries: int = TELEGRAM_MAX_RETRIES, max_queue: int = TELEGRAM_QUEUE_SIZE):
+        self.client = client
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+
+        # state below is only touched from the client loop
+        self._chats = {}
+        self._buckets = {}
+        self._idle = None
+
+        self.counters = collections.Counter()
+        self.depth = 0
+
+    def enqueue(self, method: str, payload: dict) -> concurrent.futures.Future:
+        # thread-safe; callbacks scheduled from the same thread run in order, which keeps per-chat ordering
+        future = concurrent.futures.Future()
+        self.client.loop.call_soon_threadsafe(self._put, method, payload, future)
+        return future
+
+    async def send(self, method: str, payload: dict) -> dict:
+        return await asyncio.wrap_future(self.enqueue(method, payload))
+
+    def _put(self, method, payload, future):
+        chat_id = payload.get('chat_id')
+        if not isinstance(chat_id, (int, str)):
+            # the chat id keys the per-chat queues; anything else is a caller bug, reported on the future
+            self.counters['rejected_invalid'] += 1
+            print(f'Telegram {method} rejected: chat_id {chat_id!r} is not an id')
+            future.set_exception(TypeError(f'chat_id must be an int or a str, not {type(chat_id).__name__}'))
+            return
+
+        if self.depth >= self.max_queue:
+            self.counters['dropped_queue_full'] += 1
+            future.set_result({'ok': False, 'error_code': None, 'description': 'Outbound queue is full'})
+            return
+
+        # 123 and '123' are the same chat: one queue and one bucket
+        chat_key = str(chat_id)
+        queue = self._chats.get(chat_key)
+        if queue is None:
+            # first pending message for this chat: start its drain task
+            queue = self._chats[chat_key] = collections.deque()
+            asyncio.ensure_future(self._drain_chat(chat_key, queue))
+
+        queue.append((method, payload, future))
+        self.depth += 1
+        self.counters['enqueued'] += 1
+
+    async def _drain_chat(self, chat_id, queue):
+        try:
+            while queue:
+                method, payload, future = queue[0]
+                error = None
+                try:
+                    result = await self._send_with_retries(chat_id, method, payload)
+                    if method == 'sendMediaGroup' and is_client_error(result):
+                        result = await self._send_photos(chat_id, payload, result)
+                except Exception as e:
+                    # a bug or an unserializable payload: it fails this message only, the queue goes on
+                    self.counters['errors'] += 1
+                    print(f'Telegram {method} to {chat_id} raised {e!r}')
+                    error = e
+
+                queue.popleft()
+                self.depth -= 1
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        finally:
+            del self._chats[chat_id]
+            self._prune_buckets()
+            if not self._chats and self._idle is not None:
+                self._idle.set()
+
+    async def _send_photos(self, chat_id, payload, album_result) -> dict:
+        # fallback for a rejected album: the photos that can be sent still reach the chat
+        self.counters['album_fallbacks'] += 1
+        photos = [{'chat_id': payload['chat_id'], 'photo': item['media']} for item in payload.get('media', [])]
+        results = [await self._send_with_retries(chat_id, 'sendPhoto', photo) for photo in photos]
+
+        sent = [result['result'] for result in results if result.get('ok')]
+        if not sent:
+            return album_result
+        return {'ok': True, 'result': sent}
+
+    def _prune_buckets(self, max_buckets: int = 10000):
+        # buckets untouched for long enough are full again and can be recreated on demand
+        if len(self._buckets) <= max_buckets:
+            return
+
+        refill_secs = self.chat_burst / self.chat_rate
+        now = time.monotonic()
+        for chat_id, bucket in list(self._buckets.items()):
+            if now - bucket.updated > refill_secs and chat_id not in self._chats:
+                del self._buckets[chat_id]
+
+    async def _wait_for_tokens(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        delay = max(bucket.reserve(), self.global_bucket.reserve())
+        if delay > 0:
+            self.counters['throttled'] += 1
+            await asyncio.sleep(delay)
+
+    async def _send_with_retries(self, chat_id, method, payload) -> dict:
+        result = {}
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_tokens(chat_id)
+            result = await self.client._post(self.client.method_url(method), payload)
+
+            if result.get('ok'):
+                self.counters['sent'] += 1
+                return result
+
+            error_code = result.get('error_code')
+            if error_code == 429:
+                # Telegram tells us how long to back off; only this chat's queue waits
+                self.counters['rate_limited'] += 1
+                delay = float(result.get('parameters', {}).get('retry_after', 1))
+            elif error_code is None or error_code >= 500:
+                delay = min(TELEGRAM_BACKOFF_SECS * 2 ** attempt, TELEGRAM_MAX_BACKOFF_SECS)
+            else:
+                # other 4xx errors (bad markdown, blocked bot, ...) won't succeed on retry
+                self.counters['failed'] += 1
+                print(f'Telegram {method} to {chat_id} failed: {result.get("description")}')
+                return result
+
+            if attempt < self.max_retries:
+                self.counters['retried'] += 1
+                await asyncio.sleep(delay)
+
+        self.counters['dropped_retries_exhausted'] += 1
+        print(f'Telegram {method} to {chat_id} dropped after {self.max_retries} retries: {result.get("description")}')
+        return result
+
+    async def _wait_idle(self):
+        if self._chats:
+            self._idle = asyncio.Event()
+            await self._idle.wait()
+
+    def drain(self, timeout: float = 10):
+        # blocks until every queued message is sent (or the timeout expires); used at shutdown
+        try:
+            self.client.submit(self._wait_idle()).result(timeout)
+        except concurrent.futures.TimeoutError:
+            print(f'Outbound queue not drained at shutdown; {self.depth} messages pending')
+
+    def stats(self) -> dict:
+        return {'queue_depth': self.depth,
+                'active_chats': len(self._chats),
+                **self.counters}
@@ -0,0 +1,60 @@
+"""
+The app modules read their configuration from the environment when imported, so it is set here, before any test
+module imports them: a throwaway sqlite database and image cache, an unreachable Bot API and no persisted
+sessions.
+"""
+import itertools
+import os
+import statistics
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(), "tests.db")}')
+os.environ.setdefault('TELEGRAM_TOKEN', 'test')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://localhost:9')
+os.environ.setdefault('SESSION_STORE', 'memory')
+os.environ.setdefault('IMAGE_CACHE_DIR', tempfile.mkdtemp())
+
+import pytest
+import sqlalchemy
+from sqlalchemy.ext.compiler import compiles
+
+
+class StdDev:
+    # sqlite has no stddev aggregate; the metrics queries use it
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        return statistics.stdev(self.values) if len(self.values) > 1 else None
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'connect')
+def register_stddev(dbapi_connection, connection_record):
+    if hasattr(dbapi_connection, 'create_aggregate'):
+        dbapi_connection.create_aggregate('stddev', 1, StdDev)
+
+
+@compiles(sqlalchemy.SmallInteger, 'sqlite')
+def compile_smallint(type_, compiler, **kw):
+    # sqlite only autoincrements an INTEGER PRIMARY KEY, and the ids are smallint serials on Postgres
+    return 'INTEGER'
+
+
+_user_ids = itertools.count(1)
+
+
+@pytest.fixture
+def competitor():
+    # a newly registered competitor with the initial balance; returns their user_id
+    import database as db
+
+    user_id = f'test-{os.getpid()}-{next(_user_ids)}'
+    assert db.register_competitor({'user_id': user_id, 'username': user_id, 'fullname': f'Team {user_id}'})
+    return user_id
@@ -0,0 +1,36 @@
+import pytest
+from starlette.testclient import TestClient
+
+import app as bot_app
+import database as db
+
+
+@pytest.fixture
+def client():
+    # no context manager: the startup and shutdown handlers (workers, dispatcher, caches) don't run
+    return TestClient(bot_app.app)
+
+
+def test_unhandled_update_types_are_acknowledged(client):
+    assert client.post('/', json={'update_id': 1, 'my_chat_member': {'chat': {'id': 1}}}).status_code == 200
+    assert client.post('/', json={'update_id': 2, 'edited_message': {'text': '/start'}}).status_code == 200
+    # a body that is not an update at all is still refused
+    assert client.post('/', json={'message': {'text': '/start'}}).status_code == 400
+
+
+def test_refresh_costs_needs_the_admin_token(client, monkeypatch):
+    loads = []
+    monkeypatch.setattr(db, 'load_costs_table', lambda: loads.append(1) or True)
+    monkeypatch.setattr(db, 'costs_table', [])
+
+    monkeypatch.setattr(bot_app, 'ADMIN_TOKEN', '')
+    assert client.post('/refresh_costs', headers={'X-Admin-Token': ''}).status_code == 403
+
+    monkeypatch.setattr(bot_app, 'ADMIN_TOKEN', 's3cret')
+    assert client.get('/refresh_costs', headers={'X-Admin-Token': 's3cret'}).status_code == 405
+    assert client.post('/refresh_costs').status_code == 403
+    assert client.post('/refresh_costs', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+    assert loads == []
+
+    assert client.post('/refresh_costs', headers={'X-Admin-Token': 's3cret'}).status_code == 200
+    assert loads == [1]
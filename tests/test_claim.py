@@ -0,0 +1,75 @@
+import concurrent.futures
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+import database as db
+import db_schema
+from db_schema import tb_submissions
+
+DICT_USER_HP = {'batch_size': '8', 'epochs': '10', 'learning_rate': '0.001', 'batch_norm': 'True', 'filters': '32',
+                'dropout': '0.2', 'image_size': '128'}
+
+
+def submit(user_id: str, due_in_secs: float) -> int:
+    # a free submission whose results are due in due_in_secs (past if negative); returns its id
+    assert db.make_submission(DICT_USER_HP, user_id, user_id, 'CPU', 0, due_in_secs)
+    with db_schema.engine.connect() as conn:
+        return conn.execute(sqlalchemy.select(sqlalchemy.func.max(tb_submissions.c.id)).
+                            where(tb_submissions.c.user_id == user_id)).scalar()
+
+
+def statuses(ids: list) -> dict:
+    with db_schema.engine.connect() as conn:
+        rows = conn.execute(sqlalchemy.select(tb_submissions.c.id, tb_submissions.c.training_status,
+                                              tb_submissions.c.telegram_sent).where(tb_submissions.c.id.in_(ids)))
+        return {row.id: (row.training_status, row.telegram_sent is not None) for row in rows}
+
+
+def test_claims_only_due_submissions_once(competitor):
+    due = [submit(competitor, -60), submit(competitor, -1)]
+    pending = submit(competitor, 3600)
+
+    claimed = db.claim_finished_trainings(competitor)
+
+    assert sorted(row.id for row in claimed) == sorted(due)
+    assert {row.user_id for row in claimed} == {competitor}
+    assert statuses(due + [pending]) == {due[0]: (db_schema.TRAINING_STATUS_NOTIFIED, True),
+                                         due[1]: (db_schema.TRAINING_STATUS_NOTIFIED, True),
+                                         pending: (db_schema.TRAINING_STATUS_TRAINING, False)}
+    # already claimed
+    assert db.claim_finished_trainings(competitor) == []
+
+
+def test_claims_only_the_given_users(competitor):
+    other = f'{competitor}-other'
+    db.register_competitor({'user_id': other})
+    mine, theirs = submit(competitor, -1), submit(other, -1)
+
+    assert [row.id for row in db.claim_finished_trainings(user_ids=[competitor])] == [mine]
+    assert [row.id for row in db.claim_finished_trainings(user_id=other)] == [theirs]
+
+
+def test_concurrent_sweeps_claim_each_submission_once(competitor):
+    ids = {submit(competitor, -1) for _ in range(20)}
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        claims = list(executor.map(lambda _: db.claim_finished_trainings(competitor), range(8)))
+
+    claimed = [row.id for rows in claims for row in rows]
+    assert sorted(claimed) == sorted(ids)
+
+
+def test_claim_skips_rows_locked_by_another_sweep():
+    # on PostgreSQL the due rows are locked, and those locked by a concurrent claim skipped, in the same statement
+    # that moves them to Notified
+    stmt = db.claim_finished_trainings_stmt(user_ids=['1', '2'])
+    sql = ' '.join(str(stmt.compile(dialect=postgresql.dialect())).split())
+
+    assert sql.startswith('UPDATE submissions SET ')
+    assert ('WHERE submissions.id IN (SELECT submissions.id FROM submissions '
+            'WHERE submissions.training_status = %(training_status_1)s AND submissions.telegram_sent IS NULL '
+            'AND submissions.user_id IN (__[POSTCOMPILE_user_id_1]) '
+            'AND submissions.datetime_results_available <= %(datetime_results_available_1)s '
+            'FOR UPDATE SKIP LOCKED) AND submissions.training_status = %(training_status_2)s') in sql
+    assert 'RETURNING submissions.id, submissions.user_id, submissions.chat_id' in sql
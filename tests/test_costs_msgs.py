@@ -0,0 +1,43 @@
+import collections
+import random
+import types
+
+import database as db
+import messages as msgs
+
+CostRow = collections.namedtuple('CostRow', 'gpu_model cost cuda_cores')
+
+COSTS = [CostRow('CPU', 0.5, 64), CostRow('T4', 1.25, 2560), CostRow('A100', 4.1, 6912)]
+
+
+def grid(times: list) -> dict:
+    return {(i,): (time,) + (0.5,) * 7 for i, time in enumerate(times)}
+
+
+def test_prebuilt_messages_match_the_per_gpu_computation(monkeypatch):
+    times = [random.Random(i).uniform(10, 5000) for i in range(50)] + [120.0, 3600.0]
+    monkeypatch.setattr(db, 'metrics_grid', grid(times))
+    monkeypatch.setattr(db, 'load_costs', lambda gpu_model='': COSTS)
+
+    monkeypatch.setattr(msgs, '_costs_msgs', types.MappingProxyType({}))
+    computed = {time: [msgs.create_msg_costs_gpu(time, gpu) for gpu in ('', 'CPU', 'T4', 'A100', 'H100')]
+                for time in times + [0]}
+
+    msgs.build_costs_msgs(COSTS)
+    assert set(msgs._costs_msgs) == set(times) | {0.0}
+    for time, expected in computed.items():
+        assert [msgs.create_msg_costs_gpu(time, gpu) for gpu in ('', 'CPU', 'T4', 'A100', 'H100')] == expected
+
+
+def test_a_costs_reload_swaps_in_new_messages(monkeypatch):
+    monkeypatch.setattr(db, 'metrics_grid', grid([600.0]))
+    monkeypatch.setattr(msgs, '_costs_msgs', types.MappingProxyType({}))
+
+    msgs.build_costs_msgs(COSTS)
+    before = msgs._costs_msgs
+    msgs.build_costs_msgs(COSTS[:1])
+
+    # the old mapping is left whole for the readers still holding it
+    assert len(before[600.0][0][1]) == 3
+    assert msgs.create_msg_costs_gpu(600, '')[1] == ({'text': 'CPU', 'callback_data': 'gpu_model_CPU'},)
+    assert msgs.create_msg_costs_gpu(600, 'CPU')[3] == (round(0.5 / 60 / 60 * (600 * 4000 / 64), 2),)
@@ -0,0 +1,89 @@
+import concurrent.futures
+
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+import database as db
+import db_schema
+from db_schema import tb_balances, tb_submissions
+
+DICT_USER_HP = {'batch_size': '8', 'epochs': '10', 'learning_rate': '0.001', 'batch_norm': 'True', 'filters': '32',
+                'dropout': '0.2', 'image_size': '128'}
+
+
+def submit(user_id: str, cost: float):
+    return db.make_submission(DICT_USER_HP, user_id, user_id, 'CPU', cost, 60)
+
+
+def submitted_costs(user_id: str) -> list:
+    with db_schema.engine.connect() as conn:
+        return [float(cost) for cost in
+                conn.scalars(sqlalchemy.select(tb_submissions.c.cost).where(tb_submissions.c.user_id == user_id))]
+
+
+def test_new_competitor_starts_with_the_initial_balance(competitor):
+    assert db.return_balance_per_user(competitor) == db.INITIAL_BALANCE
+    # registering again changes nothing
+    assert not db.register_competitor({'user_id': competitor})
+    assert db.return_balance_per_user(competitor) == db.INITIAL_BALANCE
+
+
+def test_submission_debits_the_rounded_cost(competitor):
+    assert submit(competitor, 1.2345)
+    assert submit(competitor, 2.3456)
+
+    costs = sorted(submitted_costs(competitor))
+    assert costs == [1.23, 2.35]
+    # the ledger and the submissions agree
+    assert db.return_balance_per_user(competitor) == round(db.INITIAL_BALANCE - sum(costs), 2)
+
+
+def test_insufficient_balance_debits_and_inserts_nothing(competitor):
+    assert submit(competitor, db.INITIAL_BALANCE - 1)
+
+    with pytest.raises(db.InsufficientBalance):
+        submit(competitor, 1.01)
+
+    assert submitted_costs(competitor) == [db.INITIAL_BALANCE - 1]
+    assert db.return_balance_per_user(competitor) == 1
+    # the exact balance can still be spent
+    assert submit(competitor, 1)
+    assert db.return_balance_per_user(competitor) == 0
+
+
+def test_concurrent_submissions_cannot_overspend(competitor):
+    cost = db.INITIAL_BALANCE / 4
+
+    def attempt(_):
+        try:
+            return bool(submit(competitor, cost))
+        except db.InsufficientBalance:
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(attempt, range(10)))
+
+    assert results.count(True) == 4
+    assert len(submitted_costs(competitor)) == 4
+    assert db.return_balance_per_user(competitor) == 0
+
+
+def test_competitor_from_before_the_ledger(competitor):
+    # no balance row, and 3 already spent: the row is created from the submissions on the first debit
+    with db_schema.engine.begin() as conn:
+        conn.execute(tb_balances.delete().where(tb_balances.c.user_id == competitor))
+    assert submit(competitor, 3)
+    with db_schema.engine.begin() as conn:
+        conn.execute(tb_balances.delete().where(tb_balances.c.user_id == competitor))
+
+    assert submit(competitor, 2)
+    assert db.return_balance_per_user(competitor) == db.INITIAL_BALANCE - 5
+
+
+def test_debit_is_a_single_conditional_update():
+    sql = str(db.debit_balance_stmt('1', 2.5).compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith('UPDATE balances SET balance=(balances.balance - CAST(')
+    assert 'WHERE balances.user_id = %(user_id_1)s AND balances.balance >= CAST(' in sql
+    assert sql.endswith('RETURNING balances.balance')
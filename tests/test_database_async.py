@@ -0,0 +1,31 @@
+import asyncio
+
+import database as db
+import database_async as dba
+from test_database import DICT_USER_HP
+
+
+def test_registration_costs_one_round_trip_per_competitor(monkeypatch):
+    calls = []
+    register = db.register_competitor
+    monkeypatch.setattr(db, 'register_competitor', lambda dict_msg: calls.append(dict_msg) or register(dict_msg))
+    dict_msg = {'user_id': 'async-registration', 'username': 'async', 'fullname': 'Async Team'}
+
+    async def main():
+        return [await dba.register_competitor(dict_msg) for _ in range(3)]
+
+    # new the first time, then known without asking the database again
+    assert asyncio.run(main()) == [True, False, False]
+    assert len(calls) == 1
+    assert db.return_balance_per_user('async-registration') == db.INITIAL_BALANCE
+
+
+def test_submission_and_balance_match_the_sync_layer(competitor):
+    async def main():
+        submitted = await dba.make_submission(DICT_USER_HP, competitor, competitor, 'CPU', 2.345, 60)
+        return submitted, await dba.return_balance_per_user(competitor)
+
+    submitted, balance = asyncio.run(main())
+
+    assert submitted
+    assert balance == db.return_balance_per_user(competitor) == round(db.INITIAL_BALANCE - 2.35, 2)
@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+import itertools
+
+import pytest
+import sqlalchemy
+
+import db_schema
+import dedup
+from db_schema import tb_updates
+from dedup import SQLUpdateStore, UpdateDeduplicator
+
+# update ids unique to each test, as the processed_updates table is shared by the test session
+_update_ids = itertools.count(10 ** 9, 1000)
+
+
+@pytest.fixture
+def update_ids():
+    return iter(range(next(_update_ids), 10 ** 12))
+
+
+def test_claim_once_and_release(update_ids):
+    deduplicator = UpdateDeduplicator()
+    first, second = next(update_ids), next(update_ids)
+
+    assert deduplicator.claim(first)
+    assert not deduplicator.claim(first)
+    assert deduplicator.claim(second)
+
+    # a released update is processed when Telegram redelivers it
+    deduplicator.release(first)
+    assert deduplicator.claim(first)
+    assert not deduplicator.claim(first)
+
+    assert deduplicator.stats()['accepted'] == 3
+    assert deduplicator.stats()['duplicates'] == 2
+    assert deduplicator.stats()['released'] == 1
+
+
+def test_window_and_size_bounds(monkeypatch, update_ids):
+    clock = [1000.0]
+    monkeypatch.setattr(dedup.time, 'monotonic', lambda: clock[0])
+    deduplicator = UpdateDeduplicator(window=60, max_entries=3)
+    ids = [next(update_ids) for _ in range(4)]
+
+    assert deduplicator.claim(ids[0])
+    clock[0] += 61
+    # expired: a redelivery this late is processed again
+    assert deduplicator.claim(ids[0])
+
+    for update_id in ids[1:]:
+        assert deduplicator.claim(update_id)
+    # the oldest id made room for the newest
+    assert deduplicator.claim(ids[0])
+    assert not deduplicator.claim(ids[3])
+
+
+def test_claim_async_without_backend(update_ids):
+    deduplicator = UpdateDeduplicator()
+    update_id = next(update_ids)
+
+    assert asyncio.run(deduplicator.claim_async(update_id))
+    assert not asyncio.run(deduplicator.claim_async(update_id))
+
+
+def test_shared_store_drops_redeliveries_to_another_worker(update_ids):
+    store = SQLUpdateStore(db_schema.engine)
+    worker_a, worker_b = UpdateDeduplicator(store), UpdateDeduplicator(store)
+    update_id = next(update_ids)
+
+    assert worker_a.claim(update_id)
+    assert not worker_b.claim(update_id)
+    assert asyncio.run(worker_b.claim_async(update_id)) is False
+
+    # released on worker a, the redelivery is processed by whichever worker gets it
+    worker_a.release(update_id)
+    other = UpdateDeduplicator(store)
+    assert other.claim(update_id)
+    assert not worker_a.claim(update_id)
+
+
+def test_shared_store_prunes_expired_ids(update_ids):
+    store = SQLUpdateStore(db_schema.engine, window=60, prune_every=2)
+    old, new = next(update_ids), next(update_ids)
+
+    assert store.claim(old)
+    with db_schema.engine.begin() as conn:
+        conn.execute(tb_updates.update().where(tb_updates.c.update_id == old).
+                     values(received=datetime.datetime.now() - datetime.timedelta(seconds=61)))
+    # the second claim prunes
+    assert store.claim(new)
+
+    with db_schema.engine.connect() as conn:
+        kept = set(conn.scalars(sqlalchemy.select(tb_updates.c.update_id).
+                                where(tb_updates.c.update_id.in_([old, new]))))
+    assert kept == {new}
+
+
+def test_unavailable_store_accepts_the_update(update_ids):
+    class DownStore:
+        def claim(self, update_id):
+            raise OSError('database is down')
+
+    deduplicator = UpdateDeduplicator(DownStore())
+    update_id = next(update_ids)
+
+    # better to process an update twice than to lose it; the local check still drops redeliveries
+    assert deduplicator.claim(update_id)
+    assert not deduplicator.claim(update_id)
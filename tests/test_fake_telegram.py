@@ -0,0 +1,68 @@
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_telegram import FakeTelegram
+
+
+def run(test):
+    async def main():
+        client = TestClient(TestServer(FakeTelegram().app()))
+        await client.start_server()
+        try:
+            return await test(client)
+        finally:
+            await client.close()
+
+    return asyncio.run(main())
+
+
+async def get_updates(client: TestClient, **payload) -> list:
+    response = await client.post('/bottest/getUpdates', json=payload)
+    return (await response.json())['result']
+
+
+def test_updates_are_served_until_the_offset_confirms_them():
+    async def test(client):
+        await client.post('/updates', json=[{'message': {'text': str(i)}} for i in range(3)])
+
+        first = await get_updates(client, limit=2)
+        again = await get_updates(client, limit=2)
+        rest = await get_updates(client, offset=first[-1]['update_id'] + 1)
+        stats = await (await client.get('/stats')).json()
+        return first, again, rest, stats
+
+    first, again, rest, stats = run(test)
+
+    assert [update['update_id'] for update in first] == [1, 2]
+    assert again == first
+    assert [update['message']['text'] for update in rest] == ['2']
+    assert (stats['updates_queued'], stats['updates_pending'], stats['updates_confirmed']) == (3, 1, 2)
+    # the polls are not counted as replies
+    assert stats['total'] == 0
+
+
+def test_get_updates_long_polls():
+    async def test(client):
+        started = time.monotonic()
+        assert await get_updates(client, timeout=0.1) == []
+        waited = time.monotonic() - started
+
+        # a waiting poll returns as soon as an update is queued
+        poll = asyncio.ensure_future(get_updates(client, timeout=10))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await client.post('/updates', json={'update_id': 42, 'message': {'text': '/start'}})
+        updates = await poll
+        return waited, time.monotonic() - started, updates
+
+    waited, woken, updates = run(test)
+
+    assert waited >= 0.1
+    assert woken < 1
+    assert [update['update_id'] for update in updates] == [42]
@@ -0,0 +1,42 @@
+import random
+
+import pytest
+
+from leaderboard import format_table
+
+pd = pytest.importorskip('pandas')
+
+COLUMNS = ['🏆', 'Team', '🎯', 'Entries', '🕰️ Last', 'Spent 💰']
+
+
+def pandas_table(columns: list, rows: list) -> str:
+    # what show_leaderboard sent before the leaderboard moved off pandas
+    return pd.DataFrame(rows, columns=columns).to_string(index=False)
+
+
+@pytest.mark.parametrize('rows', [
+    [[1, 'Team Ada', 0.812345678, 12, '2h', 37.5],
+     [2, 'B', 0.8, 3, 'Now', 4.25],
+     [3, 'The Longest Team Name Here', 0.79, 101, '11mo', 120.0]],
+    [[1, 'Solo', 0.5, 1, '5min', 1.0]],
+    [[1, 'A', 0.9, 2, '1d', 0.01], [2, 'B', None, 1, '3d', 2.0]],
+    [[1, 'A', 1.0, 2, '1y', 10.0], [2, 'B', 0.25, 10, '12mo', 0.125]],
+    [[1, 'Ünïcode ✨', 0.6667, 7, '59min', 3.333333333]],
+], ids=['top3', 'single', 'missing score', 'trailing zeros', 'unicode'])
+def test_matches_pandas(rows):
+    assert format_table(COLUMNS, rows) == pandas_table(COLUMNS, rows)
+
+
+def test_matches_pandas_on_random_boards():
+    rng = random.Random(11)
+    labels = ['Now', '1min', '59min', '2h', '1d', '30d', '1mo', '11mo', '1y', '12y']
+    for _ in range(200):
+        rows = [[position,
+                 ''.join(rng.choices('abcdefghij XYZ', k=rng.randint(1, 30))).strip() or 'x',
+                 round(rng.random(), rng.randint(1, 9)),
+                 rng.randint(1, 500),
+                 rng.choice(labels),
+                 round(rng.uniform(0, 1000), rng.randint(0, 4))]
+                for position in range(1, rng.randint(1, 10) + 1)]
+
+        assert format_table(COLUMNS, rows) == pandas_table(COLUMNS, rows)
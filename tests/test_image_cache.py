@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import db_schema
+from image_cache import ImageCache, is_bucket_url
+
+
+def test_overwritten_entries_are_counted_once(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1000)
+
+    cache.put('a', b'x' * 100)
+    cache.put('a', b'x' * 300)
+    cache.put('b', b'x' * 50)
+
+    assert cache.total_bytes == 350
+    assert cache.total_bytes == sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+
+
+def test_eviction_keeps_the_cache_within_budget(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1000)
+    for i in range(12):
+        cache.put(str(i), b'x' * 100)
+        # distinct mtimes, oldest first
+        os.utime(cache.path(str(i)), (i, i))
+
+    assert cache.total_bytes <= 1000
+    assert cache.total_bytes == sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+    # the least recently used entries went first
+    assert cache.lookup('0') is None
+    assert cache.lookup('11') is not None
+
+
+@pytest.mark.parametrize('url', [
+    db_schema.BUCKET_URL + '0_10_0.001_True_32_0.2_128_8_sample.png',
+    db_schema.BUCKET_URL + 'nested/figure.png?generation=1',
+])
+def test_bucket_urls_are_allowed(url):
+    assert is_bucket_url(url)
+
+
+@pytest.mark.parametrize('url', [
+    'https://example.com/image.png',
+    'http://storage.googleapis.com/siim_23_bot/figure.png',
+    'https://storage.googleapis.com/other_bucket/figure.png',
+    'https://storage.googleapis.com/siim_23_bot_other/figure.png',
+    'https://storage.googleapis.com/siim_23_bot/../other_bucket/figure.png',
+    'https://storage.googleapis.com/siim_23_bot/%2e%2e/other_bucket/figure.png',
+    'https://storage.googleapis.com@example.com/siim_23_bot/figure.png',
+    'https://storage.googleapis.com/siim_23_bot',
+    'file:///etc/passwd',
+    '',
+])
+def test_other_urls_are_refused(url):
+    assert not is_bucket_url(url)
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from fastapi import HTTPException
+
+import image_lib
+
+IMAGE = b'\x89PNG' + b'x' * 1000
+
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_get('/{name}', handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await image_lib.close_session()
+
+    return asyncio.run(main())
+
+
+def test_downloads_reuse_the_session_and_its_connections():
+    peers = []
+
+    async def handler(request):
+        # the client side of the connection: the same one when it is reused
+        peers.append(request.transport.get_extra_info('peername'))
+        return web.Response(body=IMAGE)
+
+    async def main():
+        server = await serve(handler)
+        try:
+            session = await image_lib.get_session()
+            images = [await image_lib.download_image(str(server.make_url(f'/{i}.png'))) for i in range(3)]
+            return session, await image_lib.get_session(), images
+        finally:
+            await server.close()
+
+    first, last, images = run(main())
+
+    assert first is last
+    assert images == [IMAGE] * 3
+    assert len(set(peers)) == 1
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_oversized_images_are_rejected(chunked):
+    async def handler(request):
+        if not chunked:
+            return web.Response(body=IMAGE)
+
+        # no Content-Length: the cap applies while the body streams in
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for _ in range(10):
+            await response.write(IMAGE)
+        return response
+
+    async def main():
+        server = await serve(handler)
+        try:
+            with pytest.raises(HTTPException) as error:
+                await image_lib.download_image(str(server.make_url('/big.png')), max_bytes=len(IMAGE) - 1)
+            return error.value.status_code
+        finally:
+            await server.close()
+
+    assert run(main()) == 413
+
+
+def test_missing_image():
+    async def handler(request):
+        return web.Response(status=404)
+
+    async def main():
+        server = await serve(handler)
+        try:
+            with pytest.raises(HTTPException) as error:
+                await image_lib.download_image(str(server.make_url('/missing.png')))
+            return error.value.status_code
+        finally:
+            await server.close()
+
+    assert run(main()) == 404
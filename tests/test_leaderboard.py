@@ -0,0 +1,117 @@
+import datetime
+
+import pytest
+
+import database as db
+import leaderboard as lb
+import messages as msgs
+
+DICT_USER_HP = {'batch_size': '8', 'epochs': '10', 'learning_rate': '0.001', 'batch_norm': 'True', 'filters': '32',
+                'dropout': '0.2', 'image_size': '128'}
+
+
+def finish_submission(user_id: str, cost: float = 1) -> list:
+    # a submission whose results are due, claimed as the notifier does; returns the claimed rows
+    assert db.make_submission(DICT_USER_HP, user_id, user_id, 'CPU', cost, -1)
+    return db.claim_finished_trainings(user_id)
+
+
+def entry(board: lb.Leaderboard, user_id: str) -> dict:
+    position = board.position(user_id)
+    return board.rows()[position - 1] if position else None
+
+
+@pytest.fixture
+def board(monkeypatch):
+    monkeypatch.setattr(lb, 'LEADERBOARD_RESYNC_SECS', 0)
+    board = lb.Leaderboard()
+    board.start()
+    return board
+
+
+def test_apply_counts_each_submission_once(board, competitor):
+    first = finish_submission(competitor)
+    board.apply(first)
+    assert entry(board, competitor)['entries'] == 1
+
+    second = finish_submission(competitor, cost=2)
+    board.apply(second)
+    board.apply(second)
+    board.apply(first + second)
+    assert entry(board, competitor)['entries'] == 2
+    assert entry(board, competitor)['sum_costs'] == 3
+
+
+def test_resync_before_apply_does_not_double_count(board, competitor):
+    board.apply(finish_submission(competitor))
+
+    # claimed and committed, then a resync reads it before the notifier applies it
+    claimed = finish_submission(competitor, cost=2)
+    assert board.load()
+    assert entry(board, competitor)['entries'] == 2
+    board.apply(claimed)
+
+    assert entry(board, competitor)['entries'] == 2
+    assert entry(board, competitor)['sum_costs'] == 3
+
+
+def test_apply_during_resync_is_kept(board, competitor, monkeypatch):
+    board.apply(finish_submission(competitor))
+    snapshot = db.get_leaderboard_snapshot
+
+    def snapshot_then_claim(user_id=None):
+        # a submission claimed and applied after the reload read the database, before it installs the result
+        result = snapshot(user_id)
+        board.apply(finish_submission(competitor, cost=2))
+        return result
+
+    monkeypatch.setattr(db, 'get_leaderboard_snapshot', snapshot_then_claim)
+    assert board.load()
+
+    assert entry(board, competitor)['entries'] == 2
+    assert entry(board, competitor)['sum_costs'] == 3
+
+
+def test_ranking_and_publish(board, competitor, monkeypatch):
+    published = []
+    monkeypatch.setattr(lb.broadcaster, 'publish', lambda event, data: published.append((event, data)))
+    rows = finish_submission(competitor)
+    score = rows[0].metrics_test_set
+
+    board.apply(rows)
+    assert entry(board, competitor)['score'] == score
+    assert published[-1][0] == 'full'
+    # an applied submission that changes nothing pushes nothing more
+    board.apply(rows)
+    assert len(published) == 1
+
+
+NOWS = [datetime.datetime(2024, 2, 29, 12, 0, 0, 5), datetime.datetime(2023, 12, 31, 23, 59, 59, 999999),
+        datetime.datetime(2024, 3, 31, 8, 15, 30, 250000)]
+ELAPSED = [datetime.timedelta(seconds=0), datetime.timedelta(seconds=59, microseconds=999999),
+           datetime.timedelta(minutes=1), datetime.timedelta(minutes=59, seconds=30), datetime.timedelta(hours=1),
+           datetime.timedelta(hours=23, minutes=59, seconds=59), datetime.timedelta(days=1, seconds=1),
+           datetime.timedelta(days=29, hours=23), datetime.timedelta(days=31), datetime.timedelta(days=45),
+           datetime.timedelta(days=364), datetime.timedelta(days=366), datetime.timedelta(days=800)]
+
+
+@pytest.mark.parametrize('now', NOWS, ids=str)
+@pytest.mark.parametrize('elapsed', ELAPSED, ids=str)
+def test_label_expiry(now, elapsed):
+    pytest.importorskip('numpy')
+    microsecond = datetime.timedelta(microseconds=1)
+    timestamp = now - elapsed
+    expiry = lb.label_expiry(timestamp, now)
+
+    def label(at):
+        return msgs.calculate_times_ago([timestamp], at)[0]
+
+    assert expiry > now
+    # the label holds until the expiry (labels only move forward, so checking the ends is enough)
+    assert label(expiry - microsecond) == label(now)
+    if elapsed < datetime.timedelta(days=1):
+        # below a day the expiry is exact: the label changes right then
+        assert label(expiry) != label(now)
+    else:
+        # month and year labels are rechecked daily
+        assert expiry - now <= datetime.timedelta(days=1)
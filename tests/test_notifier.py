@@ -0,0 +1,76 @@
+import datetime
+import time
+
+import database as db
+import messages
+import notifier
+from test_claim import submit
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def queued(dispatcher, user_id: str) -> int:
+    return [entry[2] for entry in dispatcher._heap].count(user_id)
+
+
+def test_rescan_picks_up_trainings_of_other_processes(competitor, monkeypatch):
+    notified = []
+
+    def notify_finished_trainings(base_url=None, user_ids=None):
+        claimed = db.claim_finished_trainings(user_ids=user_ids)
+        notified.extend(row.user_id for row in claimed)
+        return len(claimed)
+
+    monkeypatch.setattr(messages, 'notify_finished_trainings', notify_finished_trainings)
+    dispatcher = notifier.NotificationDispatcher(rescan_secs=0.05)
+    dispatcher.start()
+    try:
+        # submitted by another process: not scheduled in this one
+        submit(competitor, -1)
+        wait_for(lambda: competitor in notified)
+        time.sleep(0.2)
+    finally:
+        dispatcher.stop()
+
+    assert notified.count(competitor) == 1
+    # later rescans don't queue it again
+    assert queued(dispatcher, competitor) == 0
+
+
+def test_rescan_does_not_queue_a_deadline_twice(competitor):
+    submit(competitor, 3600)
+    dispatcher = notifier.NotificationDispatcher()
+
+    assert dispatcher.load() and dispatcher.load()
+    assert queued(dispatcher, competitor) == 1
+
+
+def test_failed_notifications_are_retried_with_backoff(competitor, monkeypatch):
+    attempts = []
+
+    def notify_finished_trainings(base_url=None, user_ids=None):
+        if competitor not in user_ids:
+            return 0
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise RuntimeError('claim failed')
+        return 1
+
+    monkeypatch.setattr(messages, 'notify_finished_trainings', notify_finished_trainings)
+    dispatcher = notifier.NotificationDispatcher(rescan_secs=3600, retry_secs=0.05, retry_max_secs=1)
+    dispatcher.start()
+    try:
+        dispatcher.schedule(competitor, datetime.datetime.now())
+        wait_for(lambda: dispatcher.counters['notified'] == 1)
+    finally:
+        dispatcher.stop()
+
+    assert dispatcher.counters['failed'] == 2
+    assert dispatcher.counters['retried'] == 2
+    assert attempts[2] - attempts[1] > attempts[1] - attempts[0] >= 0.05
+    assert queued(dispatcher, competitor) == 0
@@ -0,0 +1,42 @@
+import poller
+import updates
+
+CONFLICT = {'ok': False, 'error_code': 409,
+            'description': "Conflict: can't use getUpdates method while webhook is active"}
+
+
+class FakeClient:
+    def __init__(self, results: list, poller_to_stop: poller.UpdatePoller = None):
+        self.results = results
+        self.poller_to_stop = poller_to_stop
+        self.methods = []
+
+    def call(self, method: str, payload: dict, timeout: float = None) -> dict:
+        self.methods.append(method)
+        if not self.results and self.poller_to_stop is not None:
+            self.poller_to_stop.stop()
+        return self.results.pop(0) if self.results else {'ok': True, 'result': []}
+
+
+def test_webhook_conflict_waits_instead_of_exiting(monkeypatch):
+    update_poller = poller.UpdatePoller(updates.handle_update, timeout=0)
+    fake = FakeClient([CONFLICT, CONFLICT, {'ok': True, 'result': []}], update_poller)
+    monkeypatch.setattr(poller, 'client', fake)
+    monkeypatch.setattr(poller, 'POLL_CONFLICT_SECS', 0.01)
+
+    update_poller.run()
+    update_poller.close()
+
+    # kept polling past the conflicts, until stopped
+    assert fake.methods == ['getUpdates'] * 4
+
+
+def test_webhook_conflict_ends_a_drain(monkeypatch):
+    fake = FakeClient([CONFLICT])
+    monkeypatch.setattr(poller, 'client', fake)
+    update_poller = poller.UpdatePoller(updates.handle_update, timeout=0)
+
+    update_poller.run(drain=True)
+    update_poller.close()
+
+    assert fake.methods == ['getUpdates']
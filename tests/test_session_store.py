@@ -0,0 +1,161 @@
+import threading
+import time
+
+import pytest
+
+import session_store
+from session_store import MemorySessionStore, SessionStore
+
+
+class DictStore(SessionStore):
+    """Backing store in a dict, that checks it is never written with the memory store's lock held."""
+
+    def __init__(self, memory_store: MemorySessionStore = None):
+        self.data = {}
+        self.saves = []
+        self.memory_store = memory_store
+        self.fail = 0
+        self.block = None
+
+    def load(self, user_id: str) -> dict:
+        return dict(self.data.get(user_id, {}))
+
+    def save(self, user_id: str, data: dict):
+        assert not self.memory_store._lock.locked()
+        if self.block is not None:
+            self.block.wait(5)
+        if self.fail:
+            self.fail -= 1
+            raise OSError('backing store is down')
+        self.saves.append(user_id)
+        self.data[user_id] = dict(data)
+
+
+def memory_store(max_entries: int = 2, ttl: float = 3600) -> MemorySessionStore:
+    backing = DictStore()
+    # flush only when the test asks
+    store = MemorySessionStore(backing, ttl=ttl, max_entries=max_entries, flush_secs=3600)
+    backing.memory_store = store
+    return store
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_lru_eviction_without_backing():
+    store = MemorySessionStore(None, max_entries=2)
+    store.save('a', {'epochs': '10'})
+    store.save('b', {'epochs': '20'})
+    # reading a makes b the least recently used
+    assert store.load('a') == {'epochs': '10'}
+    store.save('c', {'epochs': '30'})
+
+    assert store.load('a') == {'epochs': '10'}
+    assert store.load('c') == {'epochs': '30'}
+    assert store.load('b') == {}
+
+
+def test_idle_entries_expire(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(session_store.time, 'monotonic', lambda: clock[0])
+    store = MemorySessionStore(None, ttl=60, max_entries=10)
+    store.save('a', {'epochs': '10'})
+
+    clock[0] += 30
+    assert store.load('a') == {'epochs': '10'}
+    # the read refreshed it
+    clock[0] += 59
+    assert store.load('a') == {'epochs': '10'}
+    clock[0] += 61
+    assert store.load('a') == {}
+
+
+def test_evicted_dirty_entries_are_written_back_outside_the_lock():
+    store = memory_store()
+    store.save('a', {'epochs': '10'})
+    store.save('b', {'epochs': '20'})
+    store.save('c', {'epochs': '30'})
+
+    assert store.backing.saves == ['a']
+    assert store.load('a') == {'epochs': '10'}
+
+    store.close()
+    assert store.backing.data == {'a': {'epochs': '10'}, 'b': {'epochs': '20'}, 'c': {'epochs': '30'}}
+
+
+def test_clean_entries_are_not_written_on_eviction():
+    store = memory_store()
+    store.save('a', {'epochs': '10'})
+    store.flush()
+    store.save('b', {'epochs': '20'})
+    store.save('c', {'epochs': '30'})
+
+    assert store.backing.saves == ['a']
+    store.close()
+
+
+def test_failed_write_back_keeps_the_entry_for_the_flusher():
+    store = memory_store()
+    store.save('a', {'epochs': '10'})
+    store.save('b', {'epochs': '20'})
+    store.backing.fail = 1
+    store.save('c', {'epochs': '30'})
+
+    assert 'a' not in store.backing.data
+    assert store.load('a') == {'epochs': '10'}
+
+    store.flush()
+    assert store.backing.data['a'] == {'epochs': '10'}
+    store.close()
+
+
+def dirty_a_then_clean_b(store: MemorySessionStore):
+    # a is the least recently used entry and the only dirty one, so the next new entry evicts a and nothing else
+    store.save('a', {'epochs': 'stale'})
+    store.save('b', {'epochs': '20'})
+    store.flush()
+    store.save('a', {'epochs': '10'})
+    store.load('b')
+
+
+def wait_for_write_back(store: MemorySessionStore, user_id: str):
+    deadline = time.monotonic() + 5
+    while user_id not in store._evicting and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def test_load_during_write_back_sees_the_evicted_value():
+    store = memory_store()
+    dirty_a_then_clean_b(store)
+
+    # the write back of a is stuck in the backing store while a is read again
+    store.backing.block = threading.Event()
+    evicting = threading.Thread(target=store.save, args=('c', {'epochs': '30'}))
+    evicting.start()
+    wait_for_write_back(store, 'a')
+    try:
+        assert store.load('a') == {'epochs': '10'}
+    finally:
+        store.backing.block.set()
+        evicting.join()
+
+    assert store.backing.data['a'] == {'epochs': '10'}
+    store.close()
+
+
+def test_save_supersedes_a_pending_write_back():
+    store = memory_store()
+    dirty_a_then_clean_b(store)
+
+    store.backing.block = threading.Event()
+    evicting = threading.Thread(target=store.save, args=('c', {'epochs': '30'}))
+    evicting.start()
+    wait_for_write_back(store, 'a')
+    store.save('a', {'epochs': '40'})
+    store.backing.block.set()
+    evicting.join()
+
+    store.close()
+    assert store.backing.data['a'] == {'epochs': '40'}
@@ -0,0 +1,216 @@
+import asyncio
+import random
+import threading
+import time
+
+import pytest
+
+import telegram_dispatch
+from telegram_dispatch import OutboundDispatcher, TokenBucket
+
+
+class FakeClient:
+    """The parts of TelegramClient the dispatcher uses, answering from a list of canned results (or exceptions)."""
+
+    def __init__(self, results: list = None, latency: float = 0.002):
+        self.results = list(results or [])
+        self.latency = latency
+        self.calls = []
+        # cleared to hold every call until it is set again
+        self.open = threading.Event()
+        self.open.set()
+        self.random = random.Random(3)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def method_url(self, method: str) -> str:
+        return method
+
+    async def _post(self, url: str, payload: dict) -> dict:
+        while not self.open.is_set():
+            await asyncio.sleep(0.001)
+        # varying latency, so the chats overtake each other
+        await asyncio.sleep(self.random.uniform(0, self.latency))
+        self.calls.append((time.monotonic(), url, payload))
+        if self.results:
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return {'ok': True, 'result': True}
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+@pytest.fixture
+def client():
+    client = FakeClient()
+    yield client
+    client.close()
+
+
+def test_token_bucket_bursts_then_paces(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(telegram_dispatch.time, 'monotonic', lambda: clock[0])
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    # the burst is free, then each reservation waits half a second more than the previous one
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert [bucket.reserve() for _ in range(3)] == [0.5, 1.0, 1.5]
+
+    # after the waits, and 1 s for 2 tokens of refill, the next reservation is free again
+    clock[0] += 1.5 + 1
+    assert bucket.reserve() == 0
+    # refill never exceeds the capacity
+    clock[0] += 60
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_each_chat_keeps_its_order(client):
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    futures = [dispatcher.enqueue('sendMessage', {'chat_id': chat_id, 'text': str(i)})
+               for i in range(20) for chat_id in (1, 2, 3, 'me')]
+    assert all(future.result(5)['ok'] for future in futures)
+
+    for chat_id in (1, 2, 3, 'me'):
+        texts = [payload['text'] for _, _, payload in client.calls if payload['chat_id'] == chat_id]
+        assert texts == [str(i) for i in range(20)]
+    assert dispatcher.stats()['sent'] == 80
+    assert dispatcher.stats()['queue_depth'] == 0
+
+
+def test_chat_rate_limit(client):
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=20, chat_burst=1)
+
+    started = time.monotonic()
+    futures = [dispatcher.enqueue('sendMessage', {'chat_id': 1, 'text': str(i)}) for i in range(5)]
+    other = dispatcher.enqueue('sendMessage', {'chat_id': 2, 'text': 'x'})
+
+    other.result(5)
+    # another chat is not held back by chat 1's bucket
+    assert time.monotonic() - started < 0.15
+
+    [future.result(5) for future in futures]
+    sent = [sent_at for sent_at, _, payload in client.calls if payload['chat_id'] == 1]
+    gaps = [later - earlier for earlier, later in zip(sent, sent[1:])]
+    # one message per 50 ms after the burst of one (the bucket schedules ahead, so allow for the loop's jitter)
+    assert sum(gaps) >= 4 * 0.05 - 0.01
+
+
+def test_rate_limited_message_is_retried_in_place(client, monkeypatch):
+    monkeypatch.setattr(telegram_dispatch, 'TELEGRAM_BACKOFF_SECS', 0.001)
+    client.results = [{'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.01}},
+                      {'ok': False, 'error_code': 502}]
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    futures = [dispatcher.enqueue('sendMessage', {'chat_id': 7, 'text': str(i)}) for i in range(3)]
+    assert all(future.result(5)['ok'] for future in futures)
+
+    # the first message was sent three times, and the others still went out after it
+    assert [payload['text'] for _, _, payload in client.calls] == ['0', '0', '0', '1', '2']
+    assert dispatcher.stats()['rate_limited'] == 1
+    assert dispatcher.stats()['retried'] == 2
+
+
+def test_client_errors_are_not_retried(client):
+    client.results = [{'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}]
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    assert dispatcher.enqueue('sendMessage', {'chat_id': 7, 'text': 'x'}).result(5)['error_code'] == 403
+    assert len(client.calls) == 1
+    assert dispatcher.stats()['failed'] == 1
+
+
+def test_invalid_chat_id_fails_the_future(client):
+    dispatcher = OutboundDispatcher(client)
+
+    future = dispatcher.enqueue('sendMessage', {'chat_id': {'chat_id': 1, 'txt': 'list_competitors'}, 'text': 'x'})
+    with pytest.raises(TypeError):
+        future.result(5)
+
+    # the dispatcher keeps working
+    assert dispatcher.enqueue('sendMessage', {'chat_id': 1, 'text': 'x'}).result(5)['ok']
+    assert dispatcher.stats()['rejected_invalid'] == 1
+
+
+def test_full_queue_drops(client):
+    dispatcher = OutboundDispatcher(client, chat_rate=1000, chat_burst=1000, max_queue=2)
+
+    client.open.clear()
+    futures = [dispatcher.enqueue('sendMessage', {'chat_id': 1, 'text': str(i)}) for i in range(3)]
+    futures[2].result(5)
+    client.open.set()
+    results = [future.result(5) for future in futures]
+
+    assert [result['ok'] for result in results] == [True, True, False]
+    assert dispatcher.stats()['dropped_queue_full'] == 1
+
+
+def test_rejected_album_is_sent_photo_by_photo(client):
+    client.results = [{'ok': False, 'error_code': 400, 'description': 'Bad Request: wrong file identifier/HTTP URL'},
+                      {'ok': True, 'result': {'message_id': 1}},
+                      {'ok': False, 'error_code': 400, 'description': 'Bad Request: wrong file identifier/HTTP URL'},
+                      {'ok': True, 'result': {'message_id': 2}}]
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    album = dispatcher.enqueue('sendMediaGroup', {'chat_id': 7, 'media': [{'type': 'photo', 'media': url}
+                                                                          for url in ('a', 'b', 'c')]})
+    after = dispatcher.enqueue('sendMessage', {'chat_id': 7, 'text': 'Select your option:'})
+
+    # the bad photo is skipped, the others are sent, and the chat order is kept
+    assert album.result(5) == {'ok': True, 'result': [{'message_id': 1}, {'message_id': 2}]}
+    assert after.result(5)['ok']
+    assert [(method, payload.get('photo')) for _, method, payload in client.calls] == \
+           [('sendMediaGroup', None), ('sendPhoto', 'a'), ('sendPhoto', 'b'), ('sendPhoto', 'c'), ('sendMessage', None)]
+    assert dispatcher.stats()['album_fallbacks'] == 1
+
+
+def test_rate_limited_album_is_not_split(client):
+    client.results = [{'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.01}}]
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    album = dispatcher.enqueue('sendMediaGroup', {'chat_id': 7, 'media': [{'type': 'photo', 'media': 'a'}]})
+
+    assert album.result(5)['ok']
+    assert [method for _, method, _ in client.calls] == ['sendMediaGroup', 'sendMediaGroup']
+    assert 'album_fallbacks' not in dispatcher.stats()
+
+
+def test_unexpected_error_fails_one_message_and_the_queue_goes_on(client):
+    client.results = [TypeError('Object of type set is not JSON serializable')]
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    futures = [dispatcher.enqueue('sendMessage', {'chat_id': 7, 'text': str(i)}) for i in range(3)]
+
+    with pytest.raises(TypeError):
+        futures[0].result(5)
+    assert all(future.result(5)['ok'] for future in futures[1:])
+    assert dispatcher.stats()['errors'] == 1
+    assert dispatcher.stats()['queue_depth'] == 0
+
+
+def test_int_and_str_chat_ids_share_one_queue(client):
+    dispatcher = OutboundDispatcher(client, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+
+    client.open.clear()
+    futures = [dispatcher.enqueue('sendMessage', {'chat_id': 123 if i % 2 else '123', 'text': str(i)})
+               for i in range(10)]
+    futures.append(dispatcher.enqueue('sendMessage', {'chat_id': 9, 'text': 'other'}))
+    # wait until every message is queued
+    while dispatcher.stats()['queue_depth'] < 11:
+        time.sleep(0.001)
+    assert dispatcher.stats()['active_chats'] == 2
+    client.open.set()
+
+    assert all(future.result(5)['ok'] for future in futures)
+    # one FIFO: the messages went out in the order they were sent, and kept the chat_id they were sent with
+    sent = [payload for _, _, payload in client.calls if payload['text'] != 'other']
+    assert [payload['text'] for payload in sent] == [str(i) for i in range(10)]
+    assert [payload['chat_id'] for payload in sent] == [123 if i % 2 else '123' for i in range(10)]
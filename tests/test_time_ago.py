@@ -0,0 +1,106 @@
+import datetime
+import random
+import types
+
+import pytest
+
+import messages as msgs
+
+pytest.importorskip('numpy')
+
+
+def scalar_labels(monkeypatch, timestamps: list, now: datetime.datetime) -> list:
+    # calculate_time_ago reads the clock; it sees `now` instead
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    with monkeypatch.context() as patch:
+        patch.setattr(msgs, 'datetime', types.SimpleNamespace(datetime=FrozenDatetime, timedelta=datetime.timedelta))
+        return [msgs.calculate_time_ago(timestamp) for timestamp in timestamps]
+
+
+def assert_parity(monkeypatch, timestamps: list, now: datetime.datetime):
+    # calculate_time_ago parses '%Y-%m-%d %H:%M:%S.%f', so every timestamp has microseconds
+    expected = scalar_labels(monkeypatch, timestamps, now)
+
+    assert msgs.calculate_times_ago(timestamps, now) == expected
+    assert msgs.calculate_times_ago([str(timestamp) for timestamp in timestamps], now) == expected
+
+
+def with_microseconds(timestamp: datetime.datetime) -> datetime.datetime:
+    return timestamp if timestamp.microsecond else timestamp.replace(microsecond=1)
+
+
+# month ends, leap days and the last microsecond of a year
+NOWS = [datetime.datetime(2024, 2, 29, 12, 0, 0, 5),
+        datetime.datetime(2023, 2, 28, 0, 0, 0, 1),
+        datetime.datetime(2024, 3, 31, 23, 59, 59, 999999),
+        datetime.datetime(2024, 4, 30, 6, 30, 0, 1),
+        datetime.datetime(2025, 1, 31, 12, 0, 0, 1),
+        datetime.datetime(2023, 12, 31, 23, 59, 59, 999999)]
+
+
+@pytest.mark.parametrize('now', NOWS, ids=str)
+def test_every_day_of_two_years(monkeypatch, now):
+    times_of_day = [datetime.timedelta(microseconds=1),
+                    datetime.timedelta(hours=6, minutes=30, microseconds=1),
+                    datetime.timedelta(hours=12, microseconds=4),
+                    datetime.timedelta(hours=12, microseconds=6),
+                    datetime.timedelta(hours=23, minutes=59, seconds=59, microseconds=999999)]
+
+    timestamps = []
+    day = datetime.datetime(now.year, now.month, now.day) - datetime.timedelta(days=800)
+    while day <= now + datetime.timedelta(days=1):
+        timestamps += [day + time_of_day for time_of_day in times_of_day]
+        day += datetime.timedelta(days=1)
+
+    assert_parity(monkeypatch, timestamps, now)
+
+
+@pytest.mark.parametrize('now', NOWS, ids=str)
+def test_exact_boundaries(monkeypatch, now):
+    # each bucket edge, one microsecond either side, and timestamps in the future
+    edges = [datetime.timedelta(minutes=1), datetime.timedelta(hours=1), datetime.timedelta(days=1),
+             datetime.timedelta(days=28), datetime.timedelta(days=29), datetime.timedelta(days=30),
+             datetime.timedelta(days=31), datetime.timedelta(days=365), datetime.timedelta(days=366),
+             datetime.timedelta(0)]
+    microsecond = datetime.timedelta(microseconds=1)
+
+    timestamps = []
+    for edge in edges:
+        for shift in (-microsecond, datetime.timedelta(0), microsecond):
+            timestamps.append(with_microseconds(now - edge + shift))
+            timestamps.append(with_microseconds(now + edge + shift))
+
+    # the same day and time of day, whole months and years earlier, where the month has that day
+    for months in range(1, 40):
+        year, month = divmod(now.year * 12 + now.month - 1 - months, 12)
+        for shift in (-microsecond, datetime.timedelta(0), microsecond):
+            try:
+                timestamps.append(with_microseconds(now.replace(year=year, month=month + 1) + shift))
+            except ValueError:
+                pass
+
+    assert_parity(monkeypatch, timestamps, now)
+
+
+def test_random_timestamps(monkeypatch):
+    rng = random.Random(7)
+    for _ in range(200):
+        now = datetime.datetime(2020, 1, 1) + datetime.timedelta(microseconds=rng.randrange(10 ** 6 * 86400 * 365 * 6))
+        now = with_microseconds(now)
+        scales = [30, 3600, 86400, 86400 * 31, 86400 * 400, 86400 * 2000]
+        timestamps = [with_microseconds(now - datetime.timedelta(microseconds=rng.randrange(-60 * 10 ** 6,
+                                                                                            10 ** 6 * scale)))
+                      for scale in rng.choices(scales, k=60)]
+
+        assert_parity(monkeypatch, timestamps, now)
+
+
+def test_missing_and_empty():
+    now = datetime.datetime(2024, 2, 29, 12, 0, 0, 5)
+
+    assert msgs.calculate_times_ago([], now) == []
+    assert msgs.calculate_times_ago([None, now - datetime.timedelta(hours=2), None], now) == ['', '2h', '']
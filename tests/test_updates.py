@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+
+import updates
+
+
+def callback(update_id: int, user_id: int, data: str) -> dict:
+    return {'update_id': update_id, 'callback_query': {'from': {'id': user_id}, 'data': data}}
+
+
+def run_pool(pool: updates.UpdateWorkerPool, expected: int, timeout: float = 5):
+    pool.start()
+    deadline = time.monotonic() + timeout
+    while pool.counters['processed'] + pool.counters['failed'] < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.stop()
+
+
+def test_priority_orders_users_not_updates_of_one_user():
+    processed = []
+    pool = updates.UpdateWorkerPool(lambda req: processed.append(req['update_id']), workers=1)
+
+    # user 1 is in the wizard and submits right after; user 3 submits
+    pool.submit(callback(1, 1, 'image_size|128'))
+    pool.submit(callback(2, 1, 'gpu_model_CPU'))
+    pool.submit(callback(3, 2, 'image_size|128'))
+    pool.submit(callback(4, 3, 'gpu_model_CPU'))
+    run_pool(pool, 4)
+
+    # user 3's submission goes first, but user 1's submission waits for the wizard step sent before it
+    assert processed == [4, 1, 2, 3]
+
+
+def test_updates_of_one_user_run_in_order_and_one_at_a_time():
+    processed = []
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def handler(req):
+        user_id = updates.update_user_id(req)
+        with lock:
+            if user_id in running:
+                overlaps.append(req['update_id'])
+            running.add(user_id)
+        time.sleep(0.001)
+        with lock:
+            running.discard(user_id)
+            processed.append((user_id, req['update_id']))
+
+    pool = updates.UpdateWorkerPool(handler, workers=8)
+    steps = ['new_model', 'batch_size|8', 'gpu_model_CPU', 'show_leaderboard']
+    update_id = 0
+    for round_ in range(5):
+        for user_id in range(10):
+            for step in steps:
+                update_id += 1
+                assert pool.submit(callback(update_id, user_id, step)) == updates.QUEUED
+    run_pool(pool, update_id)
+
+    assert not overlaps
+    assert len(processed) == update_id
+    for user_id in range(10):
+        ids = [processed_id for processed_user, processed_id in processed if processed_user == user_id]
+        assert ids == sorted(ids)
+
+
+def test_shedding_and_rejection():
+    pool = updates.UpdateWorkerPool(lambda req: None, workers=1, max_queue=4, shed_threshold=0.5)
+
+    assert pool.submit(callback(1, 1, 'show_leaderboard')) == updates.QUEUED
+    assert pool.submit(callback(2, 2, 'new_model')) == updates.QUEUED
+    # half full: low priority updates are shed, the others still queued
+    assert pool.submit(callback(3, 3, 'show_leaderboard')) == updates.SHED
+    assert pool.submit(callback(4, 1, 'gpu_model_CPU')) == updates.QUEUED
+    assert pool.submit(callback(5, 4, 'new_model')) == updates.QUEUED
+    assert pool.submit(callback(6, 5, 'gpu_model_CPU')) == updates.REJECTED
+    assert pool.stats()['queue_depth'] == 4
+
+    run_pool(pool, 4)
+    assert pool.stats()['queue_depth'] == 0
+    assert pool.counters['processed'] == 4
+
+
+def test_update_validation():
+    assert not updates.is_valid_update([])
+    assert not updates.is_valid_update({'message': {'text': '/start'}})
+    assert not updates.is_valid_update({'update_id': '1', 'message': {'text': '/start'}})
+
+    # well formed, but of a type the bot doesn't answer: valid, and ignored
+    edited = {'update_id': 1, 'edited_message': {'text': '/start'}}
+    assert updates.is_valid_update(edited)
+    assert not updates.is_handled_update(edited)
+    assert updates.is_handled_update(callback(2, 1, 'new_model'))
+
+
+def test_user_async_locks_only_serialize_one_user():
+    events = []
+
+    async def handle(update_id: int, user_id: int, secs: float):
+        async with updates.user_async_lock(callback(update_id, user_id, 'new_model')):
+            events.append(('start', update_id))
+            await asyncio.sleep(secs)
+            events.append(('end', update_id))
+
+    async def main():
+        # user 1's second update waits for the first; user 2 runs meanwhile
+        await asyncio.gather(handle(1, 1, 0.05), handle(2, 1, 0), handle(3, 2, 0))
+
+    asyncio.run(main())
+
+    assert events == [('start', 1), ('start', 3), ('end', 3), ('end', 1), ('start', 2), ('end', 2)]
+    # the locks of idle users are dropped
+    assert len(updates._user_async_locks) == 0
@@ -0,0 +1,309 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+import database as db
+import database_async as dba
+import hyperparameters as hp
+import messages as msgs
+from telegram_aux import tel_parse_message, tel_send_message
+
+# 'inline' handles the update inside the webhook request; 'queue' acks right away and hands it to the worker pool
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'inline')
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+# above this fraction of the queue, low priority updates are shed
+UPDATE_SHED_THRESHOLD = float(os.environ.get('UPDATE_SHED_THRESHOLD', 0.8))
+
+# priority classes: lower values are processed first
+PRIORITY_SUBMISSION = 0
+PRIORITY_WIZARD = 1
+PRIORITY_LOW = 2
+
+LOW_PRIORITY_COMMANDS = ('show_leaderboard', 'show_status', 'list_competitors')
+
+# results of UpdateWorkerPool.submit
+QUEUED = 'queued'
+SHED = 'shed'
+REJECTED = 'rejected'
+
+
+def update_session(dict_msg: dict) -> dict:
+    # load dict from disk, update it and save it back to disk
+    user_id = dict_msg.get('user_id', '')
+
+    dict_user_hp = db.load_dict(user_id)
+    dict_user_hp = msgs.update_dict_user_hps(dict_user_hp, dict_msg)
+    db.save_dict(dict_user_hp, user_id)
+
+    return dict_user_hp
+
+
+def handle_update(req: dict, base_url: str = None, register: bool = True):
+    # Parse the message to a structured dictionary
+    dict_msg = tel_parse_message(req)
+
+    user_id = dict_msg.get('user_id', '')
+    txt = dict_msg.get('txt', '')
+
+    dict_user_hp = update_session(dict_msg)
+
+    # register the competitor in the database, if necessary (the inline webhook already did, asynchronously)
+    if register:
+        db.register_competitor(dict_msg)
+
+    # evaluate the user's message and respond accordingly
+    if txt == 'new_model':
+        dict_user_hp = {}
+        db.save_dict(dict_user_hp, user_id)
+        msgs.select_batch_size(dict_msg)
+
+    elif txt in hp.batch_sizes:
+        msgs.select_epochs(dict_msg)
+
+    elif txt in hp.epochs:
+        msgs.select_lr(dict_msg)
+
+    elif txt in hp.learning_rates:
+        msgs.select_batch_norm(dict_msg)
+
+    elif txt in hp.batch_norm:
+        msgs.select_filters(dict_msg)
+
+    elif txt in hp.filters:
+        msgs.select_dropout(dict_msg)
+
+    elif txt in hp.dropout:
+        msgs.select_image_size(dict_msg)
+
+    elif txt in hp.image_size:
+        msgs.select_gpu(dict_msg, dict_user_hp)
+
+    elif txt in msgs.list_gpus_buttons():
+        msgs.submit_training(dict_msg, dict_user_hp, base_url=base_url)
+
+    elif txt == "list_competitors":
+        results = json.dumps(db.list_competitors(), indent=2, default=str)
+        msg = 'Users:\n' + results
+        tel_send_message(dict_msg['chat_id'], msg)
+
+    elif txt == "show_leaderboard":
+        msgs.show_leaderboard(dict_msg)
+
+    elif txt == "show_status":
+        msgs.show_training_status(dict_msg, base_url=base_url)
+
+    else:
+        # clear dict user hyperparameters
+        dict_user_hp = {}
+        db.save_dict(dict_user_hp, user_id)
+        msgs.welcome_message(dict_msg)
+
+
+async def handle_update_async(req: dict, base_url: str = None):
+    # handle_update for the inline webhook. The registration and the queries of the GPU selection and of the
+    # training submission are awaited on the event loop; the session store and the other steps run in a thread
+    dict_msg = tel_parse_message(req)
+    txt = dict_msg.get('txt', '')
+
+    await dba.register_competitor(dict_msg)
+
+    if txt in hp.image_size:
+        dict_user_hp = await asyncio.to_thread(update_session, dict_msg)
+        await msgs.select_gpu_async(dict_msg, dict_user_hp)
+
+    elif txt in msgs.list_gpus_buttons():
+        dict_user_hp = await asyncio.to_thread(update_session, dict_msg)
+        await msgs.submit_training_async(dict_msg, dict_user_hp, base_url=base_url)
+
+    else:
+        await asyncio.to_thread(handle_update, req, base_url, False)
+
+
+# striped per-user locks: updates from the same user never run concurrently, so a double tap cannot race on the
+# user's wizard state
+_user_locks = [threading.Lock() for _ in range(64)]
+
+
+def user_lock(req: dict) -> threading.Lock:
+    return _user_locks[hash(update_user_id(req)) % len(_user_locks)]
+
+
+class KeyedAsyncLocks:
+    """
+    One asyncio lock per key, created on first use and dropped once nobody holds or waits for it.
+
+    Only used from the event loop, so the bookkeeping needs no lock of its own. asyncio locks are granted first
+    come, first served, and a free lock is taken without suspending.
+    """
+
+    def __init__(self):
+        # key -> [lock, holders and waiters]
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+# the inline webhook holds the user's lock on the loop while the update runs, so a user's updates start in the
+# order they arrived and never overlap. Other users are not held back
+_user_async_locks = KeyedAsyncLocks()
+
+
+def user_async_lock(req: dict):
+    return _user_async_locks.hold(update_user_id(req))
+
+
+def is_valid_update(req) -> bool:
+    # a Telegram update is an object with an integer update_id
+    return isinstance(req, dict) and isinstance(req.get('update_id'), int)
+
+
+def is_handled_update(req: dict) -> bool:
+    # the update types the bot answers; the others (edited_message, my_chat_member, ...) are acknowledged and ignored
+    return bool(req.get('message') or req.get('callback_query'))
+
+
+def update_user_id(req: dict):
+    update = req.get('callback_query') or req.get('message') or {}
+    return update.get('from', {}).get('id')
+
+
+def update_priority(req: dict) -> int:
+    if req.get('callback_query'):
+        txt = req['callback_query'].get('data', '')
+    else:
+        txt = req.get('message', {}).get('text', '')
+
+    if txt.startswith('gpu_model_'):
+        return PRIORITY_SUBMISSION
+    if txt in LOW_PRIORITY_COMMANDS:
+        return PRIORITY_LOW
+    return PRIORITY_WIZARD
+
+
+class UpdateWorkerPool:
+    """
+    Bounded queue of Telegram updates drained by a pool of worker threads.
+
+    Each user's updates wait in a FIFO of their own, and a user is handed to one worker at a time, so the updates
+    of a user are processed one after the other, in the order they arrived. Priorities only order the users
+    waiting for a worker: users whose next update is a training submission are served first, then those in the
+    wizard, then leaderboard/status requests. When the queue is nearly full, low priority updates are shed; when
+    it is full, everything is.
+    """
+
+    def __init__(self, handler, workers: int = UPDATE_WORKERS, max_queue: int = UPDATE_QUEUE_SIZE,
+                 shed_threshold: float = UPDATE_SHED_THRESHOLD):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.shed_depth = int(max_queue * shed_threshold)
+
+        # (priority of the next update, seq, user_id) of the users waiting for a worker
+        self._ready = queue.PriorityQueue()
+        # user_id -> FIFO of (priority, queued_at, req, args); a user is in here while waiting or being processed
+        self._pending = {}
+        self._seq = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.depth = 0
+        self.busy = 0
+        self.counters = collections.Counter()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'update-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10):
+        # sentinels sort after every real update, so queued work is finished first
+        for _ in self._threads:
+            self._ready.put((PRIORITY_LOW + 1, next(self._seq), None))
+
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+
+    def submit(self, req: dict, *args) -> str:
+        priority = update_priority(req)
+        user_id = update_user_id(req)
+
+        with self._lock:
+            if self.depth >= self.max_queue:
+                result = SHED if priority == PRIORITY_LOW else REJECTED
+            elif priority == PRIORITY_LOW and self.depth >= self.shed_depth:
+                result = SHED
+            else:
+                pending = self._pending.get(user_id)
+                if pending is None:
+                    pending = self._pending[user_id] = collections.deque()
+                    self._ready.put((priority, next(self._seq), user_id))
+                pending.append((priority, time.monotonic(), req, args))
+                self.depth += 1
+                result = QUEUED
+
+            self.counters[result] += 1
+
+        return result
+
+    def _work(self):
+        while True:
+            priority, _, user_id = self._ready.get()
+            if priority > PRIORITY_LOW:
+                break
+
+            with self._lock:
+                _, queued_at, req, args = self._pending[user_id].popleft()
+                self.depth -= 1
+                self.busy += 1
+                self.counters['wait_ms_total'] += int((time.monotonic() - queued_at) * 1000)
+
+            result = 'processed'
+            try:
+                self.handler(req, *args)
+            except Exception as e:
+                result = 'failed'
+                print(f'Error processing update {req.get("update_id")}: {e!r}')
+
+            with self._lock:
+                self.busy -= 1
+                self.counters[result] += 1
+
+                pending = self._pending[user_id]
+                if pending:
+                    # back in line, behind the users already waiting with the same priority
+                    self._ready.put((pending[0][0], next(self._seq), user_id))
+                else:
+                    del self._pending[user_id]
+
+    def stats(self) -> dict:
+        return {'mode': WEBHOOK_MODE,
+                'queue_depth': self.depth,
+                'max_queue': self.max_queue,
+                'workers': len(self._threads),
+                'busy_workers': self.busy,
+                'waiting_users': len(self._pending) - self.busy,
+                **self.counters}